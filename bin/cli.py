@@ -51,6 +51,8 @@ def main(check_env, deploying):
     if migrate == 'y':
         process_migrate = subprocess.check_call(
             ['python', 'manage.py', 'migrate'])
+        process_cache = subprocess.check_call(
+            ['python', 'manage.py', 'createcachetable'])
 
     prepopulate = input("Prepopulate the database? [y/n]: ")
     # TODO: this should be done by default in the migration step
@@ -1,14 +1,52 @@
-from django.contrib import admin
-from .models import Item, OrderItem, Order, Payment, Coupon, Refund, Address, UserProfile
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.contrib import admin, messages
+from django.db.models import Avg, Count, Q, Sum
+from django.db.models.functions import TruncMonth
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils import timezone
+from .catalog import bump_catalog_version
+from .models import Item, OrderItem, OrderLine, Order, DailySales, HourlySales, Payment, PaymentJob, Coupon, CouponRedemption, Refund, Address, UserProfile
+from .pagination import EstimatedCountPaginator
+from .refunds import process_refunds
+from .routers import replica_reads
 
 def make_refund_accepted(modeladmin, request, queryset):
-    queryset.update(refund_requested = False,
-                    refund_granted   = True)
-make_refund_accepted.short_description = "Update orders to refund granted"
+    results = process_refunds(queryset)
+    modeladmin.message_user(request, "%(succeeded)d orders refunded, %(failed)d failed." % results,
+                            messages.SUCCESS if not results["failed"] else messages.WARNING)
+make_refund_accepted.short_description = "Refund the selected orders through Stripe"
 
 # Register your models here.
 
-class OrderAdmin(admin.ModelAdmin):
+class LargeTableAdmin(admin.ModelAdmin):
+    # no COUNT(*) over the whole table on every changelist load
+    paginator              = EstimatedCountPaginator
+    show_full_result_count = False
+
+class ItemAdmin(LargeTableAdmin):
+    list_display        = ["title",
+                           "price",
+                           "discount_price",
+                           "category",
+                           "label",
+                           "slug"]
+
+    list_filter         = ["category",
+                           "label"]
+
+    search_fields       = ["title",
+                           "slug"]
+
+    def response_action(self, request, queryset):
+        # bulk actions may use queryset.update() which sends no signals
+        response = super().response_action(request, queryset)
+        bump_catalog_version()
+        return response
+
+class OrderAdmin(LargeTableAdmin):
     list_display        = ["user",
                            "ordered",
                            "being_delivered",
@@ -37,7 +75,71 @@ class OrderAdmin(admin.ModelAdmin):
 
     actions             = [make_refund_accepted]
 
-class AddressAdmin(admin.ModelAdmin):
+    # every __str__ shown in list_display follows its user
+    list_select_related = ["user",
+                           "billing_address__user",
+                           "shipping_address__user",
+                           "payment__user",
+                           "coupon"]
+
+    def get_urls(self):
+        return [
+            path("sales/",
+                 self.admin_site.admin_view(self.sales_overview),
+                 name = "core_order_sales"),
+        ] + super().get_urls()
+
+    def sales_overview(self, request):
+        # a report a few seconds behind is fine, it runs on a replica
+        with replica_reads():
+            return self.render_sales_overview(request)
+
+    def render_sales_overview(self, request):
+        paid    = Order.objects.filter(ordered = True)
+        context = dict(
+            self.admin_site.each_context(request),
+            title     = "Sales overview",
+            opts      = self.model._meta,
+            totals    = paid.aggregate(
+                orders            = Count("id"),
+                revenue           = Sum("total"),
+                average           = Avg("total"),
+                discounts         = Sum("discount_total"),
+                coupons           = Sum("coupon_amount"),
+                refunds_requested = Count("id", filter = Q(refund_requested = True)),
+                refunds_granted   = Count("id", filter = Q(refund_granted = True))
+            ),
+            months    = self.last_months(paid, 12),
+            top_items = OrderLine.objects.values("title")
+                            .annotate(quantity = Sum("quantity"), revenue = Sum("line_total"))
+                            .order_by("-revenue")[:10],
+            coupons   = paid.exclude(coupon = None)
+                            .values("coupon__code")
+                            .annotate(orders = Count("id"), amount = Sum("coupon_amount"))
+                            .order_by("-orders")[:10],
+        )
+        return TemplateResponse(request, "admin/core/order/sales_overview.html", context).render()
+
+    def last_months(self, paid, count):
+        """Orders and revenue of the last `count` calendar months, newest first, months without sales included."""
+        month  = timezone.localdate().replace(day = 1)
+        months = [month]
+        for _ in range(count - 1):
+            month = (month - timedelta(days = 1)).replace(day = 1)
+            months.append(month)
+        since = timezone.make_aware(datetime.combine(months[-1], time()))
+        rows  = {
+            timezone.localtime(row["month"]).date(): row
+            for row in paid.filter(payment__timestamp__gte = since)
+                           .annotate(month = TruncMonth("payment__timestamp"))
+                           .values("month")
+                           .annotate(orders = Count("id"), revenue = Sum("total"))
+                           .order_by()
+        }
+        return [rows.get(month, {"month": month, "orders": 0, "revenue": Decimal("0.00")})
+                for month in months]
+
+class AddressAdmin(LargeTableAdmin):
     list_display        = ["user",
                            "street_address",
                            "apartment_address",
@@ -55,11 +157,130 @@ class AddressAdmin(admin.ModelAdmin):
                            "apartment_address",
                            "postal_code"]
 
-admin.site.register(Item)
-admin.site.register(OrderItem)
+    list_select_related = ["user"]
+
+class OrderItemAdmin(LargeTableAdmin):
+    list_display        = ["__str__",
+                           "user",
+                           "ordered"]
+
+    list_select_related = ["item",
+                           "user"]
+
+class PaymentAdmin(LargeTableAdmin):
+    list_display        = ["stripe_charge_id",
+                           "user",
+                           "amount",
+                           "timestamp"]
+
+    list_select_related = ["user"]
+
+class RefundAdmin(LargeTableAdmin):
+    list_display        = ["__str__",
+                           "order",
+                           "status",
+                           "amount",
+                           "stripe_refund_id",
+                           "processed_at"]
+
+    list_filter         = ["status",
+                           "accepted"]
+
+    list_select_related = ["order__user"]
+
+class PaymentJobAdmin(LargeTableAdmin):
+    list_display        = ["idempotency_key",
+                           "user",
+                           "order",
+                           "amount",
+                           "status",
+                           "attempts",
+                           "run_after"]
+
+    list_filter         = ["status"]
+
+    search_fields       = ["idempotency_key",
+                           "user__username"]
+
+    list_select_related = ["user",
+                           "order__user"]
+
+class OrderLineAdmin(LargeTableAdmin):
+    list_display        = ["order",
+                           "title",
+                           "quantity",
+                           "price",
+                           "discount_price",
+                           "line_total",
+                           "ordered_date"]
+
+    search_fields       = ["title",
+                           "order__ref_code"]
+
+    date_hierarchy      = "ordered_date"
+
+class DailySalesAdmin(admin.ModelAdmin):
+    list_display        = ["day",
+                           "category",
+                           "revenue",
+                           "orders",
+                           "units",
+                           "coupon_discount"]
+
+    list_filter         = ["category"]
+
+    date_hierarchy      = "day"
+
+class HourlySalesAdmin(admin.ModelAdmin):
+    list_display        = ["hour",
+                           "category",
+                           "revenue",
+                           "orders",
+                           "units",
+                           "coupon_discount"]
+
+    list_filter         = ["category"]
+
+    date_hierarchy      = "hour"
+
+class CouponAdmin(admin.ModelAdmin):
+    list_display        = ["code",
+                           "amount",
+                           "active",
+                           "valid_from",
+                           "valid_until",
+                           "min_basket",
+                           "uses",
+                           "max_uses",
+                           "max_uses_per_user"]
+
+    list_filter         = ["active"]
+
+    search_fields       = ["code"]
+
+    readonly_fields     = ["uses"]
+
+class CouponRedemptionAdmin(LargeTableAdmin):
+    list_display        = ["coupon",
+                           "user",
+                           "uses"]
+
+    search_fields       = ["coupon__code",
+                           "user__username"]
+
+    list_select_related = ["coupon",
+                           "user"]
+
+admin.site.register(Item, ItemAdmin)
+admin.site.register(OrderItem, OrderItemAdmin)
+admin.site.register(OrderLine, OrderLineAdmin)
+admin.site.register(DailySales, DailySalesAdmin)
+admin.site.register(HourlySales, HourlySalesAdmin)
 admin.site.register(Order, OrderAdmin)
-admin.site.register(Payment)
-admin.site.register(Coupon)
-admin.site.register(Refund)
+admin.site.register(Payment, PaymentAdmin)
+admin.site.register(PaymentJob, PaymentJobAdmin)
+admin.site.register(Coupon, CouponAdmin)
+admin.site.register(CouponRedemption, CouponRedemptionAdmin)
+admin.site.register(Refund, RefundAdmin)
 admin.site.register(Address, AddressAdmin)
 admin.site.register(UserProfile)
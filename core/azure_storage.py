@@ -0,0 +1,12 @@
+from django.contrib.staticfiles.storage import ManifestFilesMixin
+from storages.backends.azure_storage import AzureStorage
+
+from .storage import CompressedFilesMixin, LenientManifestMixin
+
+
+class CompressedManifestAzureStorage(CompressedFilesMixin, LenientManifestMixin, ManifestFilesMixin, AzureStorage):
+    """
+    Hashed names, the manifest and the precompressed variants in the Azure
+    container. Only imported by djecommerce/azure.py, where django-storages
+    is installed.
+    """
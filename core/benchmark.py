@@ -0,0 +1,243 @@
+import json
+import os
+import random
+import statistics
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.template import engines
+from django.template.backends.django import DjangoTemplates
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import cart
+from .catalog import bump_catalog_version
+from .models import CATEGORY_CHOICES, LABEL_CHOICES, Address, Coupon, Item, Order, OrderItem, PaymentJob
+
+QUERY_BUDGETS = os.path.join(os.path.dirname(__file__), "query_budgets.json")
+TRANSACTION_STATEMENTS = ("BEGIN", "SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+
+
+def seed_items(count, batch_size = None, seed = 0):
+    """Bulk insert `count` synthetic items (no signals, bumps the catalog version)."""
+    rng   = random.Random(seed)
+    start = (Item.objects.order_by("-id").values_list("id", flat = True).first() or 0) + 1
+    items = (
+        Item(
+            title          = f"Synthetic item {n}",
+            price          = rng.randint(500, 10000) / 100,
+            discount_price = rng.choice([None, rng.randint(100, 500) / 100]),
+            category       = rng.choice(CATEGORY_CHOICES)[0],
+            label          = rng.choice(LABEL_CHOICES)[0],
+            slug           = f"synthetic-item-{n}",
+            description    = f"Synthetic description {n}",
+            image          = "synthetic.jpg"
+        )
+        for n in range(start, start + count)
+    )
+    Item.objects.bulk_create(items, batch_size = batch_size)
+    bump_catalog_version()
+
+
+def time_view(view, path, repeat = 5, user = None):
+    """Median wall time in milliseconds to render `path` with `view`."""
+    factory = RequestFactory()
+    samples = []
+    for _ in range(repeat):
+        # start from a cold catalog cache so every sample hits the database
+        bump_catalog_version()
+        request      = factory.get(path)
+        request.user = user or AnonymousUser()
+        request.cart = None
+        started      = time.perf_counter()
+        response     = view(request)
+        if hasattr(response, "render"):
+            response.render()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def uncached_template_backend():
+    """The project's template engine without the cached loader, templates are compiled on every render."""
+    config  = settings.TEMPLATES[0]
+    options = dict(config["OPTIONS"], loaders = [
+        "django.template.loaders.filesystem.Loader",
+        "django.template.loaders.app_directories.Loader",
+    ])
+    return DjangoTemplates({"NAME": "uncached", "DIRS": config["DIRS"], "APP_DIRS": False, "OPTIONS": options})
+
+
+def fragment_cache():
+    return caches["template_fragments"] if "template_fragments" in settings.CACHES else caches["default"]
+
+
+def time_render(backend, template_name, context, repeat = 10, cold_fragments = False):
+    """Median wall time in milliseconds to render `template_name` for an anonymous visitor."""
+    request      = RequestFactory().get("/")
+    request.user = AnonymousUser()
+    request.cart = None
+    samples      = []
+    for _ in range(repeat):
+        if cold_fragments:
+            fragment_cache().clear()
+        started = time.perf_counter()
+        backend.get_template(template_name).render(context, request)
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def render_timings(page_size = 10, repeat = 10):
+    """
+    Home page render times for one page of product cards: without the
+    cached loader or fragments (compile and render everything), with the
+    cached loader and cold card fragments, and with warm fragments.
+    """
+    context = {"object_list": list(Item.objects.order_by("-id")[:page_size])}
+    cached  = engines["django"]
+    return {
+        "uncached_loader": round(time_render(uncached_template_backend(), "home.html", context, repeat,
+                                             cold_fragments = True), 3),
+        "cold_fragments":  round(time_render(cached, "home.html", context, repeat, cold_fragments = True), 3),
+        "warm_fragments":  round(time_render(cached, "home.html", context, repeat), 3),
+    }
+
+
+def seed_dataset(users = 2, items = 100, cart_lines = 3, orders = 2, seed = 0):
+    """
+    Synthetic shop: items, then per user default addresses, `orders` past
+    orders and an open cart of `cart_lines` lines.
+    """
+    rng = random.Random(seed)
+    seed_items(items, seed = seed)
+    catalog = list(Item.objects.order_by("id"))
+    coupon  = Coupon.objects.create(code = "BENCH", amount = 1)
+    dataset = {"users": [], "items": catalog, "coupon": coupon, "ref_codes": []}
+
+    for n in range(users):
+        user = get_user_model().objects.create_user(f"bench-{n}", f"bench-{n}@example.com", "bench")
+        for address_type in ("S", "B"):
+            Address.objects.create(user = user, street_address = f"{n} Bench street", apartment_address = "",
+                                   country = "FR", postal_code = "75001", address_type = address_type,
+                                   default = True)
+        for o in range(orders + 1):
+            for item in rng.sample(catalog, min(cart_lines, len(catalog))):
+                cart.add_item(user, item, quantity = rng.randint(1, 3))
+            if o < orders:
+                order    = Order.objects.get(user = user, ordered = False)
+                ref_code = f"BENCH{n:04d}{o:04d}"
+                order.items.update(ordered = True)
+                Order.objects.filter(pk = order.pk).update(ordered = True, ordered_date = timezone.now(),
+                                                           ref_code = ref_code)
+                dataset["ref_codes"].append(ref_code)
+        dataset["users"].append(user)
+    return dataset
+
+
+def view_scenarios(dataset):
+    """
+    (name, url name, method, path, data) for every route, in an order that
+    keeps the cart usable. A callable path is resolved right before the request.
+    """
+    item     = dataset["items"][0]
+    in_cart  = Order.objects.get(user = dataset["users"][0], ordered = False).items.first().item
+    checkout = {"use_default_shipping": "on", "use_default_billing": "on", "payment_option": "S"}
+    return [
+        ("home", "home", "get", reverse("core:home"), None),
+        ("home:filtered", "home", "get", reverse("core:home") + "?category=S&page=2", None),
+        ("home:keyset", "home", "get", reverse("core:home") + f"?after={item.pk + 50}", None),
+        ("search", "search", "get", reverse("core:search") + "?q=synthetic", None),
+        ("product", "product", "get", item.get_absolute_url(), None),
+        ("order-summary", "order-summary", "get", reverse("core:order-summary"), None),
+        ("add-to-cart:new", "add-to-cart", "get", item.get_add_to_cart_url(), None),
+        ("add-to-cart:existing", "add-to-cart", "get", item.get_add_to_cart_url(), None),
+        ("remove-single-item-from-cart", "remove-single-item-from-cart", "get",
+         reverse("core:remove-single-item-from-cart", kwargs = {"slug": item.slug}), None),
+        ("remove-from-cart", "remove-from-cart", "get", in_cart.get_remove_from_cart_url(), None),
+        ("checkout:get", "checkout", "get", reverse("core:checkout"), None),
+        ("checkout:post", "checkout", "post", reverse("core:checkout"), checkout),
+        ("add-coupon", "add-coupon", "post", reverse("core:add-coupon"), {"code": dataset["coupon"].code}),
+        ("payment:get", "payment", "get", reverse("core:payment", kwargs = {"payment_option": "stripe"}), None),
+        ("payment:post", "payment", "post", reverse("core:payment", kwargs = {"payment_option": "stripe"}),
+         {"stripeToken": "tok_visa"}),
+        ("payment-status", "payment-status", "get",
+         lambda: reverse("core:payment-status", kwargs = {"key": PaymentJob.objects.latest("created").idempotency_key}),
+         None),
+        ("request-refund:get", "request-refund", "get", reverse("core:request-refund"), None),
+        ("request-refund:post", "request-refund", "post", reverse("core:request-refund"),
+         {"ref_code": dataset["ref_codes"][0], "message": "Too small", "email": "bench@example.com"}),
+    ]
+
+
+def measure_request(client, method, path, data = None):
+    """Status, query count, SQL time and wall time of one request through the test client."""
+    if callable(path):
+        path = path()
+    sql_time = []
+
+    def timed(execute, sql, params, many, context):
+        # captured_queries only keep millisecond precision
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            if not sql.startswith(TRANSACTION_STATEMENTS):
+                sql_time.append(time.perf_counter() - started)
+
+    with CaptureQueriesContext(connection) as context, connection.execute_wrapper(timed):
+        started  = time.perf_counter()
+        response = getattr(client, method)(path, data or {})
+        wall_ms  = (time.perf_counter() - started) * 1000
+    queries = [query for query in context.captured_queries
+               if not query["sql"].startswith(TRANSACTION_STATEMENTS)]
+    return {
+        "status":  response.status_code,
+        "queries": len(queries),
+        "sql_ms":  round(sum(sql_time) * 1000, 3),
+        "wall_ms": round(wall_ms, 3),
+    }
+
+
+def load_query_budgets(path = QUERY_BUDGETS):
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_results(results, path, **meta):
+    with open(path, "w") as f:
+        json.dump(dict(meta, results = results), f, indent = 2, sort_keys = True)
+
+
+def hot_queries():
+    """The lookups every cart, checkout and refund request runs, by name."""
+    return {
+        "open order":             Order.objects.filter(user_id = 1, ordered = False),
+        "past orders":            Order.objects.filter(user_id = 1, ordered = True),
+        "open order line":        OrderItem.objects.filter(user_id = 1, item_id = 1, ordered = False),
+        "default address":        Address.objects.filter(user_id = 1, address_type = "S", default = True),
+        "item by slug":           Item.objects.filter(slug = "shirt"),
+        "coupon by code":         Coupon.objects.filter(code = "SAVE10"),
+        "order by ref code":      Order.objects.filter(ref_code = "abc"),
+    }
+
+
+def explain(queryset):
+    """
+    (uses an index, plan). Postgres prefers sequential scans of small tables,
+    they are disabled so the plan shows whether an index can serve the query.
+    """
+    with transaction.atomic():
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+        plan = queryset.explain()
+    if connection.vendor == "sqlite":
+        # every table access must be a SEARCH, a bare SCAN reads the whole table
+        steps = [line for line in plan.splitlines() if " SCAN " in f" {line} " or "SEARCH" in line]
+        return all("SEARCH" in line for line in steps), plan
+    return "Seq Scan" not in plan, plan
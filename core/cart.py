@@ -0,0 +1,295 @@
+import json
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Prefetch
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject, cached_property
+
+from .models import Item, Order, OrderItem, PaymentJob, order_total_expression
+
+ADDED       = "added"
+UPDATED     = "updated"
+REMOVED     = "removed"
+NOT_IN_CART = "not_in_cart"
+
+# Query budget of the cart mutations, on top of the item lookup and the
+# request.cart load (transaction statements not counted):
+#
+#   add_item              item already in the cart       2 (line update, order update)
+#                         new item                       3 (line insert, link, order update)
+#                         first item, no open order      4 (+ order insert)
+#   remove_single_item    quantity > 1                   2 (line update, order update)
+#                         last unit                      5 (line update, line select, unlink, delete, order update)
+#   remove_item                                          4 (line select, unlink, delete, order update)
+#
+# Quantities and the order's stored totals are only ever changed with F()
+# expressions inside one transaction, and the unique open order / open order
+# item constraints turn concurrent inserts into updates, so concurrent clicks
+# never lose an update.
+#
+# While a payment job of the order is pending or running, the order update
+# matches no row and the mutation is rolled back with CartLocked: the job
+# charges the total it was queued with, so the lines must stay as they are.
+#
+# Anonymous visitors get a SessionCart kept in a signed cookie instead, so
+# browsing never writes to the database. It is merged into the open order
+# when they log in.
+
+ANONYMOUS_CART_COOKIE  = getattr(settings, "ANONYMOUS_CART_COOKIE", "cart")
+ANONYMOUS_CART_MAX_AGE = getattr(settings, "ANONYMOUS_CART_MAX_AGE", 60 * 60 * 24 * 30)
+ANONYMOUS_CART_LINES   = 50
+ANONYMOUS_CART_SALT    = "core.cart"
+
+
+class CartLocked(Exception):
+    """The open order is being paid, its lines can't change."""
+
+
+class SessionCartLines:
+    def __init__(self, cart):
+        self.cart = cart
+
+    def all(self):
+        return self.cart.lines
+
+
+class SessionCart:
+    """
+    Anonymous cart, {item id: quantity} in a signed cookie. Its lines are
+    unsaved OrderItems so the templates render it like an Order.
+    """
+
+    pk            = None
+    coupon        = None
+    coupon_id     = None
+    coupon_amount = 0
+
+    def __init__(self, quantities = None):
+        self.quantities = quantities or {}
+        self.modified   = False
+        self.items      = SessionCartLines(self)
+
+    @classmethod
+    def from_request(cls, request):
+        value = request.get_signed_cookie(ANONYMOUS_CART_COOKIE, default = None,
+                                          salt = ANONYMOUS_CART_SALT, max_age = ANONYMOUS_CART_MAX_AGE)
+        try:
+            quantities = {int(pk): int(quantity) for pk, quantity in json.loads(value).items()}
+        except (TypeError, ValueError, AttributeError):
+            quantities = {}
+        return cls({pk: quantity for pk, quantity in quantities.items() if quantity > 0})
+
+    def __bool__(self):
+        return bool(self.quantities)
+
+    @cached_property
+    def lines(self):
+        items = Item.objects.in_bulk(list(self.quantities))
+        return [
+            OrderItem(item = items[pk], quantity = quantity,
+                      line_total = quantity * items[pk].get_final_price())
+            for pk, quantity in self.quantities.items() if pk in items
+        ]
+
+    @property
+    def subtotal(self):
+        return sum(line.get_total_item_price() for line in self.lines)
+
+    @property
+    def total(self):
+        return sum(line.line_total for line in self.lines)
+
+    @property
+    def discount_total(self):
+        return self.subtotal - self.total
+
+    def get_total(self):
+        return self.total
+
+    def _changed(self):
+        self.modified = True
+        self.__dict__.pop("lines", None)
+
+    def add(self, item, quantity = 1):
+        status = UPDATED if item.pk in self.quantities else ADDED
+        if status == ADDED and len(self.quantities) >= ANONYMOUS_CART_LINES:
+            return NOT_IN_CART
+        self.quantities[item.pk] = self.quantities.get(item.pk, 0) + quantity
+        self._changed()
+        return status
+
+    def remove_single(self, item):
+        if item.pk not in self.quantities:
+            return NOT_IN_CART
+        if self.quantities[item.pk] > 1:
+            self.quantities[item.pk] -= 1
+            self._changed()
+            return UPDATED
+        return self.remove(item)
+
+    def remove(self, item):
+        if self.quantities.pop(item.pk, None) is None:
+            return NOT_IN_CART
+        self._changed()
+        return REMOVED
+
+    def save(self, response):
+        if self.quantities:
+            value = json.dumps({str(pk): quantity for pk, quantity in self.quantities.items()},
+                               separators = (",", ":"))
+            response.set_signed_cookie(ANONYMOUS_CART_COOKIE, value, salt = ANONYMOUS_CART_SALT,
+                                       max_age = ANONYMOUS_CART_MAX_AGE, httponly = True, samesite = "Lax")
+        else:
+            response.delete_cookie(ANONYMOUS_CART_COOKIE)
+
+
+def load_cart(user):
+    if not user.is_authenticated:
+        return None
+    return (
+        Order.objects
+        .filter(user = user, ordered = False)
+        .select_related("coupon", "billing_address", "shipping_address")
+        .prefetch_related(
+            Prefetch("items", queryset = OrderItem.objects.select_related("item"))
+        )
+        .first()
+    )
+
+def get_cart(request):
+    if not hasattr(request, "_cached_cart"):
+        if request.user.is_authenticated:
+            request._cached_cart = load_cart(request.user)
+        else:
+            request._cached_cart = SessionCart.from_request(request)
+    return request._cached_cart
+
+def save_anonymous_cart(request, response):
+    if getattr(request, "_merged_anonymous_cart", False):
+        response.delete_cookie(ANONYMOUS_CART_COOKIE)
+        return
+    session_cart = request.__dict__.get("_cached_cart")
+    if isinstance(session_cart, SessionCart) and session_cart.modified:
+        session_cart.save(response)
+
+def set_cart(request, order):
+    request._cached_cart = order
+    request.cart = SimpleLazyObject(lambda: get_cart(request))
+
+def get_cart_item(order, item):
+    # reads the prefetched order items, no query
+    for order_item in order.items.all():
+        if order_item.item_id == item.pk:
+            return order_item
+    return None
+
+def get_or_create_open_order(user):
+    try:
+        with transaction.atomic():
+            return Order.objects.create(user = user, ordered_date = timezone.now()), True
+    except IntegrityError:
+        # another request opened the cart in the meantime
+        return Order.objects.get(user = user, ordered = False), False
+
+def _open_lines(user, item):
+    return OrderItem.objects.filter(user = user, item = item, ordered = False)
+
+def _change_quantity(user, item, quantity, condition = None):
+    lines = _open_lines(user, item)
+    if condition:
+        lines = lines.filter(**condition)
+    return lines.update(
+        quantity   = F("quantity") + quantity,
+        line_total = F("line_total") + quantity * item.get_final_price()
+    )
+
+def unlocked(orders):
+    """`orders` without those a payment job is charging."""
+    return orders.exclude(paymentjob__status__in = PaymentJob.IN_FLIGHT)
+
+def _change_totals(order, item, quantity):
+    price   = item.price
+    final   = item.get_final_price()
+    changed = unlocked(Order.objects.filter(pk = order.pk)).update(
+        subtotal       = F("subtotal") + quantity * price,
+        discount_total = F("discount_total") + quantity * (price - final),
+        total          = order_total_expression(F("subtotal") - F("discount_total") - F("coupon_amount")
+                                                + quantity * final)
+    )
+    if not changed:
+        raise CartLocked("Your order is being paid, it can't change until the payment is done.")
+
+def _delete_line(order, item, user):
+    line = _open_lines(user, item).select_for_update().first()
+    if line is None:
+        return False
+    # the order totals are adjusted below, skip the recomputing receivers
+    line._skip_order_totals = True
+    line.delete()
+    _change_totals(order, item, -line.quantity)
+    return True
+
+def add_item(user, item, order = None, quantity = 1):
+    """Add `quantity` units of `item` to the user's open order."""
+    in_cart = get_cart_item(order, item) is not None if order else None
+    with transaction.atomic():
+        if not order:
+            order, created = get_or_create_open_order(user)
+            in_cart        = False if created else None
+
+        status = None
+        if in_cart is not False and _change_quantity(user, item, quantity):
+            status = UPDATED
+        if status is None:
+            try:
+                with transaction.atomic():
+                    line = OrderItem.objects.create(user = user, item = item, quantity = quantity)
+            except IntegrityError:
+                # the line was created concurrently
+                _change_quantity(user, item, quantity)
+                status = UPDATED
+            else:
+                Order.items.through.objects.create(order_id = order.pk, orderitem_id = line.pk)
+                status = ADDED
+
+        _change_totals(order, item, quantity)
+    return status
+
+def remove_single_item(user, item, order):
+    """Take one unit of `item` out of the cart, dropping the line at zero."""
+    with transaction.atomic():
+        if _change_quantity(user, item, -1, condition = { "quantity__gt": 1 }):
+            _change_totals(order, item, -1)
+            return UPDATED
+        if _delete_line(order, item, user):
+            return REMOVED
+    return NOT_IN_CART
+
+def remove_item(user, item, order):
+    """Drop the whole `item` line from the cart."""
+    with transaction.atomic():
+        if _delete_line(order, item, user):
+            return REMOVED
+    return NOT_IN_CART
+
+def merge_anonymous_cart(request, user):
+    """Move the cookie cart into the user's open order, in one transaction."""
+    session_cart = SessionCart.from_request(request)
+    if session_cart:
+        items = Item.objects.in_bulk(list(session_cart.quantities))
+        try:
+            with transaction.atomic():
+                order = load_cart(user)
+                for pk, quantity in session_cart.quantities.items():
+                    if pk in items:
+                        add_item(user, items[pk], order = order, quantity = quantity)
+                        # the first line opens the order, later lines reuse it
+                        order = order or Order.objects.get(user = user, ordered = False)
+            request._merged_anonymous_cart = True
+        except CartLocked:
+            # the cookie cart is kept, it is merged on a later login
+            pass
+    # request.cart was the anonymous cart until now
+    request.__dict__.pop("_cached_cart", None)
+    request.cart = SimpleLazyObject(lambda: get_cart(request))
@@ -0,0 +1,121 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
+
+from .routers import primary_reads
+
+VERSION_KEY = "catalog:version"
+BUMPED_KEY  = "catalog:bumped"
+
+_missing    = object()
+_stats      = {"hits": 0, "misses": 0}
+_stats_lock = threading.Lock()
+
+
+def get_cache():
+    return caches[getattr(settings, "CATALOG_CACHE", "default")]
+
+def get_version_cache():
+    # every process must see a bump, the values themselves may stay local
+    return caches[getattr(settings, "CATALOG_VERSION_CACHE", "default")]
+
+def _new_version():
+    # a fresh version never collides with one used before the key was evicted
+    return int(time.time() * 1000)
+
+def get_catalog_version():
+    cache   = get_version_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, _new_version(), timeout = None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+def bump_catalog_version():
+    cache = get_version_cache()
+    cache.set(BUMPED_KEY, time.time(), timeout = None)
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        version = _new_version()
+        cache.set(VERSION_KEY, version, timeout = None)
+        return version
+
+def replicas_caught_up():
+    """Whether the replicas hold the last catalog change, they lag less than REPLICA_PIN_SECONDS."""
+    bumped = get_version_cache().get(BUMPED_KEY)
+    return bumped is None or time.time() - bumped >= getattr(settings, "REPLICA_PIN_SECONDS", 5)
+
+def _record(stat):
+    with _stats_lock:
+        _stats[stat] += 1
+
+def catalog_cache_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+def reset_catalog_cache_stats():
+    with _stats_lock:
+        _stats.update(hits = 0, misses = 0)
+
+def cached_catalog_value(name, compute):
+    """Return the value cached under `name` for the current catalog version."""
+    cache = get_cache()
+    key   = f"catalog:{get_catalog_version()}:{name}"
+    value = cache.get(key, _missing)
+    if value is _missing:
+        _record("misses")
+        if replicas_caught_up():
+            value = compute()
+        else:
+            # a lagging replica would store the previous version's rows under this key
+            with primary_reads():
+                value = compute()
+        cache.set(key, value, getattr(settings, "CATALOG_CACHE_TIMEOUT", 60 * 15))
+    else:
+        _record("hits")
+    return value
+
+
+class CatalogPaginator(Paginator):
+    """Paginator whose count and page contents are cached per catalog version."""
+
+    def __init__(self, object_list, per_page, cache_key = "catalog", **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.cache_key = cache_key
+
+    @cached_property
+    def count(self):
+        return cached_catalog_value(f"{self.cache_key}:count", self.object_list.count)
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        top    = bottom + self.per_page
+        if top + self.orphans >= self.count:
+            top = self.count
+        object_list = cached_catalog_value(
+            f"{self.cache_key}:page:{self.per_page}:{number}",
+            lambda: list(self.object_list[bottom:top])
+        )
+        return self._get_page(object_list, number, self)
+
+
+def get_facet_counts():
+    """(category, label, count) rows for the whole catalog, one grouped query per version."""
+    from django.db.models import Count
+    from .models import Item
+
+    return cached_catalog_value(
+        "facets",
+        lambda: list(Item.objects.order_by().values_list("category", "label").annotate(count = Count("id")))
+    )
+
+
+def catalog_changed_receiver(sender, *args, **kwargs):
+    if not kwargs.get("raw"):
+        bump_catalog_version()
@@ -0,0 +1,87 @@
+from django.db import transaction
+
+from .models import Address
+
+SHIPPING = "S"
+BILLING  = "B"
+
+
+class CheckoutError(Exception):
+    """The checkout form can't be completed, the message is shown to the customer."""
+
+
+def get_default_addresses(user):
+    """{address_type: Address} of the user's default addresses, in one query."""
+    return {address.address_type: address
+            for address in Address.objects.filter(user = user, default = True)}
+
+def new_address(user, data, prefix, address_type):
+    street      = data.get(f"{prefix}_address_1")
+    country     = data.get(f"{prefix}_country")
+    postal_code = data.get(f"{prefix}_postal_code")
+    if not (street and country and postal_code):
+        raise CheckoutError(f"Please fill in the required {prefix} address field.")
+    return Address(
+        user              = user,
+        street_address    = street,
+        apartment_address = data.get(f"{prefix}_address_2") or "",
+        country           = country,
+        postal_code       = postal_code,
+        address_type      = address_type,
+        default           = bool(data.get(f"set_default_{prefix}"))
+    )
+
+def save_checkout(order, user, data):
+    """
+    Resolve the shipping and billing addresses of the cleaned checkout form
+    and store them on `order`. Everything is validated before the first
+    write, which then take a fixed number of queries in one transaction.
+    """
+    defaults = {}
+    if data.get("use_default_shipping") or data.get("use_default_billing"):
+        defaults = get_default_addresses(user)
+    new = []
+
+    if data.get("use_default_shipping"):
+        shipping = defaults.get(SHIPPING)
+        if shipping is None:
+            raise CheckoutError("No default shipping address available.")
+    else:
+        shipping = new_address(user, data, "shipping", SHIPPING)
+        new.append(shipping)
+
+    if data.get("same_billing_address"):
+        billing = Address(
+            user              = user,
+            street_address    = shipping.street_address,
+            apartment_address = shipping.apartment_address,
+            country           = shipping.country,
+            postal_code       = shipping.postal_code,
+            address_type      = BILLING
+        )
+        new.append(billing)
+    elif data.get("use_default_billing"):
+        billing = defaults.get(BILLING)
+        if billing is None:
+            raise CheckoutError("No default billing address available.")
+    else:
+        billing = new_address(user, data, "billing", BILLING)
+        new.append(billing)
+
+    with transaction.atomic():
+        replaced = [address.address_type for address in new if address.default]
+        if replaced:
+            # a single default address per type
+            Address.objects.filter(user = user, address_type__in = replaced, default = True).update(default = False)
+        if new:
+            Address.objects.bulk_create(new)
+            if new[0].pk is None:
+                # the backend returns no pks from bulk inserts (SQLite), the
+                # rows just inserted are the user's latest
+                pks = Address.objects.filter(user = user).order_by("-pk").values_list("pk", flat = True)
+                for address, pk in zip(new, reversed(pks[:len(new)])):
+                    address.pk = pk
+        order.shipping_address = shipping
+        order.billing_address  = billing
+        order.save(update_fields = ["shipping_address", "billing_address"])
+    return order
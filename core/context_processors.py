@@ -0,0 +1,2 @@
+def cart(request):
+    return {"cart": getattr(request, "cart", None)}
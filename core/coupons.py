@@ -0,0 +1,154 @@
+import threading
+import time
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .catalog import get_version_cache
+
+VERSION_KEY = "coupons:version"
+
+_table      = {"version": None, "coupons": {}}
+_table_lock = threading.Lock()
+
+
+class CouponError(Exception):
+    """The coupon can't be applied, the message is shown to the customer."""
+
+
+def get_coupon_version():
+    cache   = get_version_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, int(time.time() * 1000), timeout = None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+def bump_coupon_version():
+    cache = get_version_cache()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, int(time.time() * 1000), timeout = None)
+
+def get_coupon_table():
+    """
+    {code: Coupon} of the coupons that can still be used, kept in process and
+    reloaded once any process bumps the version in CATALOG_VERSION_CACHE,
+    which production shares between workers. Usage counters are never read
+    from here, they only change through atomic updates.
+    """
+    from .models import Coupon
+
+    version = get_coupon_version()
+    if _table["version"] != version:
+        with _table_lock:
+            if _table["version"] != version:
+                coupons = Coupon.objects.filter(active = True).exclude(valid_until__lt = timezone.now())
+                _table["coupons"] = {coupon.code: coupon for coupon in coupons}
+                _table["version"] = version
+    return _table["coupons"]
+
+def validate_coupon(coupon, order, now = None):
+    """Validity window and minimum basket, checked in memory."""
+    now = now or timezone.now()
+    if coupon.valid_from and now < coupon.valid_from:
+        raise CouponError("This coupon is not valid yet.")
+    if coupon.valid_until and now > coupon.valid_until:
+        raise CouponError("This coupon has expired.")
+    basket = order.subtotal - order.discount_total
+    if basket < coupon.min_basket:
+        raise CouponError(f"This coupon needs a basket of at least {coupon.min_basket} €.")
+
+def check_available(coupon, user):
+    """Raise when the caps are reached already, the counters themselves only move on payment."""
+    from .models import Coupon, CouponRedemption
+
+    if coupon.max_uses is not None and not Coupon.objects.filter(pk = coupon.pk, uses__lt = F("max_uses")).exists():
+        raise CouponError("This coupon has been used up.")
+    if coupon.max_uses_per_user is not None and CouponRedemption.objects.filter(
+            coupon_id = coupon.pk, user = user, uses__gte = coupon.max_uses_per_user).exists():
+        raise CouponError("You have already used this coupon.")
+
+def _redeem(coupon, user):
+    from .models import Coupon, CouponRedemption
+
+    # the conditional updates hold under any concurrency, a capped code is
+    # never handed out more than max_uses times
+    coupons = Coupon.objects.filter(pk = coupon.pk)
+    if coupon.max_uses is not None:
+        coupons = coupons.filter(uses__lt = F("max_uses"))
+    if not coupons.update(uses = F("uses") + 1):
+        raise CouponError("This coupon has been used up.")
+
+    # the user's row only exists from their first redemption on
+    redemptions = CouponRedemption.objects.filter(coupon_id = coupon.pk, user = user)
+    if coupon.max_uses_per_user is not None:
+        redemptions = redemptions.filter(uses__lt = coupon.max_uses_per_user)
+    if redemptions.update(uses = F("uses") + 1):
+        return
+    if coupon.max_uses_per_user != 0:
+        try:
+            with transaction.atomic():
+                CouponRedemption.objects.create(coupon_id = coupon.pk, user = user, uses = 1)
+            return
+        except IntegrityError:
+            # the row exists, or another request of the same user created it meanwhile
+            if redemptions.update(uses = F("uses") + 1):
+                return
+    raise CouponError("You have already used this coupon.")
+
+def release_coupon(coupon_id, user):
+    """Give back a redemption whose payment failed."""
+    from .models import Coupon, CouponRedemption
+
+    Coupon.objects.filter(pk = coupon_id, uses__gt = 0).update(uses = F("uses") - 1)
+    CouponRedemption.objects.filter(coupon_id = coupon_id, user = user, uses__gt = 0).update(uses = F("uses") - 1)
+
+def redeem_coupon(order, user):
+    """
+    Count the coupon of `order` against its caps, when the customer pays.
+    The coupon is validated again, the basket may have changed since it was
+    applied. Run it in the transaction that queues the payment.
+    """
+    coupon = get_coupon_table().get(order.coupon.code)
+    if coupon is None:
+        raise CouponError("This coupon is no longer valid.")
+    validate_coupon(coupon, order)
+    _redeem(coupon, user)
+
+def apply_coupon(order, user, code):
+    """
+    Put `code` on the open `order`. Nothing is counted yet, carts that are
+    never paid don't use up a capped coupon; see redeem_coupon().
+    """
+    coupon = get_coupon_table().get(code.strip())
+    if coupon is None:
+        raise CouponError("This coupon does not exist.")
+    if order.coupon_id == coupon.pk:
+        raise CouponError("This coupon is already applied.")
+    validate_coupon(coupon, order)
+    check_available(coupon, user)
+    _set_coupon(order, coupon)
+    return coupon
+
+def _set_coupon(order, coupon):
+    from .cart import unlocked
+    from .models import Order, order_total_expression
+
+    # no row matches while a payment job charges the order's total
+    changed = unlocked(Order.objects.filter(pk = order.pk)).update(
+        coupon        = coupon,
+        coupon_amount = coupon.amount,
+        total         = order_total_expression(F("subtotal") - F("discount_total") - coupon.amount)
+    )
+    if not changed:
+        raise CouponError("Your order is being paid, it can't change until the payment is done.")
+    order.coupon            = coupon
+    order._loaded_coupon_id = coupon.pk
+    order.apply_coupon_amount()
+
+def coupon_table_receiver(sender, *args, **kwargs):
+    if not kwargs.get("raw"):
+        bump_coupon_version()
@@ -0,0 +1,88 @@
+import logging
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# derivative name -> maximum width in pixels, the aspect ratio is kept
+DERIVATIVE_WIDTHS = {
+    "card":   400,
+    "detail": 1000,
+}
+# extension -> Pillow format and save options
+DERIVATIVE_FORMATS = {
+    "webp": ("WEBP", {"quality": 80, "method": 4}),
+    "jpg":  ("JPEG", {"quality": 85, "optimize": True, "progressive": True}),
+}
+
+
+def derivative_name(name, size, extension):
+    """`shirt.png` -> `shirt.png.card.webp`, stored next to the original."""
+    return f"{name}.{size}.{extension}"
+
+def derivative_names(name):
+    return [derivative_name(name, size, extension)
+            for size in DERIVATIVE_WIDTHS for extension in DERIVATIVE_FORMATS]
+
+def generate_derivatives(name, storage = None):
+    """Write every size and format of the image `name`, return the stored names."""
+    from PIL import Image, ImageOps
+
+    storage = storage or default_storage
+    with storage.open(name, "rb") as original:
+        image = Image.open(original)
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGB")
+
+    stored = []
+    for size, width in DERIVATIVE_WIDTHS.items():
+        resized = image.copy()
+        # never upscale, the height bound only keeps the ratio
+        resized.thumbnail((width, width * 4), Image.LANCZOS)
+        for extension, (image_format, options) in DERIVATIVE_FORMATS.items():
+            buffer = BytesIO()
+            resized.save(buffer, image_format, **options)
+            target = derivative_name(name, size, extension)
+            # storage.save renames on collision, replace the old file instead
+            if storage.exists(target):
+                storage.delete(target)
+            stored.append(storage.save(target, ContentFile(buffer.getvalue())))
+    return stored
+
+def delete_derivatives(name, storage = None):
+    storage = storage or default_storage
+    for target in derivative_names(name):
+        if storage.exists(target):
+            storage.delete(target)
+
+def delete_unused_derivatives(sender, instance, name):
+    """Delete the derivatives of `name` unless another item still shows that image."""
+    if name and not sender.objects.filter(image_derivatives = name).exclude(pk = instance.pk).exists():
+        delete_derivatives(name, instance.image.storage)
+
+def item_image_receiver(sender, instance, raw = False, *args, **kwargs):
+    name = instance.image.name
+    if raw or name == instance.image_derivatives:
+        return
+    if instance.image_derivatives:
+        # the image was replaced or cleared
+        delete_unused_derivatives(sender, instance, instance.image_derivatives)
+        instance.image_derivatives = ""
+        sender.objects.filter(pk = instance.pk).update(image_derivatives = "")
+    if not name or not instance.image.storage.exists(name):
+        return
+    try:
+        generate_derivatives(name, instance.image.storage)
+    except OSError:
+        logger.warning("Could not generate the derivatives of %s", name, exc_info = True)
+        return
+    # the card fragments are keyed on updated_at
+    instance.image_derivatives = name
+    instance.updated_at        = timezone.now()
+    sender.objects.filter(pk = instance.pk).update(image_derivatives = name, updated_at = instance.updated_at)
+
+def item_image_delete_receiver(sender, instance, *args, **kwargs):
+    delete_unused_derivatives(sender, instance, instance.image_derivatives)
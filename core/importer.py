@@ -0,0 +1,254 @@
+import csv
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from urllib.parse import urlparse
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.text import slugify
+
+from .catalog import bump_catalog_version
+from .models import CATEGORY_CHOICES, LABEL_CHOICES, Item, reprice_open_order_items
+from .search import get_search_backend
+
+IMPORT_FIELDS = ["title", "price", "discount_price", "category", "label", "description", "image"]
+SLUG_LENGTH   = Item._meta.get_field("slug").max_length
+IMAGE_PREFIX  = "items/"
+
+
+class RowError(ValueError):
+    pass
+
+
+def read_rows(path, format = None):
+    """Yield one dict per CSV or JSONL row, the file is never read as a whole."""
+    format = format or os.path.splitext(path)[1].lstrip(".").lower()
+    with open(path, newline = "", encoding = "utf-8") as f:
+        if format == "csv":
+            yield from csv.DictReader(f)
+        elif format in ("jsonl", "ndjson"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise ValueError(f"Unsupported catalog format {format!r}")
+
+def batched(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+def _choice(value, choices, field):
+    value = (value or "").strip()
+    for code, name in choices:
+        if value.lower() in (code.lower(), name.lower()):
+            return code
+    raise RowError(f"unknown {field} {value!r}")
+
+def _decimal(value, field, required = True):
+    if value in (None, ""):
+        if required:
+            raise RowError(f"missing {field}")
+        return None
+    try:
+        return Decimal(str(value)).quantize(Decimal("0.01"))
+    except InvalidOperation:
+        raise RowError(f"invalid {field} {value!r}")
+
+def clean_row(row):
+    title = (row.get("title") or "").strip()
+    if not title:
+        raise RowError("missing title")
+    return {
+        "title":          title[:120],
+        "price":          _decimal(row.get("price"), "price"),
+        "discount_price": _decimal(row.get("discount_price"), "discount_price", required = False),
+        "category":       _choice(row.get("category"), CATEGORY_CHOICES, "category"),
+        "label":          _choice(row.get("label"), LABEL_CHOICES, "label"),
+        "description":    row.get("description") or "",
+        "image":          (row.get("image") or "").strip(),
+    }
+
+
+class SlugAllocator:
+    """
+    Unique slugs without a query per row. Explicit slugs and the first
+    occurrence of a title map onto the existing item (upsert), repeated
+    titles in the same import get a numbered suffix.
+    """
+
+    def __init__(self):
+        self.used = set()
+
+    def allocate(self, row, title):
+        explicit = slugify(row.get("slug") or "")[:SLUG_LENGTH]
+        if explicit:
+            self.used.add(explicit)
+            return explicit
+
+        base = slugify(title)[:SLUG_LENGTH] or "item"
+        slug = base
+        n    = 1
+        while slug in self.used:
+            n      += 1
+            suffix  = f"-{n}"
+            slug    = base[:SLUG_LENGTH - len(suffix)] + suffix
+        self.used.add(slug)
+        return slug
+
+
+def _digest(data):
+    return hashlib.md5(data).hexdigest()[:12]
+
+def resolve_image(value, slug, image_dir = None, storage = None):
+    """
+    Storage name for the image column. URLs are downloaded and local files
+    copied under items/ once, anything else is linked as an existing name.
+    The names carry a hash of the URL or of the file, so a changed image is
+    stored again rather than matched with the old one.
+    """
+    storage = storage or default_storage
+    if not value:
+        return ""
+
+    parsed = urlparse(value)
+    if parsed.scheme in ("http", "https"):
+        extension = os.path.splitext(parsed.path)[1].lower() or ".jpg"
+        name      = f"{IMAGE_PREFIX}{slug}-{_digest(value.encode())}{extension}"
+        if not storage.exists(name):
+            import requests
+
+            response = requests.get(value, timeout = 30)
+            response.raise_for_status()
+            name = storage.save(name, ContentFile(response.content))
+        return name
+
+    path = os.path.join(image_dir, value) if image_dir else value
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            content = f.read()
+        root, extension = os.path.splitext(os.path.basename(path))
+        name = f"{IMAGE_PREFIX}{root}-{_digest(content)}{extension}"
+        if not storage.exists(name):
+            name = storage.save(name, ContentFile(content))
+        return name
+    return value
+
+
+class CatalogImporter:
+    """Streams rows into Item with batched bulk_create / bulk_update keyed on slug."""
+
+    def __init__(self, batch_size = 500, image_dir = None, image_workers = 8,
+                 on_progress = None, on_error = None):
+        self.batch_size    = batch_size
+        self.image_dir     = image_dir
+        self.image_workers = image_workers
+        self.on_progress   = on_progress
+        self.on_error      = on_error
+        self.stats         = {"rows": 0, "created": 0, "updated": 0, "unchanged": 0, "skipped": 0}
+
+    def load_existing(self):
+        # slug -> pk is the only per-item state kept in memory
+        return dict(Item.objects.order_by("id").values_list("slug", "id").iterator(chunk_size = 10000))
+
+    def run(self, rows):
+        started  = time.monotonic()
+        existing = self.load_existing()
+        slugs    = SlugAllocator()
+        backend  = get_search_backend()
+
+        with ThreadPoolExecutor(max_workers = self.image_workers) as pool:
+            for number, batch in enumerate(batched(rows, self.batch_size)):
+                pending = {}
+                for offset, row in enumerate(batch, start = number * self.batch_size + 1):
+                    self.stats["rows"] += 1
+                    try:
+                        values = clean_row(row)
+                    except RowError as e:
+                        self.stats["skipped"] += 1
+                        if self.on_error:
+                            self.on_error(offset, str(e))
+                        continue
+                    # a later row with the same slug wins
+                    pending[slugs.allocate(row, values["title"])] = values
+
+                images = pool.map(
+                    lambda args: self._image(*args),
+                    [(slug, values["image"]) for slug, values in pending.items()]
+                )
+                for (slug, values), image in zip(list(pending.items()), images):
+                    if image is None:
+                        self.stats["skipped"] += 1
+                        del pending[slug]
+                    else:
+                        values["image"] = image
+
+                self.write(pending, existing, backend)
+                if self.on_progress:
+                    self.on_progress(self.stats, time.monotonic() - started)
+
+        bump_catalog_version()
+        return self.stats
+
+    def _image(self, slug, value):
+        try:
+            return resolve_image(value, slug, self.image_dir)
+        except Exception as e:
+            if self.on_error:
+                self.on_error(slug, f"image {value!r}: {e}")
+            return None
+
+    def write(self, pending, existing, backend):
+        to_create = [Item(slug = slug, **values) for slug, values in pending.items() if slug not in existing]
+        # unchanged rows are neither rewritten nor reindexed
+        current   = {
+            row.pop("slug"): row
+            for row in Item.objects.filter(pk__in = [existing[slug] for slug in pending if slug in existing])
+                                   .values("slug", *IMPORT_FIELDS)
+        }
+        to_update = []
+        repriced  = []
+        now       = timezone.now()
+        for slug, row in current.items():
+            values = pending[slug]
+            # rows without an image keep the one already linked
+            values["image"] = values["image"] or row["image"]
+            if row != values:
+                item = Item(pk = existing[slug], slug = slug, updated_at = now, **values)
+                to_update.append(item)
+                if (row["price"], row["discount_price"]) != (item.price, item.discount_price):
+                    repriced.append(item)
+
+        changed = [item.slug for item in to_create + to_update]
+        with transaction.atomic():
+            if to_create:
+                Item.objects.bulk_create(to_create, batch_size = self._batch_size(["slug"] + IMPORT_FIELDS, to_create))
+            if to_update:
+                # bulk_update skips auto_now, updated_at is set above
+                fields = IMPORT_FIELDS + ["updated_at"]
+                Item.objects.bulk_update(to_update, fields, batch_size = self._batch_size(fields, to_update))
+            if changed:
+                # one query gives the new pks and the rows to index
+                indexed = list(Item.objects.filter(slug__in = changed).only("id", "slug", "title", "description"))
+                backend.index(indexed)
+                existing.update((item.slug, item.pk) for item in indexed)
+            if repriced:
+                reprice_open_order_items(repriced)
+
+        self.stats["created"]   += len(to_create)
+        self.stats["updated"]   += len(to_update)
+        self.stats["unchanged"] += len(current) - len(to_update)
+
+    def _batch_size(self, fields, objs):
+        fields = [Item._meta.get_field(name) for name in fields]
+        return min(self.batch_size, connection.ops.bulk_batch_size(fields, objs) or self.batch_size)
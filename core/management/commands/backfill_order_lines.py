@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from core.reporting import backfill_order_lines
+
+
+class Command(BaseCommand):
+    help = 'Snapshots the lines of paid orders placed before OrderLine existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Orders snapshotted per transaction')
+
+    def handle(self, *args, **options):
+        stats = backfill_order_lines(options['chunk_size'], on_progress=self.progress)
+        self.stdout.write(self.style.SUCCESS('Snapshotted %(lines)d lines of %(orders)d orders' % stats))
+
+    def progress(self, stats):
+        self.stdout.write('%(orders)d orders, %(lines)d lines' % stats)
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.benchmark import seed_items, time_view
+from core.models import Item
+from core.views import HomeView
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compares OFFSET and keyset pagination latency of the home listing at increasing depth'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=20000,
+                            help='Synthetic items to seed (rolled back unless --keep)')
+        parser.add_argument('--pages', type=int, nargs='+', default=[1, 10, 100, 1000],
+                            help='Page numbers to measure')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the seeded items')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                if not options['keep']:
+                    raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, options):
+        per_page = HomeView.paginate_by
+        needed = max(options['pages']) * per_page - Item.objects.count()
+        if needed > 0:
+            seed_items(max(needed, options['items'] - Item.objects.count()))
+        view = HomeView.as_view()
+        ids = Item.objects.order_by('-id').values_list('id', flat=True)
+
+        self.stdout.write('%8s %12s %12s' % ('page', 'offset ms', 'keyset ms'))
+        for page in options['pages']:
+            offset_ms = time_view(view, f'/?page={page}', options['repeat'])
+            after = ids[(page - 1) * per_page - 1] if page > 1 else ''
+            keyset_ms = time_view(view, f'/?after={after}', options['repeat'])
+            self.stdout.write('%8d %12.2f %12.2f' % (page, offset_ms, keyset_ms))
@@ -0,0 +1,80 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db.models import F, Sum, Value
+from django.db.models.functions import Coalesce
+
+from core.models import (
+    Order,
+    OrderItem,
+    order_item_line_total_expression,
+    order_item_subtotal_expression
+)
+
+
+class Command(BaseCommand):
+    help = 'Detects (and optionally repairs) stored order totals that have drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true',
+                            help='Recompute the drifted totals of open carts')
+        parser.add_argument('--all', action='store_true',
+                            help='Also report paid orders whose total differs from the amount charged')
+
+    def handle(self, *args, **options):
+        fix = options['fix']
+        # paid orders keep what the customer was charged, live prices only apply to carts
+        order_items = OrderItem.objects.filter(ordered=False)
+        orders = Order.objects.filter(ordered=False)
+
+        drifted_items = [
+            order_item.pk for order_item in order_items
+            .annotate(expected=order_item_line_total_expression())
+            .exclude(line_total=F('expected'))
+            .only('pk')
+            .iterator()
+        ]
+        if fix:
+            for order_item in OrderItem.objects.filter(pk__in=drifted_items).select_related('item'):
+                # OrderItem.save only recomputes the line total when the quantity is saved
+                order_item.line_total = order_item.get_final_price()
+                order_item.save(update_fields=['line_total'])
+
+        zero = Value(Decimal('0.00'))
+        expected = orders.annotate(
+            expected_subtotal=Coalesce(Sum(order_item_subtotal_expression('items__')), zero),
+            expected_lines=Coalesce(Sum(order_item_line_total_expression('items__')), zero),
+            expected_coupon=Coalesce(F('coupon__amount'), zero),
+        ).values_list('pk', 'subtotal', 'discount_total', 'coupon_amount', 'total',
+                      'expected_subtotal', 'expected_lines', 'expected_coupon')
+
+        drifted_orders = []
+        for pk, subtotal, discount, coupon, total, exp_subtotal, exp_lines, exp_coupon in expected.iterator():
+            stored = (subtotal, discount, coupon, total)
+            wanted = (exp_subtotal, exp_subtotal - exp_lines, exp_coupon, max(exp_lines - exp_coupon, Decimal('0.00')))
+            if stored != wanted:
+                drifted_orders.append(pk)
+                self.stdout.write(f'Order {pk}: stored {stored}, expected {wanted}')
+
+        if fix:
+            for order in Order.objects.filter(pk__in=drifted_orders).select_related('coupon'):
+                order.update_totals()
+
+        verb = 'Repaired' if fix else 'Found'
+        style = self.style.SUCCESS if fix or not (drifted_items or drifted_orders) else self.style.WARNING
+        self.stdout.write(style(
+            f'{verb} {len(drifted_items)} order item(s) and {len(drifted_orders)} order(s) with drifted totals'))
+
+        if options['all']:
+            self.check_paid_orders()
+
+    def check_paid_orders(self):
+        mismatched = Order.objects.filter(ordered=True, payment__isnull=False) \
+            .exclude(total=F('payment__amount')) \
+            .values_list('pk', 'total', 'payment__amount')
+        count = 0
+        for pk, total, amount in mismatched.iterator():
+            count += 1
+            self.stdout.write(f'Paid order {pk}: total {total}, charged {amount}')
+        style = self.style.WARNING if count else self.style.SUCCESS
+        self.stdout.write(style(f'Found {count} paid order(s) whose total differs from the charge, not repaired'))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.benchmark import explain, hot_queries
+
+
+class Command(BaseCommand):
+    help = 'Shows the query plan of the hot lookups and fails when one of them scans a whole table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--plans', action='store_true',
+                            help='Print the full plans')
+
+    def handle(self, *args, **options):
+        scans = []
+        for name, queryset in hot_queries().items():
+            indexed, plan = explain(queryset)
+            if indexed:
+                self.stdout.write(self.style.SUCCESS('%-20s index' % name))
+            else:
+                scans.append(name)
+                self.stdout.write(self.style.ERROR('%-20s full scan' % name))
+            if options['plans'] or not indexed:
+                self.stdout.write('    ' + plan.replace('\n', '\n    '))
+        if scans:
+            raise CommandError('%d hot queries scan a whole table' % len(scans))
@@ -0,0 +1,60 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import F
+from django.utils import timezone
+
+from core.catalog import bump_catalog_version
+from core.images import generate_derivatives
+from core.models import Item
+
+
+def render(name):
+    try:
+        generate_derivatives(name)
+    except OSError as e:
+        return name, str(e)
+    return name, None
+
+
+class Command(BaseCommand):
+    help = 'Generates the thumbnail and WebP derivatives of item images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of worker processes')
+        parser.add_argument('--all', action='store_true',
+                            help='Regenerate items whose derivatives are up to date')
+
+    def handle(self, *args, **options):
+        items = Item.objects.exclude(image='')
+        if not options['all']:
+            items = items.exclude(image_derivatives=F('image'))
+        names = set(items.values_list('image', flat=True))
+        if not names:
+            self.stdout.write('Nothing to generate')
+            return
+
+        started = time.monotonic()
+        done = []
+        # forked workers must not share the parent's database connections
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            futures = [executor.submit(render, name) for name in names]
+            for future in as_completed(futures):
+                name, error = future.result()
+                if error:
+                    self.stderr.write('%s: %s' % (name, error))
+                else:
+                    done.append(name)
+
+        for name in done:
+            Item.objects.filter(image=name).update(image_derivatives=name, updated_at=timezone.now())
+        if done:
+            bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(
+            'Generated derivatives for %d of %d images in %.1fs' % (
+                len(done), len(names), time.monotonic() - started)))
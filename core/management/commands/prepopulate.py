@@ -0,0 +1,68 @@
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.importer import CatalogImporter, read_rows
+from core.models import CATEGORY_CHOICES, LABEL_CHOICES
+
+
+def demo_rows(count, seed=0):
+    rng = random.Random(seed)
+    for n in range(1, count + 1):
+        yield {
+            'title': 'Demo item %d' % n,
+            'price': '%.2f' % (rng.randint(500, 10000) / 100),
+            'discount_price': rng.choice(['', '%.2f' % (rng.randint(100, 500) / 100)]),
+            'category': rng.choice(CATEGORY_CHOICES)[0],
+            'label': rng.choice(LABEL_CHOICES)[0],
+            'description': 'Demo description %d' % n,
+            'image': '',
+        }
+
+
+class Command(BaseCommand):
+    help = ('Streams a CSV or JSONL catalog into Item, upserting on slug. '
+            'Without a file a demo catalog is loaded. Run generate_image_derivatives afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?',
+                            help='CSV or JSONL file with title, price, discount_price, category, '
+                                 'label, description, image and optionally slug columns')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='File format, guessed from the extension by default')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Rows written per bulk statement')
+        parser.add_argument('--image-dir',
+                            help='Directory local image paths are relative to')
+        parser.add_argument('--image-workers', type=int, default=8,
+                            help='Concurrent image downloads')
+        parser.add_argument('--demo-items', type=int, default=50,
+                            help='Demo items loaded when no file is given')
+
+    def handle(self, *args, **options):
+        if options['path']:
+            rows = read_rows(options['path'], options['format'])
+        else:
+            rows = demo_rows(options['demo_items'])
+
+        importer = CatalogImporter(
+            batch_size=options['batch_size'],
+            image_dir=options['image_dir'],
+            image_workers=options['image_workers'],
+            on_progress=self.progress,
+            on_error=self.error,
+        )
+        try:
+            stats = importer.run(rows)
+        except (OSError, ValueError) as e:
+            raise CommandError(e)
+        self.stdout.write(self.style.SUCCESS(
+            'Imported %(rows)d rows: %(created)d created, %(updated)d updated, '
+            '%(unchanged)d unchanged, %(skipped)d skipped' % stats))
+
+    def progress(self, stats, elapsed):
+        self.stdout.write('%d rows, %d created, %d updated, %.0f rows/s' % (
+            stats['rows'], stats['created'], stats['updated'], stats['rows'] / max(elapsed, 1e-6)))
+
+    def error(self, row, message):
+        self.stderr.write('Row %s: %s' % (row, message))
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.payments import claim_next_job, run_job
+
+
+class Command(BaseCommand):
+    help = 'Charges queued payments and finalizes their orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty')
+        parser.add_argument('--sleep', type=float, default=1.0,
+                            help='Seconds to wait when the queue is empty')
+
+    def handle(self, *args, **options):
+        processed = 0
+        while True:
+            job = claim_next_job()
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+            run_job(job)
+            processed += 1
+            self.stdout.write('Processed payment job %s' % job.idempotency_key)
+        self.stdout.write(self.style.SUCCESS('Processed %d payment job(s)' % processed))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Order
+from core.refunds import process_refunds
+
+
+class Command(BaseCommand):
+    help = 'Issues the Stripe refunds of orders whose refund was requested'
+
+    def add_arguments(self, parser):
+        parser.add_argument('orders', nargs='*', type=int,
+                            help='Order ids, every requested refund by default')
+        parser.add_argument('--workers', type=int,
+                            help='Concurrent Stripe calls (REFUND_WORKERS)')
+        parser.add_argument('--rate', type=float,
+                            help='Stripe calls per second (REFUND_RATE_LIMIT)')
+
+    def handle(self, *args, **options):
+        orders = Order.objects.filter(ordered=True, refund_granted=False)
+        if options['orders']:
+            orders = orders.filter(pk__in=options['orders'])
+        else:
+            orders = orders.filter(refund_requested=True)
+        results = process_refunds(orders, workers=options['workers'], rate=options['rate'])
+        self.stdout.write(self.style.SUCCESS(
+            '%(succeeded)d orders refunded, %(failed)d failed' % results))
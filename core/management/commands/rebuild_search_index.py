@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the product full-text search index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of items indexed per statement')
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        started = time.monotonic()
+        with transaction.atomic():
+            total = backend.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            'Indexed %d items with %s in %.1fs' % (total, type(backend).__name__, time.monotonic() - started)))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from core.reporting import rebuild_sales_rollups, rollup_sales
+
+
+class Command(BaseCommand):
+    help = ('Adds the orders paid since the last run to the hourly and daily sales rollups. '
+            'Run it from cron, every few minutes')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Orders aggregated per transaction')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Drop the rollups and aggregate every paid order again')
+
+    def handle(self, *args, **options):
+        run = rebuild_sales_rollups if options['rebuild'] else rollup_sales
+        stats = run(options['chunk_size'], on_progress=self.progress)
+        self.stdout.write(self.style.SUCCESS('Rolled up %(orders)d orders, %(lines)d lines' % stats))
+
+    def progress(self, stats):
+        self.stdout.write('%(orders)d orders, %(lines)d lines' % stats)
@@ -0,0 +1,191 @@
+import heapq
+import logging
+import os
+import sys
+import sysconfig
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# seconds, the usual Prometheus defaults
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BACKGROUND      = "background"
+
+_current = ContextVar("request_metrics", default = None)
+
+# the project's virtualenv may live inside BASE_DIR
+LIBRARY_DIRS = tuple({os.path.join(sysconfig.get_paths()[name], "") for name in ("stdlib", "purelib", "platlib")})
+
+
+class RequestMetrics:
+    """Counters of the request being served, collected without locking."""
+
+    def __init__(self, slow_queries = 0):
+        self.queries        = 0
+        self.sql_seconds    = 0.0
+        self.stripe_calls   = 0
+        self.stripe_seconds = 0.0
+        self.slow_queries   = slow_queries
+        self.slowest        = []
+
+    def execute(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration          = time.perf_counter() - started
+            self.queries     += 1
+            self.sql_seconds += duration
+            if self.slow_queries:
+                entry = (duration, sql, call_site())
+                if len(self.slowest) < self.slow_queries:
+                    heapq.heappush(self.slowest, entry)
+                elif duration > self.slowest[0][0]:
+                    heapq.heapreplace(self.slowest, entry)
+
+
+def is_project_file(filename):
+    return (filename.startswith(settings.BASE_DIR) and filename != __file__
+            and not filename.startswith(LIBRARY_DIRS)
+            and f"{os.sep}site-packages{os.sep}" not in filename)
+
+def call_site():
+    """First frame outside Django and third party packages, as `path:line in function`."""
+    frame = sys._getframe(2)
+    while frame:
+        filename = frame.f_code.co_filename
+        if is_project_file(filename):
+            return "%s:%d in %s" % (os.path.relpath(filename, settings.BASE_DIR),
+                                    frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return "?"
+
+
+class Registry:
+    """In-process aggregates, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests       = defaultdict(int)
+            # route -> bucket counts, then +Inf, sum
+            self.latency        = defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1) + [0.0])
+            self.queries        = defaultdict(int)
+            self.sql_seconds    = defaultdict(float)
+            self.stripe_calls   = defaultdict(int)
+            self.stripe_seconds = defaultdict(float)
+
+    def observe_request(self, route, method, status, duration, state):
+        bucket = bisect_left(LATENCY_BUCKETS, duration)
+        with self.lock:
+            self.requests[(route, method, status)] += 1
+            histogram          = self.latency[route]
+            histogram[bucket] += 1
+            histogram[-1]     += duration
+            self.queries[route]        += state.queries
+            self.sql_seconds[route]    += state.sql_seconds
+            self.stripe_calls[route]   += state.stripe_calls
+            self.stripe_seconds[route] += state.stripe_seconds
+
+    def observe_stripe(self, route, duration):
+        with self.lock:
+            self.stripe_calls[route]   += 1
+            self.stripe_seconds[route] += duration
+
+    def render(self):
+        from .catalog import catalog_cache_stats
+
+        with self.lock:
+            lines = [
+                "# HELP http_requests_total Requests served, by route, method and status.",
+                "# TYPE http_requests_total counter",
+            ]
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append('http_requests_total{route="%s",method="%s",status="%s"} %d'
+                             % (route, method, status, count))
+
+            lines += [
+                "# HELP http_request_duration_seconds Request latency, by route.",
+                "# TYPE http_request_duration_seconds histogram",
+            ]
+            for route, histogram in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram):
+                    cumulative += count
+                    lines.append('http_request_duration_seconds_bucket{route="%s",le="%s"} %d'
+                                 % (route, bound, cumulative))
+                lines.append('http_request_duration_seconds_sum{route="%s"} %.6f' % (route, histogram[-1]))
+                lines.append('http_request_duration_seconds_count{route="%s"} %d' % (route, cumulative))
+
+            for name, help_text, kind, values, template in (
+                ("db_queries_total", "Database queries, by route.", "counter",
+                 self.queries, "%d"),
+                ("db_query_duration_seconds_total", "Time spent in the database, by route.", "counter",
+                 self.sql_seconds, "%.6f"),
+                ("stripe_requests_total", "Stripe API calls, by route.", "counter",
+                 self.stripe_calls, "%d"),
+                ("stripe_request_duration_seconds_total", "Time spent waiting on Stripe, by route.", "counter",
+                 self.stripe_seconds, "%.6f"),
+            ):
+                lines += ["# HELP %s %s" % (name, help_text), "# TYPE %s %s" % (name, kind)]
+                for route, value in sorted(values.items()):
+                    lines.append(('%s{route="%s"} ' + template) % (name, route, value))
+
+        stats = catalog_cache_stats()
+        lines += [
+            "# HELP catalog_cache_requests_total Catalog cache lookups, by result.",
+            "# TYPE catalog_cache_requests_total counter",
+            'catalog_cache_requests_total{result="hit"} %d' % stats["hits"],
+            'catalog_cache_requests_total{result="miss"} %d' % stats["misses"],
+        ]
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def current_request_metrics():
+    return _current.get()
+
+def start_request(slow_queries = 0):
+    state = RequestMetrics(slow_queries)
+    return state, _current.set(state)
+
+def finish_request(token):
+    _current.reset(token)
+
+def log_slow_queries(route, state):
+    for duration, sql, site in sorted(state.slowest, reverse = True):
+        logger.warning("Slow query on %s (%.1fms) at %s: %s", route, duration * 1000, site, sql)
+
+
+class TimedHTTPClient:
+    """Wraps stripe's HTTP client to count the calls and the time spent on them."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def request_with_retries(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._client.request_with_retries(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - started
+            state    = _current.get()
+            if state is None:
+                registry.observe_stripe(BACKGROUND, duration)
+            else:
+                state.stripe_calls   += 1
+                state.stripe_seconds += duration
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
@@ -0,0 +1,174 @@
+import logging
+import mimetypes
+import os
+import re
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.exceptions import MiddlewareNotUsed, SuspiciousFileOperation
+from django.db import OperationalError, connections
+from django.http import FileResponse, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.functional import SimpleLazyObject, cached_property
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+from . import metrics, routers
+from .cart import get_cart, save_anonymous_cart
+
+logger = logging.getLogger(__name__)
+
+
+class CartMiddleware:
+    """
+    Exposes the user's open order, or the anonymous cookie cart, as a lazy
+    `request.cart` and writes the cookie back when the cart changed.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.cart = SimpleLazyObject(lambda: get_cart(request))
+        response     = self.get_response(request)
+        save_anonymous_cart(request, response)
+        return response
+
+
+class MetricsMiddleware:
+    """
+    Records latency, query count, SQL and Stripe time per route into
+    `metrics.registry`. Goes first so the other middleware are measured too.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, "METRICS_ENABLED", True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.slow_queries = getattr(settings, "METRICS_SLOW_QUERIES", 0)
+
+    def __call__(self, request):
+        state, token = metrics.start_request(self.slow_queries)
+        started      = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(state.execute))
+                response = self.get_response(request)
+        finally:
+            metrics.finish_request(token)
+        duration = time.perf_counter() - started
+
+        match = getattr(request, "resolver_match", None)
+        route = match.view_name if match else "unmatched"
+        metrics.registry.observe_request(route, request.method, response.status_code, duration, state)
+        if state.slowest:
+            metrics.log_slow_queries(route, state)
+        return response
+
+
+class StaticFilesMiddleware:
+    """
+    Serves collectstatic's output from STATIC_ROOT, picking the `.br` or
+    `.gz` variant the client accepts. Names listed in the manifest carry a
+    content hash and are cached for STATIC_MAX_AGE, other files briefly.
+    """
+    encodings = (("br", ".br"), ("gzip", ".gz"))
+
+    def __init__(self, get_response):
+        if not getattr(settings, "STATIC_SERVE", True) or not settings.STATIC_ROOT \
+                or not settings.STATIC_URL.startswith("/"):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.max_age      = getattr(settings, "STATIC_MAX_AGE", 60 * 60 * 24 * 365)
+
+    @cached_property
+    def hashed_names(self):
+        # the manifest only changes with a deploy, which restarts the process
+        return set(getattr(staticfiles_storage, "hashed_files", {}).values())
+
+    def __call__(self, request):
+        if request.method not in ("GET", "HEAD") or not request.path.startswith(settings.STATIC_URL):
+            return self.get_response(request)
+        name = request.path[len(settings.STATIC_URL):]
+        try:
+            path = safe_join(settings.STATIC_ROOT, name)
+        except SuspiciousFileOperation:
+            return self.get_response(request)
+        if not os.path.isfile(path):
+            return self.get_response(request)
+        return self.serve(request, name, path)
+
+    def serve(self, request, name, path):
+        stat = os.stat(path)
+        if not was_modified_since(request.META.get("HTTP_IF_MODIFIED_SINCE"), stat.st_mtime, stat.st_size):
+            response = HttpResponseNotModified()
+        else:
+            accepted = request.META.get("HTTP_ACCEPT_ENCODING", "")
+            encoding = None
+            for candidate, suffix in self.encodings:
+                if re.search(r"\b%s\b" % candidate, accepted) and os.path.isfile(path + suffix):
+                    encoding, path = candidate, path + suffix
+                    break
+            content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            response     = FileResponse(open(path, "rb"), content_type = content_type)
+            if encoding:
+                response["Content-Encoding"] = encoding
+            response["Last-Modified"] = http_date(stat.st_mtime)
+        if name in self.hashed_names:
+            response["Cache-Control"] = "public, max-age=%d, immutable" % self.max_age
+        else:
+            response["Cache-Control"] = "public, max-age=60"
+        response["Vary"] = "Accept-Encoding"
+        return response
+
+
+class ReplicaPinMiddleware:
+    """
+    Keeps the reads of a user who just wrote (cart, checkout, payment, login)
+    on the primary for REPLICA_PIN_SECONDS, longer than the replicas lag
+    behind, through a short-lived cookie. Goes before SessionMiddleware so
+    session writes count too. A view whose replica query fails is run again
+    on the primary.
+    """
+    cookie_name  = "primary_pin"
+    safe_methods = ("GET", "HEAD", "OPTIONS")
+
+    def __init__(self, get_response):
+        if not routers.get_replicas():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.pin_seconds  = getattr(settings, "REPLICA_PIN_SECONDS", 5)
+
+    def __call__(self, request):
+        try:
+            pinned = float(request.COOKIES.get(self.cookie_name, 0)) > time.time()
+        except ValueError:
+            pinned = False
+        # forms are validated against what the user is about to change
+        pinned = pinned or request.method not in self.safe_methods
+        tokens = routers.start_request(pinned)
+        try:
+            response = self.get_response(request)
+            if routers.wrote_to_primary():
+                response.set_cookie(self.cookie_name, str(int(time.time() + self.pin_seconds)),
+                                    max_age = self.pin_seconds, httponly = True, samesite = "Lax")
+        finally:
+            routers.finish_request(tokens)
+        return response
+
+    def process_exception(self, request, exception):
+        alias = routers.replica_used()
+        if not isinstance(exception, OperationalError) or alias is None:
+            return None
+        logger.warning("Replica %s failed, retrying on the primary", alias, exc_info = True)
+        routers.mark_down(alias)
+        # reads go to a replica only until the first write, nothing was written yet
+        match = request.resolver_match
+        with routers.primary_reads():
+            response = match.func(request, *match.args, **match.kwargs)
+            if hasattr(response, "render") and callable(response.render):
+                response = response.render()
+        return response
@@ -0,0 +1,64 @@
+# Generated by Django 3.0.8 on 2026-10-18 12:06
+
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+def backfill_totals(apps, schema_editor):
+    Order = apps.get_model('core', 'Order')
+    OrderItem = apps.get_model('core', 'OrderItem')
+
+    for order_item in OrderItem.objects.select_related('item').iterator():
+        unit_price = order_item.item.discount_price or order_item.item.price
+        order_item.line_total = order_item.quantity * unit_price
+        order_item.save(update_fields=['line_total'])
+
+    for order in Order.objects.select_related('coupon').prefetch_related('items__item'):
+        subtotal = Decimal('0.00')
+        lines = Decimal('0.00')
+        for order_item in order.items.all():
+            subtotal += order_item.quantity * order_item.item.price
+            lines += order_item.line_total
+        order.subtotal = subtotal
+        order.discount_total = subtotal - lines
+        order.coupon_amount = order.coupon.amount if order.coupon else Decimal('0.00')
+        # a coupon worth more than the basket makes it free, as in Order.update_totals
+        order.total = max(lines - order.coupon_amount, Decimal('0.00'))
+        order.save(update_fields=['subtotal', 'discount_total', 'coupon_amount', 'total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='coupon_amount',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='discount_total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='line_total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
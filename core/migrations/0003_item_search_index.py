@@ -0,0 +1,47 @@
+from django.db import migrations
+
+from core.search import sqlite_has_fts5
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        if not sqlite_has_fts5(schema_editor.connection):
+            # searched with LIKE instead, see core.search.DatabaseSearchBackend
+            return
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS core_item_fts USING fts5(title, description)')
+        schema_editor.execute(
+            'INSERT INTO core_item_fts (rowid, title, description) '
+            'SELECT id, title, description FROM core_item')
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE TABLE IF NOT EXISTS core_item_search ('
+            'item_id integer PRIMARY KEY REFERENCES core_item (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, '
+            'document tsvector NOT NULL)')
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS core_item_search_document_gin '
+            'ON core_item_search USING GIN (document)')
+        schema_editor.execute(
+            "INSERT INTO core_item_search (item_id, document) "
+            "SELECT id, setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+            "setweight(to_tsvector('english', coalesce(description, '')), 'B') FROM core_item")
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS core_item_fts')
+    elif vendor == 'postgresql':
+        schema_editor.execute('DROP TABLE IF EXISTS core_item_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_order_totals'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
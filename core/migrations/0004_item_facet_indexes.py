@@ -0,0 +1,25 @@
+# Generated by Django 3.0.8 on 2026-10-18 12:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_item_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['category', '-id'], name='core_item_category_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['label', '-id'], name='core_item_label_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['category', 'label', '-id'], name='core_item_cat_label_id_idx'),
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 3.0.8 on 2026-10-18 12:12
+
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+def merge_open_carts(apps, schema_editor):
+    """Fold duplicate open orders and order items together before adding the constraints."""
+    Order = apps.get_model('core', 'Order')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    Through = Order.items.through
+
+    touched = set()
+    open_orders = {}
+    for order in Order.objects.filter(ordered=False).order_by('pk'):
+        keeper = open_orders.setdefault(order.user_id, order)
+        if keeper.pk != order.pk:
+            for link in Through.objects.filter(order_id=order.pk):
+                Through.objects.get_or_create(order_id=keeper.pk, orderitem_id=link.orderitem_id)
+            order.delete()
+            touched.add(keeper.pk)
+
+    # lines dropped from a cart by the old remove views were left behind
+    OrderItem.objects.filter(ordered=False).exclude(
+        pk__in=Through.objects.filter(order__ordered=False).values('orderitem_id')
+    ).delete()
+
+    open_lines = {}
+    for line in OrderItem.objects.filter(ordered=False).order_by('pk'):
+        keeper = open_lines.setdefault((line.user_id, line.item_id), line)
+        if keeper.pk != line.pk:
+            keeper.quantity += line.quantity
+            keeper.save(update_fields=['quantity'])
+            for link in Through.objects.filter(orderitem_id=line.pk):
+                Through.objects.get_or_create(order_id=link.order_id, orderitem_id=keeper.pk)
+                touched.add(link.order_id)
+            line.delete()
+
+    for order in Order.objects.filter(pk__in=touched).select_related('coupon'):
+        subtotal = Decimal('0.00')
+        lines = Decimal('0.00')
+        for line in OrderItem.objects.filter(pk__in=Through.objects.filter(order_id=order.pk).values('orderitem_id')).select_related('item'):
+            unit_price = line.item.discount_price or line.item.price
+            line.line_total = line.quantity * unit_price
+            line.save(update_fields=['line_total'])
+            subtotal += line.quantity * line.item.price
+            lines += line.line_total
+        order.subtotal = subtotal
+        order.discount_total = subtotal - lines
+        # a coupon worth more than the basket makes it free, as in Order.update_totals
+        order.total = max(lines - order.coupon_amount, Decimal('0.00'))
+        order.save(update_fields=['subtotal', 'discount_total', 'total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_item_facet_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_open_carts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(ordered=False), fields=('user',), name='core_order_one_open_order'),
+        ),
+        migrations.AddConstraint(
+            model_name='orderitem',
+            constraint=models.UniqueConstraint(condition=models.Q(ordered=False), fields=('user', 'item'), name='core_orderitem_one_open_line'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.0.8 on 2026-10-18 12:14
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0005_one_open_cart_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('idempotency_key', models.CharField(max_length=64, unique=True)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('source', models.CharField(blank=True, max_length=50, null=True)),
+                ('customer', models.CharField(blank=True, max_length=50, null=True)),
+                ('status', models.CharField(choices=[('P', 'Pending'), ('R', 'Running'), ('S', 'Succeeded'), ('F', 'Failed')], default='P', max_length=1)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Order')),
+                ('payment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.Payment')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='paymentjob',
+            index=models.Index(fields=['status', 'run_after'], name='core_paymentjob_queue_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='paymentjob',
+            constraint=models.UniqueConstraint(condition=models.Q(status__in=['P', 'R', 'S']), fields=('order',), name='core_paymentjob_one_active_per_order'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-18 12:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_payment_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='image_derivatives',
+            field=models.CharField(blank=True, editable=False, max_length=100),
+        ),
+    ]
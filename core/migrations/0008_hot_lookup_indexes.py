@@ -0,0 +1,97 @@
+# Generated by Django 3.0.8 on 2026-10-18 12:31
+
+import random
+import string
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def unique_value(value, taken, max_length):
+    n = 2
+    candidate = value
+    while candidate in taken:
+        suffix = '-%d' % n
+        candidate = value[:max_length - len(suffix)] + suffix
+        n += 1
+    taken.add(candidate)
+    return candidate
+
+
+def dedupe_lookup_keys(apps, schema_editor):
+    """Make the columns that become unique distinct, the first row keeps its value."""
+    Item = apps.get_model('core', 'Item')
+    Coupon = apps.get_model('core', 'Coupon')
+    Order = apps.get_model('core', 'Order')
+    Address = apps.get_model('core', 'Address')
+
+    for model, field, max_length in ((Item, 'slug', 50), (Coupon, 'code', 15)):
+        duplicates = list(model.objects.values(field).annotate(n=Count('pk')).filter(n__gt=1).values_list(field, flat=True))
+        if not duplicates:
+            continue
+        taken = set(model.objects.values_list(field, flat=True))
+        for value in duplicates:
+            for row in model.objects.filter(**{field: value}).order_by('pk')[1:]:
+                setattr(row, field, unique_value(value, taken, max_length))
+                row.save(update_fields=[field])
+
+    Order.objects.filter(ref_code='').update(ref_code=None)
+    duplicates = Order.objects.exclude(ref_code=None).values('ref_code').annotate(n=Count('pk')).filter(n__gt=1)
+    taken = set(Order.objects.exclude(ref_code=None).values_list('ref_code', flat=True))
+    for value in duplicates.values_list('ref_code', flat=True):
+        for order in Order.objects.filter(ref_code=value).order_by('pk')[1:]:
+            ref_code = value
+            while ref_code in taken:
+                ref_code = ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
+            taken.add(ref_code)
+            order.ref_code = ref_code
+            order.save(update_fields=['ref_code'])
+
+    # the most recent default address of each type stays the default
+    defaults = Address.objects.filter(default=True).values('user', 'address_type').annotate(n=Count('pk')).filter(n__gt=1)
+    for row in defaults.values('user', 'address_type'):
+        addresses = Address.objects.filter(default=True, user=row['user'], address_type=row['address_type'])
+        latest = addresses.order_by('-pk').first()
+        addresses.exclude(pk=latest.pk).update(default=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_item_image_derivatives'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_lookup_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='coupon',
+            name='code',
+            field=models.CharField(max_length=15, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='item',
+            name='slug',
+            field=models.SlugField(unique=True),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='ref_code',
+            field=models.CharField(blank=True, max_length=20, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['user', 'address_type', 'default'], name='core_address_user_type_def_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'ordered'], name='core_order_user_ordered_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(fields=['user', 'item', 'ordered'], name='core_orderitem_user_item_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='address',
+            constraint=models.UniqueConstraint(condition=models.Q(default=True), fields=('user', 'address_type'), name='core_address_one_default'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.0.8 on 2026-10-18 12:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_hot_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='refund',
+            name='amount',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='processed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='status',
+            field=models.CharField(choices=[('P', 'Pending'), ('S', 'Succeeded'), ('F', 'Failed')], default='P', max_length=1),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='stripe_refund_id',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+    ]
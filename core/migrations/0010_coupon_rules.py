@@ -0,0 +1,64 @@
+# Generated by Django 3.0.8 on 2026-10-18 12:38
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0009_refund_results'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coupon',
+            name='active',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='max_uses',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='max_uses_per_user',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='min_basket',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='uses',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='valid_from',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='valid_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='CouponRedemption',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uses', models.PositiveIntegerField(default=0)),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Coupon')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='couponredemption',
+            constraint=models.UniqueConstraint(fields=('coupon', 'user'), name='core_couponredemption_unique'),
+        ),
+    ]
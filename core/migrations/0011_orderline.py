@@ -0,0 +1,37 @@
+# Generated by Django 3.0.8 on 2026-10-18 12:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_coupon_rules'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderLine',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=120)),
+                ('quantity', models.IntegerField()),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('discount_price', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('line_total', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('currency', models.CharField(default='eur', max_length=3)),
+                ('ordered_date', models.DateTimeField()),
+                ('item', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.Item')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='core.Order')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='orderline',
+            index=models.Index(fields=['ordered_date'], name='core_orderline_date_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='orderline',
+            constraint=models.UniqueConstraint(fields=('order', 'item'), name='core_orderline_unique'),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 3.0.8 on 2026-10-18 12:44
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def fill_line_categories(apps, schema_editor):
+    Item = apps.get_model('core', 'Item')
+    OrderLine = apps.get_model('core', 'OrderLine')
+    OrderLine.objects.filter(item__isnull=False).update(
+        category=Subquery(Item.objects.filter(pk=OuterRef('item')).values('category')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_orderline'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(blank=True, choices=[('S', 'Shirt'), ('SW', 'Sport wear'), ('OW', 'Outwear')], max_length=2)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('orders', models.IntegerField(default=0)),
+                ('units', models.IntegerField(default=0)),
+                ('coupon_discount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('day', models.DateField()),
+            ],
+            options={
+                'verbose_name_plural': 'Daily sales',
+            },
+        ),
+        migrations.CreateModel(
+            name='HourlySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(blank=True, choices=[('S', 'Shirt'), ('SW', 'Sport wear'), ('OW', 'Outwear')], max_length=2)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('orders', models.IntegerField(default=0)),
+                ('units', models.IntegerField(default=0)),
+                ('coupon_discount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('hour', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name_plural': 'Hourly sales',
+            },
+        ),
+        migrations.CreateModel(
+            name='RollupCursor',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('timestamp', models.DateTimeField(blank=True, null=True)),
+                ('last_id', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='orderline',
+            name='category',
+            field=models.CharField(blank=True, choices=[('S', 'Shirt'), ('SW', 'Sport wear'), ('OW', 'Outwear')], max_length=2),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['timestamp', 'id'], name='core_payment_timestamp_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='hourlysales',
+            constraint=models.UniqueConstraint(fields=('hour', 'category'), name='core_hourlysales_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailysales',
+            constraint=models.UniqueConstraint(fields=('day', 'category'), name='core_dailysales_unique'),
+        ),
+        migrations.RunPython(fill_line_categories, migrations.RunPython.noop),
+    ]
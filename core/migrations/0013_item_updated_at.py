@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-18 12:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
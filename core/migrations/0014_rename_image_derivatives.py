@@ -0,0 +1,38 @@
+# Generated by Django 3.0.8 on 2026-10-18 14:02
+
+import os
+
+from django.core.files.storage import default_storage
+from django.db import migrations
+from django.utils import timezone
+
+# the sizes and formats at the time of the rename
+OLD_SIZES = ['card', 'detail']
+OLD_FORMATS = ['webp', 'jpg']
+
+
+def expire_derivatives(apps, schema_editor):
+    # derivatives are now named after the whole original name, the items show
+    # their original image until generate_image_derivatives wrote the new ones;
+    # updated_at expires the cached cards
+    Item = apps.get_model('core', 'Item')
+    names = set(Item.objects.exclude(image_derivatives='').values_list('image_derivatives', flat=True))
+    for name in names:
+        root, _ = os.path.splitext(name)
+        for size in OLD_SIZES:
+            for extension in OLD_FORMATS:
+                old_name = f'{root}.{size}.{extension}'
+                if default_storage.exists(old_name):
+                    default_storage.delete(old_name)
+    Item.objects.exclude(image_derivatives='').update(image_derivatives='', updated_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_item_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(expire_derivatives, migrations.RunPython.noop),
+    ]
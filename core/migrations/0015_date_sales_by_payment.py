@@ -0,0 +1,27 @@
+# Generated by Django 3.0.8 on 2026-10-18 14:20
+
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+
+def date_by_payment(apps, schema_editor):
+    # paid orders and their lines carried the date the cart was opened
+    Order = apps.get_model('core', 'Order')
+    OrderLine = apps.get_model('core', 'OrderLine')
+    Payment = apps.get_model('core', 'Payment')
+
+    paid_at = Payment.objects.filter(pk=OuterRef('payment_id')).values('timestamp')[:1]
+    Order.objects.filter(payment__isnull=False).update(ordered_date=Subquery(paid_at))
+    ordered_at = Order.objects.filter(pk=OuterRef('order_id')).values('ordered_date')[:1]
+    OrderLine.objects.filter(order__payment__isnull=False).update(ordered_date=Subquery(ordered_at))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_rename_image_derivatives'),
+    ]
+
+    operations = [
+        migrations.RunPython(date_by_payment, migrations.RunPython.noop),
+    ]
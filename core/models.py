@@ -1,9 +1,20 @@
+from decimal import Decimal
+
+from allauth.account.signals import user_logged_in
 from django.conf import settings
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models import Case, DecimalField, ExpressionWrapper, F, Q, Sum, Value, When
+from django.db.models.functions import Greatest
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
 from django.shortcuts import reverse
+from django.utils import timezone
 from django_countries.fields import CountryField
 
+from .catalog import catalog_changed_receiver
+from .coupons import coupon_table_receiver
+from .images import item_image_delete_receiver, item_image_receiver
+from .search import search_index_receiver, search_remove_receiver
+
 
 
 CATEGORY_CHOICES = (
@@ -18,11 +29,26 @@ LABEL_CHOICES = (
     ("D", "danger"),
 )
 
+CURRENCY = "eur"
+
 ADDRESS_CHOICES =(
     ("B", "Billing"),
     ("S", "Shipping")
 )
 
+PAYMENT_JOB_STATUS_CHOICES = (
+    ("P", "Pending"),
+    ("R", "Running"),
+    ("S", "Succeeded"),
+    ("F", "Failed"),
+)
+
+REFUND_STATUS_CHOICES = (
+    ("P", "Pending"),
+    ("S", "Succeeded"),
+    ("F", "Failed"),
+)
+
 # Create your models here.
 class UserProfile(models.Model):
     user                  = models.OneToOneField(settings.AUTH_USER_MODEL,
@@ -47,9 +73,23 @@ class Item(models.Model):
                                        max_length = 2)
     label           = models.CharField(choices    = LABEL_CHOICES,
                                        max_length = 1)
-    slug            = models.SlugField()
+    slug            = models.SlugField(unique = True)
     description     = models.TextField()
     image           = models.ImageField()
+    # image name the stored thumbnails were generated from
+    image_derivatives = models.CharField(max_length = 100,
+                                         blank      = True,
+                                         editable   = False)
+    # Last-Modified and ETag of the product page
+    updated_at      = models.DateTimeField(auto_now = True)
+
+    class Meta:
+        indexes = [
+            # HomeView filters on the facets and orders by -id
+            models.Index(fields = ["category", "-id"], name = "core_item_category_id_idx"),
+            models.Index(fields = ["label", "-id"], name = "core_item_label_id_idx"),
+            models.Index(fields = ["category", "label", "-id"], name = "core_item_cat_label_id_idx"),
+        ]
 
     def __str__(self):
         return self.title
@@ -63,6 +103,11 @@ class Item(models.Model):
     def get_remove_from_cart_url(self):
         return reverse("core:remove-from-cart", kwargs = { "slug": self.slug })
 
+    def get_final_price(self):
+        if self.discount_price:
+            return self.discount_price
+        return self.price
+
 class Address(models.Model):
     user                = models.ForeignKey(settings.AUTH_USER_MODEL,
                                             on_delete = models.CASCADE)
@@ -79,6 +124,15 @@ class Address(models.Model):
 
     class Meta:
         verbose_name_plural = "Addresses"
+        indexes = [
+            # CheckoutView looks up the default address of each type
+            models.Index(fields = ["user", "address_type", "default"], name = "core_address_user_type_def_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields    = ["user", "address_type"],
+                                    condition = Q(default = True),
+                                    name      = "core_address_one_default"),
+        ]
 
 class Payment(models.Model):
     stripe_charge_id  = models.CharField(max_length = 50)
@@ -90,17 +144,56 @@ class Payment(models.Model):
                                             max_digits     = 10)
     timestamp         = models.DateTimeField(auto_now_add  = True)
 
+    class Meta:
+        indexes = [
+            # high-water mark of the sales rollups
+            models.Index(fields = ["timestamp", "id"], name = "core_payment_timestamp_idx"),
+        ]
+
     def __str__(self):
         return self.user.username
 
 class Coupon(models.Model):
-    code              = models.CharField(max_length = 15)
+    code              = models.CharField(max_length = 15,
+                                         unique     = True)
     amount            = models.DecimalField(decimal_places = 2,
                                             max_digits     = 10)
+    active            = models.BooleanField(default = True)
+    valid_from        = models.DateTimeField(blank = True,
+                                             null  = True)
+    valid_until       = models.DateTimeField(blank = True,
+                                             null  = True)
+    min_basket        = models.DecimalField(decimal_places = 2,
+                                            max_digits     = 10,
+                                            default        = 0)
+    # empty means unlimited
+    max_uses          = models.PositiveIntegerField(blank = True,
+                                                    null  = True)
+    max_uses_per_user = models.PositiveIntegerField(blank = True,
+                                                    null  = True)
+    uses              = models.PositiveIntegerField(default  = 0,
+                                                    editable = False)
 
     def __str__(self):
         return self.code
 
+class CouponRedemption(models.Model):
+    """Per-user usage counter of a coupon."""
+    coupon            = models.ForeignKey(Coupon,
+                                          on_delete = models.CASCADE)
+    user              = models.ForeignKey(settings.AUTH_USER_MODEL,
+                                          on_delete = models.CASCADE)
+    uses              = models.PositiveIntegerField(default = 0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields = ["coupon", "user"],
+                                    name   = "core_couponredemption_unique"),
+        ]
+
+    def __str__(self):
+        return f"{self.coupon} by {self.user}"
+
 class OrderItem(models.Model):
     user          = models.ForeignKey(settings.AUTH_USER_MODEL,
                                       on_delete = models.CASCADE)
@@ -108,10 +201,31 @@ class OrderItem(models.Model):
                                       on_delete = models.CASCADE)
     quantity      = models.IntegerField(default = 1)
     ordered       = models.BooleanField(default = False)
+    line_total    = models.DecimalField(decimal_places = 2,
+                                        max_digits     = 10,
+                                        default        = 0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields = ["user", "item", "ordered"], name = "core_orderitem_user_item_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields    = ["user", "item"],
+                                    condition = Q(ordered = False),
+                                    name      = "core_orderitem_one_open_line"),
+        ]
 
     def __str__(self):
         return f"{self.quantity} of {self.item.title}"
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or "quantity" in update_fields:
+            self.line_total = self.get_final_price()
+            if update_fields is not None:
+                kwargs["update_fields"] = set(update_fields) | {"line_total"}
+        super().save(*args, **kwargs)
+
     def get_total_item_price(self):
         return self.quantity * self.item.price
 
@@ -131,7 +245,8 @@ class Order(models.Model):
                                             on_delete = models.CASCADE)
     ref_code            = models.CharField(max_length = 20,
                                            blank      = True,
-                                           null       = True)
+                                           null       = True,
+                                           unique     = True)
     items               = models.ManyToManyField(OrderItem)
     start_date          = models.DateTimeField(auto_now_add = True)
     ordered_date        = models.DateTimeField()
@@ -159,30 +274,380 @@ class Order(models.Model):
     refund_requested    = models.BooleanField(default = False)
     refund_granted      = models.BooleanField(default = False)
 
+    # denormalized totals, kept up to date by update_totals() and the
+    # receivers at the bottom of this module
+    subtotal            = models.DecimalField(decimal_places = 2,
+                                              max_digits     = 10,
+                                              default        = 0)
+    discount_total      = models.DecimalField(decimal_places = 2,
+                                              max_digits     = 10,
+                                              default        = 0)
+    coupon_amount       = models.DecimalField(decimal_places = 2,
+                                              max_digits     = 10,
+                                              default        = 0)
+    total               = models.DecimalField(decimal_places = 2,
+                                              max_digits     = 10,
+                                              default        = 0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields = ["user", "ordered"], name = "core_order_user_ordered_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields    = ["user"],
+                                    condition = Q(ordered = False),
+                                    name      = "core_order_one_open_order"),
+        ]
+
     def __str__(self):
         return self.user.username
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_coupon_id = instance.__dict__.get("coupon_id")
+        return instance
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        coupon_changed = self.coupon_id != getattr(self, "_loaded_coupon_id", None)
+        if coupon_changed and (update_fields is None or "coupon" in update_fields):
+            self.apply_coupon_amount()
+            if update_fields is not None:
+                kwargs["update_fields"] = set(update_fields) | {"coupon_amount", "total"}
+        super().save(*args, **kwargs)
+        self._loaded_coupon_id = self.coupon_id
+
+    def apply_coupon_amount(self):
+        self.coupon_amount = self.coupon.amount if self.coupon_id else Decimal("0.00")
+        self.total = max(self.subtotal - self.discount_total - self.coupon_amount, Decimal("0.00"))
+
+    def calculate_totals(self):
+        """Compute the totals from the live item prices in a single query."""
+        totals = self.items.aggregate(
+            subtotal = Sum(order_item_subtotal_expression()),
+            lines    = Sum(order_item_line_total_expression())
+        )
+        subtotal = totals["subtotal"] or Decimal("0.00")
+        lines    = totals["lines"] or Decimal("0.00")
+        coupon   = self.coupon.amount if self.coupon_id else Decimal("0.00")
+        return {
+            "subtotal":       subtotal,
+            "discount_total": subtotal - lines,
+            "coupon_amount":  coupon,
+            "total":          max(lines - coupon, Decimal("0.00")),
+        }
+
+    def update_totals(self, save = True):
+        for field, value in self.calculate_totals().items():
+            setattr(self, field, value)
+        if save and self.pk:
+            self.save(update_fields = TOTAL_FIELDS)
+
     def get_total(self):
-        total = 0
-        for order_item in self.items.all():
-            total += order_item.get_final_price()
-        if self.coupon:
-            total -= self.coupon.amount
-        return total
+        return self.total
+
+class OrderLine(models.Model):
+    """What a paid order line cost when it was bought, never updated afterwards."""
+    order             = models.ForeignKey(Order,
+                                          related_name = "lines",
+                                          on_delete    = models.CASCADE)
+    item              = models.ForeignKey(Item,
+                                          on_delete = models.SET_NULL,
+                                          blank     = True,
+                                          null      = True)
+    title             = models.CharField(max_length = 120)
+    category          = models.CharField(choices    = CATEGORY_CHOICES,
+                                         max_length = 2,
+                                         blank      = True)
+    quantity          = models.IntegerField()
+    price             = models.DecimalField(decimal_places = 2,
+                                            max_digits     = 10)
+    discount_price    = models.DecimalField(decimal_places = 2,
+                                            max_digits     = 10,
+                                            blank          = True,
+                                            null           = True)
+    line_total        = models.DecimalField(decimal_places = 2,
+                                            max_digits     = 10)
+    currency          = models.CharField(max_length = 3,
+                                         default    = CURRENCY)
+    ordered_date      = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields = ["ordered_date"], name = "core_orderline_date_idx"),
+        ]
+        constraints = [
+            # snapshotting an order twice inserts nothing
+            models.UniqueConstraint(fields = ["order", "item"],
+                                    name   = "core_orderline_unique"),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} of {self.title}"
+
+class SalesRollup(models.Model):
+    """
+    Sales of one period, per category. The row with an empty category holds
+    the whole shop: revenue there is what was charged, after discounts and
+    coupons, while category revenue is the sum of the line totals.
+    """
+    category          = models.CharField(choices    = CATEGORY_CHOICES,
+                                         max_length = 2,
+                                         blank      = True)
+    revenue           = models.DecimalField(decimal_places = 2,
+                                            max_digits     = 12,
+                                            default        = 0)
+    orders            = models.IntegerField(default = 0)
+    units             = models.IntegerField(default = 0)
+    coupon_discount   = models.DecimalField(decimal_places = 2,
+                                            max_digits     = 12,
+                                            default        = 0)
+
+    class Meta:
+        abstract = True
+
+class DailySales(SalesRollup):
+    day               = models.DateField()
+
+    class Meta:
+        verbose_name_plural = "Daily sales"
+        constraints = [
+            models.UniqueConstraint(fields = ["day", "category"],
+                                    name   = "core_dailysales_unique"),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.category or 'all'}"
+
+class HourlySales(SalesRollup):
+    hour              = models.DateTimeField()
+
+    class Meta:
+        verbose_name_plural = "Hourly sales"
+        constraints = [
+            models.UniqueConstraint(fields = ["hour", "category"],
+                                    name   = "core_hourlysales_unique"),
+        ]
+
+    def __str__(self):
+        return f"{self.hour:%Y-%m-%d %H:00} {self.category or 'all'}"
+
+class RollupCursor(models.Model):
+    """Last (Payment.timestamp, Payment.id) folded into a rollup."""
+    name              = models.CharField(max_length = 50,
+                                         unique     = True)
+    timestamp         = models.DateTimeField(blank = True,
+                                             null  = True)
+    last_id           = models.IntegerField(default = 0)
+
+    def __str__(self):
+        return self.name
+
+class PaymentJob(models.Model):
+    PENDING   = "P"
+    RUNNING   = "R"
+    SUCCEEDED = "S"
+    FAILED    = "F"
+    ACTIVE    = (PENDING, RUNNING, SUCCEEDED)
+    # the order's cart is locked meanwhile
+    IN_FLIGHT = (PENDING, RUNNING)
+
+    order             = models.ForeignKey(Order,
+                                          on_delete = models.CASCADE)
+    user              = models.ForeignKey(settings.AUTH_USER_MODEL,
+                                          on_delete = models.CASCADE)
+    idempotency_key   = models.CharField(max_length = 64,
+                                         unique     = True)
+    amount            = models.DecimalField(decimal_places = 2,
+                                            max_digits     = 10)
+    source            = models.CharField(max_length = 50,
+                                         blank      = True,
+                                         null       = True)
+    customer          = models.CharField(max_length = 50,
+                                         blank      = True,
+                                         null       = True)
+    status            = models.CharField(max_length = 1,
+                                         choices    = PAYMENT_JOB_STATUS_CHOICES,
+                                         default    = PENDING)
+    attempts          = models.IntegerField(default = 0)
+    error             = models.TextField(blank = True)
+    payment           = models.ForeignKey(Payment,
+                                          on_delete = models.SET_NULL,
+                                          blank     = True,
+                                          null      = True)
+    run_after         = models.DateTimeField(default = timezone.now)
+    created           = models.DateTimeField(auto_now_add = True)
+    updated           = models.DateTimeField(auto_now = True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields = ["status", "run_after"], name = "core_paymentjob_queue_idx"),
+        ]
+        constraints = [
+            # a second submit of the same cart joins the job already queued
+            models.UniqueConstraint(fields    = ["order"],
+                                    condition = Q(status__in = ["P", "R", "S"]),
+                                    name      = "core_paymentjob_one_active_per_order"),
+        ]
+
+    def __str__(self):
+        return self.idempotency_key
+
+    def is_finished(self):
+        return self.status in (self.SUCCEEDED, self.FAILED)
 
 class Refund(models.Model):
+    PENDING   = "P"
+    SUCCEEDED = "S"
+    FAILED    = "F"
+
     order             = models.ForeignKey(Order,
                                           on_delete = models.CASCADE)
     reason            = models.TextField()
     accepted          = models.BooleanField(default = False)
     email             = models.EmailField()
+    status            = models.CharField(max_length = 1,
+                                         choices    = REFUND_STATUS_CHOICES,
+                                         default    = PENDING)
+    stripe_refund_id  = models.CharField(max_length = 50,
+                                         blank      = True)
+    amount            = models.DecimalField(decimal_places = 2,
+                                            max_digits     = 10,
+                                            blank          = True,
+                                            null           = True)
+    attempts          = models.IntegerField(default = 0)
+    error             = models.TextField(blank = True)
+    processed_at      = models.DateTimeField(blank = True,
+                                             null  = True)
 
     def __str__(self):
         return f"{self.pk}"
 
+TOTAL_FIELDS = ["subtotal", "discount_total", "coupon_amount", "total"]
+
+def order_total_expression(total):
+    """The stored total of an UPDATE, a coupon worth more than the basket makes it free."""
+    return Greatest(total, Value(0), output_field = DecimalField(decimal_places = 2, max_digits = 10))
+
+def order_item_subtotal_expression(prefix = ""):
+    return ExpressionWrapper(
+        F(f"{prefix}quantity") * F(f"{prefix}item__price"),
+        output_field = DecimalField(decimal_places = 2, max_digits = 10)
+    )
+
+def order_item_line_total_expression(prefix = ""):
+    # mirrors OrderItem.get_final_price()
+    return Case(
+        When(**{ f"{prefix}item__discount_price__gt": 0 },
+             then = F(f"{prefix}quantity") * F(f"{prefix}item__discount_price")),
+        default      = F(f"{prefix}quantity") * F(f"{prefix}item__price"),
+        output_field = DecimalField(decimal_places = 2, max_digits = 10)
+    )
+
+def reprice_open_order_items(items):
+    """Refresh the stored totals of every open cart holding one of `items`."""
+    for item in items:
+        OrderItem.objects.filter(item = item, ordered = False).update(
+            line_total = F("quantity") * item.get_final_price()
+        )
+    orders = Order.objects.filter(
+        ordered         = False,
+        items__item__in = items
+    ).select_related("coupon").distinct()
+    for order in orders:
+        order.update_totals()
+
 def user_profile_receiver(sender, instance, created, *args, **kwargs):
     if created:
         user_profile = UserProfile.objects.create(user = instance)
 
+PRICE_FIELDS = ["price", "discount_price"]
+
+def item_pre_save_receiver(sender, instance, raw = False, update_fields = None, *args, **kwargs):
+    if raw or instance._state.adding:
+        return
+    if update_fields is not None and not set(PRICE_FIELDS) & set(update_fields):
+        instance._stored_prices = None
+        return
+    instance._stored_prices = sender.objects.filter(pk = instance.pk).values_list(*PRICE_FIELDS).first()
+
+def item_price_receiver(sender, instance, created, raw = False, *args, **kwargs):
+    # title, description and image edits leave the carts alone
+    stored = getattr(instance, "_stored_prices", None)
+    if not created and not raw and stored is not None and stored != (instance.price, instance.discount_price):
+        reprice_open_order_items([instance])
+
+def order_item_receiver(sender, instance, created, raw = False, *args, **kwargs):
+    # new order items are not attached to an order yet, m2m_changed handles them
+    if not created and not raw and not getattr(instance, "_skip_order_totals", False):
+        for order in Order.objects.filter(items = instance, ordered = False):
+            order.update_totals()
+
+def order_item_pre_delete_receiver(sender, instance, *args, **kwargs):
+    if getattr(instance, "_skip_order_totals", False):
+        return
+    instance._open_order_ids = list(
+        Order.objects.filter(items = instance, ordered = False).values_list("pk", flat = True)
+    )
+
+def order_item_post_delete_receiver(sender, instance, *args, **kwargs):
+    for order in Order.objects.filter(pk__in = getattr(instance, "_open_order_ids", [])):
+        order.update_totals()
+
+def order_items_changed_receiver(sender, instance, action, reverse, pk_set, *args, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        if not instance.ordered:
+            instance.update_totals()
+    elif pk_set:
+        for order in Order.objects.filter(pk__in = pk_set, ordered = False):
+            order.update_totals()
+
+def anonymous_cart_receiver(sender, request, user, *args, **kwargs):
+    from .cart import merge_anonymous_cart
+
+    merge_anonymous_cart(request, user)
+
+def coupon_receiver(sender, instance, created, raw = False, *args, **kwargs):
+    if not created and not raw:
+        Order.objects.filter(coupon = instance, ordered = False).update(
+            coupon_amount = instance.amount,
+            total         = order_total_expression(F("subtotal") - F("discount_total") - instance.amount)
+        )
+
 post_save.connect(user_profile_receiver,
                   sender = settings.AUTH_USER_MODEL)
+pre_save.connect(item_pre_save_receiver,
+                 sender = Item)
+post_save.connect(item_price_receiver,
+                  sender = Item)
+# before the catalog version bump, cached pages must see the new derivatives
+post_save.connect(item_image_receiver,
+                  sender = Item)
+post_delete.connect(item_image_delete_receiver,
+                    sender = Item)
+post_save.connect(catalog_changed_receiver,
+                  sender = Item)
+post_delete.connect(catalog_changed_receiver,
+                    sender = Item)
+post_save.connect(search_index_receiver,
+                  sender = Item)
+post_delete.connect(search_remove_receiver,
+                    sender = Item)
+post_save.connect(order_item_receiver,
+                  sender = OrderItem)
+pre_delete.connect(order_item_pre_delete_receiver,
+                   sender = OrderItem)
+post_delete.connect(order_item_post_delete_receiver,
+                    sender = OrderItem)
+m2m_changed.connect(order_items_changed_receiver,
+                    sender = Order.items.through)
+post_save.connect(coupon_receiver,
+                  sender = Coupon)
+post_save.connect(coupon_table_receiver,
+                  sender = Coupon)
+post_delete.connect(coupon_table_receiver,
+                    sender = Coupon)
+user_logged_in.connect(anonymous_cart_receiver)
@@ -0,0 +1,128 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connections
+from django.http import Http404
+from django.utils.functional import cached_property
+
+
+class KeysetPage:
+    """Page of a keyset (cursor) paginated, primary key descending listing."""
+
+    is_keyset = True
+    number    = None
+
+    def __init__(self, object_list, next_after, previous_before):
+        self.object_list     = object_list
+        self.next_after      = next_after
+        self.previous_before = previous_before
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_after is not None
+
+    def has_previous(self):
+        return self.previous_before is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginationMixin:
+    """
+    Adds an opt-in keyset pagination mode to a ListView: ``?after=<pk>``
+    seeks past the given primary key (``?after=`` starts at the top) and
+    ``?before=<pk>`` walks back. No OFFSET and no COUNT(*) are issued, so
+    every page costs the same. Set ``keyset_pagination = True`` to make it
+    the default for a view.
+    """
+
+    keyset_pagination = False
+
+    def use_keyset_pagination(self):
+        return (self.keyset_pagination
+                or "after" in self.request.GET
+                or "before" in self.request.GET)
+
+    def get_cursor(self, name):
+        value = self.request.GET.get(name)
+        if not value:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise Http404(f"Invalid cursor: {value}")
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.use_keyset_pagination():
+            return super().paginate_queryset(queryset, page_size)
+        if not hasattr(queryset, "filter"):
+            raise ImproperlyConfigured("Keyset pagination needs a queryset.")
+
+        after  = self.get_cursor("after")
+        before = self.get_cursor("before")
+        if before is not None:
+            # walk up from the cursor, then restore the descending order
+            rows = list(queryset.filter(pk__gt = before).order_by("pk")[:page_size + 1])
+            has_more = len(rows) > page_size
+            rows = rows[:page_size][::-1]
+            next_after      = rows[-1].pk if rows else None
+            previous_before = rows[0].pk if rows and has_more else None
+        else:
+            if after is not None:
+                queryset = queryset.filter(pk__lt = after)
+            rows = list(queryset.order_by("-pk")[:page_size + 1])
+            has_more = len(rows) > page_size
+            rows = rows[:page_size]
+            next_after      = rows[-1].pk if rows and has_more else None
+            previous_before = rows[0].pk if rows and after is not None else None
+
+        page = KeysetPage(rows, next_after, previous_before)
+        return (None, page, page.object_list, page.has_other_pages())
+
+
+def estimated_count(queryset):
+    """
+    Row count of an unfiltered queryset from the planner statistics
+    (pg_class.reltuples, sqlite_stat1 once ANALYZE ran), None otherwise.
+    """
+    if queryset.query.where or queryset.query.distinct:
+        return None
+    connection = connections[queryset.db]
+    table      = queryset.model._meta.db_table
+    if connection.vendor == "postgresql":
+        sql = "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass"
+    elif connection.vendor == "sqlite":
+        # the stat column starts with the table's row count
+        sql = "SELECT CAST(stat AS INTEGER) FROM sqlite_stat1 WHERE tbl = %s LIMIT 1"
+    else:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [table])
+            row = cursor.fetchone()
+    except DatabaseError:
+        return None
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return row[0]
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Uses the planner estimate instead of COUNT(*) for unfiltered querysets of
+    large tables. Filtered querysets and small tables get an exact count.
+    """
+
+    estimate_threshold = 10000
+
+    @cached_property
+    def count(self):
+        estimate = estimated_count(self.object_list)
+        if estimate is not None and estimate >= self.estimate_threshold:
+            return estimate
+        return super().count
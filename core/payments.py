@@ -0,0 +1,248 @@
+import logging
+import random
+import string
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+import stripe
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .coupons import CouponError, redeem_coupon, release_coupon, validate_coupon
+from .metrics import TimedHTTPClient
+from .models import CURRENCY, Order, Payment, PaymentJob
+from .reporting import snapshot_order_lines
+
+logger = logging.getLogger(__name__)
+
+stripe.api_key  = settings.STRIPE_SECRET_KEY
+stripe.api_base = getattr(settings, "STRIPE_API_BASE", stripe.api_base)
+# counts Stripe calls and their latency for the metrics endpoint
+stripe.default_http_client = TimedHTTPClient(stripe.http_client.new_default_http_client(
+    verify_ssl_certs = stripe.verify_ssl_certs,
+    proxy            = stripe.proxy
+))
+
+MAX_ATTEMPTS  = getattr(settings, "PAYMENT_JOB_MAX_ATTEMPTS", 5)
+RETRY_BACKOFF = getattr(settings, "PAYMENT_JOB_RETRY_BACKOFF", 2)     # seconds, doubled per attempt
+STALE_AFTER   = getattr(settings, "PAYMENT_JOB_STALE_AFTER", 300)     # seconds before a running job is reclaimed
+
+
+class RetryLater(Exception):
+    pass
+
+
+def create_ref_code():
+    return "".join(random.choices(string.ascii_lowercase + string.digits, k=20))
+
+def enqueue_payment(order, user, source = None, customer = None):
+    """Queue the charge of `order`, or return the job already queued for it."""
+    job = PaymentJob.objects.filter(order = order, status__in = PaymentJob.ACTIVE).first()
+    if job:
+        return job
+    try:
+        with transaction.atomic():
+            if order.coupon_id:
+                # counted from here on, released again if the charge fails;
+                # raises CouponError when the coupon no longer applies
+                redeem_coupon(order, user)
+            job = PaymentJob.objects.create(
+                order           = order,
+                user            = user,
+                # stripe replays the first response for a repeated key, so a
+                # retried job can never charge the card twice
+                idempotency_key = f"order-{order.pk}-{uuid.uuid4().hex}",
+                amount          = order.total,
+                source          = source,
+                customer        = customer
+            )
+    except IntegrityError:
+        return PaymentJob.objects.get(order = order, status__in = PaymentJob.ACTIVE)
+    if getattr(settings, "PAYMENT_JOBS_EAGER", False) and claim_job(job):
+        run_job(job)
+        job.refresh_from_db()
+    return job
+
+def claim_job(job):
+    # the conditional update makes sure only one worker claims the job
+    claimed = PaymentJob.objects.filter(pk = job.pk, status = job.status, updated = job.updated).update(
+        status   = PaymentJob.RUNNING,
+        attempts = F("attempts") + 1,
+        updated  = timezone.now()
+    )
+    if claimed:
+        job.refresh_from_db()
+    return bool(claimed)
+
+def claim_next_job():
+    now   = timezone.now()
+    ready = Q(status = PaymentJob.PENDING, run_after__lte = now) | Q(
+        status      = PaymentJob.RUNNING,
+        updated__lt = now - timedelta(seconds = STALE_AFTER)
+    )
+    for job in PaymentJob.objects.filter(ready).order_by("run_after", "pk")[:10]:
+        if claim_job(job):
+            return job
+    return None
+
+def run_job(job):
+    """Charge a claimed job and finalize its order, or schedule a retry."""
+    # the cart is locked while the job is in flight, but a price change still
+    # reprices it; the customer confirms the new total with a new job
+    order = Order.objects.select_related("coupon").get(pk = job.order_id)
+    if order.total != job.amount:
+        fail_job(job, "Your order changed during the payment. Please confirm the new total.")
+        return
+    if order.coupon_id:
+        try:
+            validate_coupon(order.coupon, order)
+        except CouponError as e:
+            fail_job(job, str(e))
+            return
+    try:
+        charge = charge_order(job)
+    except RetryLater as e:
+        if job.attempts >= MAX_ATTEMPTS:
+            fail_job(job, str(e))
+        else:
+            PaymentJob.objects.filter(pk = job.pk).update(
+                status    = PaymentJob.PENDING,
+                error     = str(e),
+                run_after = timezone.now() + timedelta(seconds = RETRY_BACKOFF * 2 ** (job.attempts - 1))
+            )
+    except stripe.error.StripeError as e:
+        fail_job(job, describe_stripe_error(e))
+    else:
+        finalize_order(job, charge)
+
+def charge_order(job):
+    # a card saved for the customer is charged by its source id, alone the
+    # customer means its default card
+    params = {}
+    if job.customer:
+        params["customer"] = job.customer
+    if job.source:
+        params["source"] = job.source
+    try:
+        return stripe.Charge.create(
+            amount          = int(job.amount * 100), # cents
+            currency        = CURRENCY,
+            idempotency_key = job.idempotency_key,
+            **params
+        )
+    except stripe.error.RateLimitError:
+        raise RetryLater("Rate limit error")
+    except stripe.error.APIConnectionError:
+        raise RetryLater("Network error")
+
+def describe_stripe_error(e):
+    if isinstance(e, stripe.error.CardError):
+        return e.user_message or "Your card was declined."
+    if isinstance(e, stripe.error.InvalidRequestError):
+        return "Invalid parameters"
+    if isinstance(e, stripe.error.AuthenticationError):
+        return "Not authenticated"
+    return "Something went wrong. You are not charged. Please try again."
+
+def fail_job(job, error):
+    logger.warning("Payment job %s failed: %s", job.idempotency_key, error)
+    with transaction.atomic():
+        failed = PaymentJob.objects.filter(pk = job.pk, status__in = PaymentJob.IN_FLIGHT).update(
+            status = PaymentJob.FAILED,
+            error  = error
+        )
+        coupon_id = Order.objects.values_list("coupon_id", flat = True).get(pk = job.order_id)
+        if failed and coupon_id:
+            release_coupon(coupon_id, job.user_id)
+
+def _card_cache_key(customer_id):
+    return f"stripe:cards:{customer_id}"
+
+def fetch_default_card(customer_id):
+    cards = stripe.Customer.list_sources(
+        customer_id,
+        limit  = 3,
+        object = "card"
+    )
+    card_list = cards["data"]
+    if not card_list:
+        return None
+    card = card_list[0]
+    return {
+        "id":        card["id"],
+        "brand":     card.get("brand"),
+        "last4":     card["last4"],
+        "exp_month": card["exp_month"],
+        "exp_year":  card["exp_year"],
+    }
+
+def _refresh_default_card(customer_id):
+    key = _card_cache_key(customer_id)
+    try:
+        card = fetch_default_card(customer_id)
+        cache.set(key, (time.time(), card), getattr(settings, "STRIPE_CARD_CACHE_MAX_AGE", 60 * 60 * 24))
+    except stripe.error.StripeError:
+        logger.warning("Could not refresh the cards of %s", customer_id, exc_info = True)
+    finally:
+        cache.delete(f"{key}:refreshing")
+
+def get_default_card(customer_id):
+    """
+    Summary of the customer's default card. Entries older than
+    STRIPE_CARD_CACHE_TTL are still served while a background thread
+    fetches a fresh copy (stale-while-revalidate).
+    """
+    key   = _card_cache_key(customer_id)
+    entry = cache.get(key)
+    if entry is None:
+        card = fetch_default_card(customer_id)
+        cache.set(key, (time.time(), card), getattr(settings, "STRIPE_CARD_CACHE_MAX_AGE", 60 * 60 * 24))
+        return card
+
+    fetched_at, card = entry
+    if time.time() - fetched_at >= getattr(settings, "STRIPE_CARD_CACHE_TTL", 60 * 5):
+        # only one refresh per customer at a time
+        if cache.add(f"{key}:refreshing", True, 30):
+            threading.Thread(target = _refresh_default_card, args = (customer_id,), daemon = True).start()
+    return card
+
+def invalidate_default_card(customer_id):
+    cache.delete(_card_cache_key(customer_id))
+
+def finalize_order(job, charge):
+    """
+    Record the charge and mark the order paid. A reclaimed job may be charged
+    by two workers, Stripe replays the same charge to both and only the first
+    one to finalize records it.
+    """
+    with transaction.atomic():
+        finalized = PaymentJob.objects.filter(pk = job.pk, status__in = PaymentJob.IN_FLIGHT).update(
+            status = PaymentJob.SUCCEEDED,
+            error  = ""
+        )
+        if not finalized:
+            current = PaymentJob.objects.select_related("payment").get(pk = job.pk)
+            if current.status != PaymentJob.SUCCEEDED:
+                logger.error("Payment job %s was charged (%s) after it failed", job.idempotency_key, charge["id"])
+            return current.payment
+        payment = Payment.objects.create(
+            stripe_charge_id = charge["id"],
+            user             = job.user,
+            amount           = job.amount
+        )
+        PaymentJob.objects.filter(pk = job.pk).update(payment = payment)
+        order = Order.objects.get(pk = job.order_id)
+        order.items.update(ordered = True)
+        Order.objects.filter(pk = order.pk, ordered = False).update(
+            ordered      = True,
+            ordered_date = payment.timestamp,
+            ref_code     = create_ref_code(),
+            payment      = payment
+        )
+        snapshot_order_lines([order.pk])
+    return payment
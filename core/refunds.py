@@ -0,0 +1,145 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import stripe
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import payments  # noqa: F401 configures the stripe client
+from .models import Order, Refund
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Blocks callers so that at most `rate` calls per second go out, with bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity = None):
+        self.rate     = rate
+        self.capacity = capacity or rate
+        self.tokens   = self.capacity
+        self.updated  = time.monotonic()
+        self.lock     = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now          = time.monotonic()
+                self.tokens  = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RefundFailed(Exception):
+    def __init__(self, message, attempts):
+        super().__init__(message)
+        self.attempts = attempts
+
+
+def refund_key(refund):
+    """
+    Same for every call of a run, so a retried network error is replayed by
+    Stripe rather than refunded again. Stripe replays errors too, a run after
+    a failure gets a fresh key by counting the earlier attempts.
+    """
+    return f"refund-{refund.pk}-{refund.attempts}"
+
+def refund_charge(charge_id, idempotency_key, bucket, max_attempts, backoff):
+    """
+    Issue the Stripe refund of `charge_id`, retrying rate limit and network
+    errors. Runs on the pool, touches no database. Returns (refund, attempts),
+    raises RefundFailed.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        bucket.acquire()
+        try:
+            return stripe.Refund.create(charge = charge_id, idempotency_key = idempotency_key), attempt
+        except (stripe.error.RateLimitError, stripe.error.APIConnectionError) as e:
+            if attempt >= max_attempts:
+                raise RefundFailed(e.user_message or str(e), attempt)
+            time.sleep(backoff * 2 ** (attempt - 1))
+        except stripe.error.StripeError as e:
+            raise RefundFailed(e.user_message or str(e), attempt)
+
+
+def process_refunds(orders, workers = None, rate = None):
+    """
+    Refund the Stripe charge of each paid order not refunded yet, concurrently.
+    Results are recorded on the order's latest Refund (created when the
+    customer never asked). Returns {"succeeded": n, "failed": n}.
+    """
+    workers      = workers or getattr(settings, "REFUND_WORKERS", 4)
+    rate         = rate or getattr(settings, "REFUND_RATE_LIMIT", 20)
+    max_attempts = getattr(settings, "REFUND_MAX_ATTEMPTS", 5)
+    backoff      = getattr(settings, "REFUND_RETRY_BACKOFF", 1)
+
+    # open carts picked in the changelist have nothing to refund
+    orders  = list(Order.objects.filter(pk__in = [order.pk for order in orders], ordered = True,
+                                        refund_granted = False)
+                                .select_related("payment", "user"))
+    refunds = {}
+    for refund in Refund.objects.filter(order__in = orders).order_by("pk"):
+        refunds[refund.order_id] = refund
+    missing = [Refund(order = order, reason = "Refunded by staff", email = order.user.email)
+               for order in orders if order.pk not in refunds]
+    for refund in missing:
+        refund.save()
+        refunds[refund.order_id] = refund
+
+    results = {"succeeded": 0, "failed": 0}
+    bucket  = TokenBucket(rate)
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        futures = {}
+        for order in orders:
+            refund = refunds[order.pk]
+            if order.payment is None:
+                record_failure(refund, "The order has no payment")
+                results["failed"] += 1
+                continue
+            future = pool.submit(refund_charge, order.payment.stripe_charge_id, refund_key(refund),
+                                 bucket, max_attempts, backoff)
+            futures[future] = (order, refund)
+
+        for future in as_completed(futures):
+            order, refund = futures[future]
+            try:
+                stripe_refund, attempts = future.result()
+            except RefundFailed as e:
+                record_failure(refund, str(e), e.attempts)
+                results["failed"] += 1
+            else:
+                record_success(order, refund, stripe_refund, attempts)
+                results["succeeded"] += 1
+    return results
+
+def record_success(order, refund, stripe_refund, attempts):
+    with transaction.atomic():
+        Refund.objects.filter(pk = refund.pk).update(
+            accepted         = True,
+            status           = Refund.SUCCEEDED,
+            stripe_refund_id = stripe_refund["id"],
+            amount           = order.payment.amount,
+            attempts         = F("attempts") + attempts,
+            error            = "",
+            processed_at     = timezone.now()
+        )
+        Order.objects.filter(pk = order.pk).update(refund_requested = False, refund_granted = True)
+
+def record_failure(refund, error, attempts = 0):
+    logger.warning("Refund %s failed: %s", refund.pk, error)
+    Refund.objects.filter(pk = refund.pk).update(
+        status       = Refund.FAILED,
+        attempts     = F("attempts") + attempts,
+        error        = error,
+        processed_at = timezone.now()
+    )
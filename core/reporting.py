@@ -0,0 +1,164 @@
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import DailySales, HourlySales, Order, OrderItem, OrderLine, RollupCursor
+
+LINE_FIELDS  = ["order", "item", "title", "category", "quantity", "price", "discount_price", "line_total",
+                "currency", "ordered_date"]
+SALES_CURSOR = "sales"
+ALL          = ""
+
+
+def snapshot_order_lines(order_ids):
+    """
+    Copy the lines of the given orders, with their item's title and prices,
+    into OrderLine. One read and one bulk insert. Lines already snapshotted
+    are left untouched. Returns the number of lines read. Lines are dated by
+    the payment, a cart may have been opened long before.
+    """
+    rows = OrderItem.objects.filter(order__in = order_ids).values_list(
+        "order", "item", "item__title", "item__category", "quantity", "item__price", "item__discount_price",
+        "line_total", Coalesce("order__payment__timestamp", "order__ordered_date")
+    )
+    lines = [
+        OrderLine(order_id = order_id, item_id = item_id, title = title, category = category, quantity = quantity,
+                  price = price, discount_price = discount_price, line_total = line_total,
+                  ordered_date = ordered_date)
+        for order_id, item_id, title, category, quantity, price, discount_price, line_total, ordered_date in rows
+    ]
+    if lines:
+        fields     = [OrderLine._meta.get_field(name) for name in LINE_FIELDS]
+        batch_size = connection.ops.bulk_batch_size(fields, lines) or None
+        OrderLine.objects.bulk_create(lines, batch_size = batch_size, ignore_conflicts = True)
+    return len(lines)
+
+def backfill_order_lines(chunk_size = 500, on_progress = None):
+    """
+    Snapshot the paid orders that have no lines yet, `chunk_size` orders per
+    transaction, walking the primary key. Line prices come from the items as
+    they are now, the line totals are the ones stored on the cart lines.
+    """
+    stats = {"orders": 0, "lines": 0}
+    last  = 0
+    while True:
+        order_ids = list(Order.objects.filter(ordered = True, pk__gt = last, lines__isnull = True)
+                                      .order_by("pk")
+                                      .values_list("pk", flat = True)[:chunk_size])
+        if not order_ids:
+            return stats
+        with transaction.atomic():
+            stats["lines"] += snapshot_order_lines(order_ids)
+        stats["orders"] += len(order_ids)
+        last = order_ids[-1]
+        if on_progress:
+            on_progress(stats)
+
+
+def _after(timestamp, payment_id, prefix = ""):
+    """Orders paid after the (timestamp, payment id) position."""
+    if timestamp is None:
+        return Q()
+    return (Q(**{f"{prefix}payment__timestamp__gt": timestamp}) |
+            Q(**{f"{prefix}payment__timestamp": timestamp, f"{prefix}payment_id__gt": payment_id}))
+
+def _up_to(timestamp, payment_id, prefix = ""):
+    """Orders paid at or before the (timestamp, payment id) position."""
+    return (Q(**{f"{prefix}payment__timestamp__lt": timestamp}) |
+            Q(**{f"{prefix}payment__timestamp": timestamp, f"{prefix}payment_id__lte": payment_id}))
+
+def _upsert(model, key, values):
+    increments = {field: F(field) + value for field, value in values.items()}
+    if model.objects.filter(**key).update(**increments):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**key, **values)
+    except IntegrityError:
+        model.objects.filter(**key).update(**increments)
+
+def _empty_rollup():
+    return {"revenue": Decimal("0.00"), "orders": 0, "units": 0, "coupon_discount": Decimal("0.00")}
+
+def rollup_sales(chunk_size = 1000, on_progress = None):
+    """
+    Fold the orders paid since the last run into HourlySales and DailySales,
+    `chunk_size` orders per transaction. The position is a high-water mark on
+    (Payment.timestamp, Payment.id) stored in RollupCursor and moved in the
+    same transaction as the aggregates, so each order is counted once.
+    Payments younger than SALES_ROLLUP_LAG seconds are left for the next run,
+    a transaction still in flight may commit an older timestamp.
+    """
+    until = timezone.now() - timedelta(seconds = getattr(settings, "SALES_ROLLUP_LAG", 60))
+    stats = {"orders": 0, "lines": 0}
+    while True:
+        with transaction.atomic():
+            # a concurrent run waits here instead of counting the same orders
+            cursor, _ = RollupCursor.objects.select_for_update().get_or_create(name = SALES_CURSOR)
+            orders = list(Order.objects.filter(_after(cursor.timestamp, cursor.last_id),
+                                               ordered = True, payment__timestamp__lte = until)
+                                       .order_by("payment__timestamp", "payment_id")
+                                       .values_list("pk", "payment_id", "payment__timestamp", "total",
+                                                    "coupon_amount")[:chunk_size])
+            if not orders:
+                return stats
+            _, last_id, last_timestamp, _, _ = orders[-1]
+
+            hourly = defaultdict(_empty_rollup)
+            hours  = {}
+            for order_id, _, timestamp, total, coupon_amount in orders:
+                hours[order_id] = hour = timezone.localtime(timestamp).replace(minute = 0, second = 0,
+                                                                              microsecond = 0)
+                rollup                     = hourly[(hour, ALL)]
+                rollup["revenue"]         += total
+                rollup["orders"]          += 1
+                rollup["coupon_discount"] += coupon_amount
+
+            # the lines of the chunk, streamed
+            lines = OrderLine.objects.filter(
+                _after(cursor.timestamp, cursor.last_id, "order__"), _up_to(last_timestamp, last_id, "order__"),
+                order__ordered = True
+            ).values_list("order_id", "category", "quantity", "line_total")
+            counted = set()
+            for order_id, category, quantity, line_total in lines.iterator(chunk_size = chunk_size):
+                hour = hours.get(order_id)
+                if hour is None:
+                    continue
+                rollup             = hourly[(hour, category)]
+                rollup["revenue"] += line_total
+                rollup["units"]   += quantity
+                hourly[(hour, ALL)]["units"] += quantity
+                if (order_id, category) not in counted:
+                    counted.add((order_id, category))
+                    rollup["orders"] += 1
+                stats["lines"] += 1
+
+            daily = defaultdict(_empty_rollup)
+            for (hour, category), values in hourly.items():
+                _upsert(HourlySales, {"hour": hour, "category": category}, values)
+                rollup = daily[(hour.date(), category)]
+                for field, value in values.items():
+                    rollup[field] += value
+            for (day, category), values in daily.items():
+                _upsert(DailySales, {"day": day, "category": category}, values)
+
+            cursor.timestamp = last_timestamp
+            cursor.last_id   = last_id
+            cursor.save()
+        stats["orders"] += len(orders)
+        if on_progress:
+            on_progress(stats)
+
+def rebuild_sales_rollups(chunk_size = 1000, on_progress = None):
+    """Drop the rollups and aggregate every paid order again, chunk by chunk."""
+    with transaction.atomic():
+        RollupCursor.objects.filter(name = SALES_CURSOR).delete()
+        HourlySales.objects.all().delete()
+        DailySales.objects.all().delete()
+    return rollup_sales(chunk_size, on_progress)
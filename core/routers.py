@@ -0,0 +1,148 @@
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+# read-mostly models a slightly stale copy is fine for
+REPLICA_MODELS = {"core.item", "core.orderline", "core.dailysales", "core.hourlysales"}
+
+# DatabaseCache entries: the shared version keys are read from the primary,
+# and caching a page is not a write of the user's
+CACHE_APP_LABEL = "django_cache"
+
+# commands and workers read the primary, ReplicaPinMiddleware unpins requests
+_pinned        = ContextVar("pinned_to_primary", default = True)
+_wrote         = ContextVar("wrote_to_primary", default = False)
+_replica_reads = ContextVar("replica_reads", default = False)
+_replica_used  = ContextVar("replica_used", default = None)
+_down_until    = {}
+
+
+def get_replicas():
+    return getattr(settings, "DATABASE_REPLICAS", [])
+
+def start_request(pinned):
+    """Fresh routing state for a request, `pinned` when the user wrote recently."""
+    return _pinned.set(pinned), _wrote.set(False), _replica_used.set(None)
+
+def finish_request(tokens):
+    pinned, wrote, replica_used = tokens
+    _pinned.reset(pinned)
+    _wrote.reset(wrote)
+    _replica_used.reset(replica_used)
+
+def wrote_to_primary():
+    return _wrote.get()
+
+def replica_used():
+    """The replica the last read of the request went to, None when none did."""
+    return _replica_used.get()
+
+@contextmanager
+def primary_reads():
+    """Route every read inside the block to the primary."""
+    pinned = _pinned.set(True)
+    wrote  = _wrote.set(False)
+    try:
+        yield
+    finally:
+        # a write inside the block keeps the pin for the rest of the request
+        if not _wrote.get():
+            _pinned.reset(pinned)
+            _wrote.reset(wrote)
+
+@contextmanager
+def replica_reads():
+    """Route every read inside the block to a replica, for reports that read any model."""
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+def use_primary(view):
+    """For views that write what they read, such as the cart's prices."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with primary_reads():
+            return view(*args, **kwargs)
+    return wrapper
+
+def mark_down(alias):
+    _down_until[alias] = time.monotonic() + getattr(settings, "REPLICA_RETRY_SECONDS", 30)
+
+def connect(alias):
+    connection = connections[alias]
+    if connection.vendor == "sqlite" and not connection.is_in_memory_db():
+        # connecting would create an empty database in place of a missing copy
+        if not os.path.isfile(connection.settings_dict["NAME"]):
+            raise DatabaseError(f"{connection.settings_dict['NAME']} does not exist")
+    # no round trip once the thread's connection is open
+    connection.ensure_connection()
+
+def healthy_replica():
+    """A random replica that accepts connections, None when all are down."""
+    replicas = [alias for alias in get_replicas() if _down_until.get(alias, 0) <= time.monotonic()]
+    random.shuffle(replicas)
+    for alias in replicas:
+        try:
+            connect(alias)
+        except DatabaseError:
+            logger.warning("Replica %s is unavailable, reading from the primary", alias, exc_info = True)
+            mark_down(alias)
+            continue
+        return alias
+    return None
+
+
+class ReplicaRouter:
+    """
+    Sends the reads of requests that touch REPLICA_MODELS, and every read
+    inside `replica_reads()`, to one of DATABASE_REPLICAS. Writes go to the
+    primary and pin the request to it, so a user reads their own writes; the
+    pin is carried over to their next requests by ReplicaPinMiddleware,
+    which also retries a request on the primary when a replica query fails.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not get_replicas() or _pinned.get() or model._meta.app_label == CACHE_APP_LABEL:
+            return None
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db == DEFAULT_DB_ALIAS:
+            # objects related to fresh rows are read from the primary too
+            return None
+        if model._meta.label_lower not in REPLICA_MODELS and not _replica_reads.get():
+            return None
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            # a transaction may already hold writes of its own
+            return None
+        alias = healthy_replica()
+        if alias is not None:
+            _replica_used.set(alias)
+        return alias
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != CACHE_APP_LABEL:
+            _pinned.set(True)
+            _wrote.set(True)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *get_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name = None, **hints):
+        # replicas are copies of the primary
+        if db in get_replicas():
+            return False
+        return None
@@ -0,0 +1,248 @@
+import logging
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import OperationalError, connection
+from django.db.models import Case, IntegerField, Q, When
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+SQLITE_TABLE   = "core_item_fts"
+POSTGRES_TABLE = "core_item_search"
+
+
+def sqlite_has_fts5(connection):
+    """Whether the SQLite library was built with the FTS5 extension."""
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE temp.core_fts5_probe USING fts5(probe)")
+        except OperationalError:
+            return False
+        cursor.execute("DROP TABLE temp.core_fts5_probe")
+    return True
+
+
+class BaseSearchBackend:
+    """Keeps a full-text index of Item titles and descriptions."""
+
+    def available(self):
+        return True
+
+    def index(self, items):
+        raise NotImplementedError
+
+    def remove(self, item_ids):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def search(self, query, offset, limit):
+        """Return the ids of the matching items, best match first."""
+        raise NotImplementedError
+
+    def count(self, query):
+        raise NotImplementedError
+
+    def rebuild(self, batch_size = 1000):
+        from .models import Item
+
+        self.clear()
+        total = 0
+        batch = []
+        for item in Item.objects.only("id", "title", "description").order_by("id").iterator(chunk_size = batch_size):
+            batch.append(item)
+            if len(batch) >= batch_size:
+                self.index(batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            self.index(batch)
+            total += len(batch)
+        return total
+
+
+class SqliteSearchBackend(BaseSearchBackend):
+    """SQLite FTS5 table ranked with bm25, the title weighs more than the description."""
+
+    def available(self):
+        return sqlite_has_fts5(connection)
+
+    def _match(self, query):
+        terms = re.findall(r"\w+", query or "")
+        return " ".join(f'"{term}"*' for term in terms)
+
+    def index(self, items):
+        rows = [(item.pk, item.title, item.description) for item in items]
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {SQLITE_TABLE} WHERE rowid = %s",
+                               [(row[0],) for row in rows])
+            cursor.executemany(f"INSERT INTO {SQLITE_TABLE} (rowid, title, description) VALUES (%s, %s, %s)",
+                               rows)
+
+    def remove(self, item_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {SQLITE_TABLE} WHERE rowid = %s",
+                               [(item_id,) for item_id in item_ids])
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SQLITE_TABLE}")
+
+    def search(self, query, offset, limit):
+        match = self._match(query)
+        if not match:
+            return []
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {SQLITE_TABLE} WHERE {SQLITE_TABLE} MATCH %s "
+                f"ORDER BY bm25({SQLITE_TABLE}, 10.0, 1.0), rowid DESC LIMIT %s OFFSET %s",
+                [match, limit, offset]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def count(self, query):
+        match = self._match(query)
+        if not match:
+            return 0
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*) FROM {SQLITE_TABLE} WHERE {SQLITE_TABLE} MATCH %s", [match])
+            return cursor.fetchone()[0]
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """tsvector documents in a side table with a GIN index, ranked with ts_rank."""
+
+    config   = "english"
+    document = ("setweight(to_tsvector(%(config)s, coalesce(title, '')), 'A') || "
+                "setweight(to_tsvector(%(config)s, coalesce(description, '')), 'B')")
+
+    def index(self, items):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {POSTGRES_TABLE} (item_id, document) "
+                f"SELECT id, {self.document} FROM core_item WHERE id = ANY(%(ids)s) "
+                f"ON CONFLICT (item_id) DO UPDATE SET document = EXCLUDED.document",
+                {"config": self.config, "ids": [item.pk for item in items]}
+            )
+
+    def remove(self, item_ids):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {POSTGRES_TABLE} WHERE item_id = ANY(%s)", [list(item_ids)])
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"TRUNCATE {POSTGRES_TABLE}")
+
+    def search(self, query, offset, limit):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT item_id FROM {POSTGRES_TABLE}, plainto_tsquery(%s, %s) query "
+                f"WHERE document @@ query "
+                f"ORDER BY ts_rank(document, query) DESC, item_id DESC LIMIT %s OFFSET %s",
+                [self.config, query, limit, offset]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def count(self, query):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT COUNT(*) FROM {POSTGRES_TABLE} WHERE document @@ plainto_tsquery(%s, %s)",
+                [self.config, query]
+            )
+            return cursor.fetchone()[0]
+
+
+class DatabaseSearchBackend(BaseSearchBackend):
+    """
+    LIKE matching on the item table, for SQLite builds without FTS5. There is
+    no index to keep; items with every term in the title rank first.
+    """
+
+    def _terms(self, query):
+        return re.findall(r"\w+", query or "")
+
+    def _matches(self, terms):
+        from .models import Item
+
+        items = Item.objects.all()
+        for term in terms:
+            items = items.filter(Q(title__icontains = term) | Q(description__icontains = term))
+        return items
+
+    def index(self, items):
+        pass
+
+    def remove(self, item_ids):
+        pass
+
+    def clear(self):
+        pass
+
+    def rebuild(self, batch_size = 1000):
+        from .models import Item
+
+        return Item.objects.count()
+
+    def search(self, query, offset, limit):
+        terms = self._terms(query)
+        if not terms:
+            return []
+        in_title = Q()
+        for term in terms:
+            in_title &= Q(title__icontains = term)
+        ranked = self._matches(terms).annotate(
+            rank = Case(When(in_title, then = 0), default = 1, output_field = IntegerField())
+        ).order_by("rank", "-id")
+        return list(ranked.values_list("id", flat = True)[offset:offset + limit])
+
+    def count(self, query):
+        terms = self._terms(query)
+        return self._matches(terms).count() if terms else 0
+
+
+@lru_cache(maxsize = None)
+def get_search_backend():
+    backend = import_string(settings.SEARCH_BACKEND)()
+    if not backend.available():
+        logger.warning("%s is not available, searching with LIKE", type(backend).__name__)
+        return DatabaseSearchBackend()
+    return backend
+
+
+class SearchResults:
+    """Lazy, sliceable result set that Django's Paginator can page through."""
+
+    def __init__(self, query, backend = None):
+        self.query   = query
+        self.backend = backend or get_search_backend()
+        self._count  = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.backend.count(self.query)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        from .models import Item
+
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        start = key.start or 0
+        stop  = self.count() if key.stop is None else key.stop
+        ids   = self.backend.search(self.query, start, max(stop - start, 0))
+        items = Item.objects.in_bulk(ids)
+        return [items[pk] for pk in ids if pk in items]
+
+
+def search_index_receiver(sender, instance, raw = False, *args, **kwargs):
+    if not raw:
+        get_search_backend().index([instance])
+
+def search_remove_receiver(sender, instance, *args, **kwargs):
+    get_search_backend().remove([instance.pk])
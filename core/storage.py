@@ -0,0 +1,83 @@
+import gzip
+import posixpath
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+try:
+    import brotli
+except ImportError:
+    # .br files are only written when the brotli package is installed
+    brotli = None
+
+COMPRESSIBLE = {".css", ".js", ".map", ".svg", ".txt", ".json", ".xml", ".html", ".ico", ".eot", ".ttf", ".otf"}
+
+
+def compressors():
+    yield ".gz", lambda content: gzip.compress(content, compresslevel = 9, mtime = 0)
+    if brotli is not None:
+        yield ".br", lambda content: brotli.compress(content, quality = 11)
+
+
+class CompressedFilesMixin:
+    """
+    Writes `.gz` (and `.br`) siblings of the text assets collectstatic
+    stores, through the storage API so remote backends get them too. A
+    variant is skipped when it saves less than 5%.
+    """
+    min_size = 256
+
+    def post_process(self, paths, dry_run = False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        hashed = set(getattr(self, "hashed_files", {}).values())
+        for name in sorted(set(paths) | hashed):
+            if posixpath.splitext(name)[1].lower() in COMPRESSIBLE:
+                self.compress(name, hashed = name in hashed and name not in paths)
+
+    def compress(self, name, hashed = False):
+        content = None
+        for suffix, compress in compressors():
+            if hashed and self.exists(name + suffix):
+                # hashed names never change content
+                continue
+            if content is None:
+                with self.open(name) as f:
+                    content = f.read()
+                if len(content) < self.min_size:
+                    return
+            compressed = compress(content)
+            if len(compressed) < len(content) * 0.95:
+                if self.exists(name + suffix):
+                    self.delete(name + suffix)
+                self.save(name + suffix, ContentFile(compressed))
+
+
+class LenientManifestMixin:
+    """
+    Unknown names fall back to the plain name instead of raising: before
+    collectstatic ran (development, tests), and for CSS references to files
+    that aren't shipped, such as mdb.min.css's img/ directory.
+    """
+    manifest_strict = False
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name
+
+    def url_converter(self, name, hashed_files, template = None):
+        converter = super().url_converter(name, hashed_files, template)
+
+        def convert(matchobj):
+            try:
+                return converter(matchobj)
+            except ValueError:
+                return matchobj.group(0)
+        return convert
+
+
+class CompressedManifestStaticFilesStorage(CompressedFilesMixin, LenientManifestMixin, ManifestStaticFilesStorage):
+    """Hashed names, a staticfiles.json manifest and precompressed variants under STATIC_ROOT."""
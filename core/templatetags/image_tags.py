@@ -0,0 +1,42 @@
+from django import template
+from django.utils.html import format_html, format_html_join
+
+from core.images import DERIVATIVE_FORMATS, DERIVATIVE_WIDTHS, derivative_name
+
+register = template.Library()
+
+SIZES = {
+    "card":   "(min-width: 992px) 25vw, (min-width: 768px) 50vw, 100vw",
+    "detail": "(min-width: 768px) 50vw, 100vw",
+}
+
+def srcset(storage, name, extension, largest):
+    widths = [(size, width) for size, width in DERIVATIVE_WIDTHS.items()
+              if width <= DERIVATIVE_WIDTHS[largest]]
+    return ", ".join(f"{storage.url(derivative_name(name, size, extension))} {width}w"
+                     for size, width in widths)
+
+@register.simple_tag
+def item_image(item, size = "card", css_class = "img-fluid"):
+    """<picture> with WebP and JPEG srcsets, the original until derivatives exist."""
+    image = item.image
+    if not image:
+        return ""
+    if image.name != item.image_derivatives:
+        return format_html('<img src="{}" class="{}" alt="{}" loading="lazy">',
+                           image.url, css_class, item.title)
+
+    sources = format_html_join(
+        "", '<source type="image/{}" srcset="{}" sizes="{}">',
+        ((extension, srcset(image.storage, image.name, extension, size), SIZES[size])
+         for extension in DERIVATIVE_FORMATS if extension != "jpg")
+    )
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" sizes="{}" class="{}" alt="{}" loading="lazy"></picture>',
+        sources,
+        image.storage.url(derivative_name(image.name, size, "jpg")),
+        srcset(image.storage, image.name, "jpg", size),
+        SIZES[size],
+        css_class,
+        item.title
+    )
@@ -1,3 +1,1309 @@
-from django.test import TestCase
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from io import BytesIO, StringIO
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs
 
-# Create your tests here.
+import stripe
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections
+from django.http import HttpResponse
+from django.template import Context, Template, engines
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import get_resolver, reverse
+from django.utils import timezone
+
+from . import benchmark, cart, images, metrics, payments, refunds, routers
+from .catalog import bump_catalog_version, cached_catalog_value, get_facet_counts
+from .checkout import CheckoutError, save_checkout
+from .coupons import CouponError, apply_coupon
+from .importer import CatalogImporter, resolve_image
+from .models import (Address, Coupon, CouponRedemption, DailySales, HourlySales, Item, Order, OrderItem, OrderLine,
+                     Payment, PaymentJob, Refund, UserProfile)
+from .middleware import CartMiddleware, ReplicaPinMiddleware
+from .pagination import EstimatedCountPaginator
+from .reporting import snapshot_order_lines
+from .search import DatabaseSearchBackend, get_search_backend
+
+User = get_user_model()
+
+
+def create_item(slug, price="10.00", discount_price=None):
+    return Item.objects.create(title=slug, price=Decimal(price), discount_price=discount_price,
+                               category="S", label="P", slug=slug, description=slug, image="x.jpg")
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append((self.path, {}, None))
+            status, body = self.server.respond(self.path.split("?")[0], {})
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode())
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        params = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+        key = self.headers.get("Idempotency-Key")
+        with self.server.lock:
+            self.server.requests.append((self.path, params, key))
+            if key in self.server.responses:
+                status, body = self.server.responses[key]
+            else:
+                status, body = self.server.respond(self.path, params)
+                # like Stripe, rate limited requests are not replayed
+                if status != 429:
+                    self.server.responses[key] = (status, body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeStripeServer(ThreadingHTTPServer):
+    """Minimal local stand-in for the Stripe API, replays idempotent requests."""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeStripeHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.responses = {}
+        self.rate_limited = 0
+        self.created = []
+        self.cards = []
+
+    def respond(self, path, params):
+        if self.rate_limited:
+            self.rate_limited -= 1
+            return 429, {"error": {"type": "rate_limit_error", "message": "Too many requests"}}
+        if path == "/v1/charges":
+            if params.get("source") == "tok_chargeDeclined":
+                return 402, {"error": {"type": "card_error", "code": "card_declined",
+                                       "message": "Your card was declined."}}
+            charge = {"id": f"ch_{len(self.created) + 1}", "object": "charge",
+                      "amount": int(params["amount"]), "status": "succeeded"}
+            self.created.append(charge)
+            return 200, charge
+        if path == "/v1/refunds":
+            if params["charge"] == "ch_refunded":
+                return 400, {"error": {"type": "invalid_request_error", "code": "charge_already_refunded",
+                                       "message": "Charge ch_refunded has already been refunded."}}
+            refund = {"id": f"re_{len(self.created) + 1}", "object": "refund",
+                      "charge": params["charge"], "status": "succeeded"}
+            self.created.append(refund)
+            return 200, refund
+        if path.startswith("/v1/customers/") and path.endswith("/sources"):
+            if params.get("source"):
+                card = {"id": f"card_{len(self.created) + 1}", "object": "card", "last4": "4242"}
+                self.created.append(card)
+                return 200, card
+            return 200, {"object": "list", "data": self.cards, "has_more": False}
+        return 404, {"error": {"type": "invalid_request_error", "message": f"Unknown path {path}"}}
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        self.previous_api_base = stripe.api_base
+        stripe.api_base = "http://%s:%s" % self.server_address
+        return self
+
+    def __exit__(self, *exc_info):
+        stripe.api_base = self.previous_api_base
+        self.shutdown()
+        self.server_close()
+
+
+class QueryBudgetMixin:
+    TRANSACTION_STATEMENTS = ("BEGIN", "SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+
+    def assertQueryBudget(self, budget, func, *args, **kwargs):
+        with CaptureQueriesContext(connection) as context:
+            result = func(*args, **kwargs)
+        queries = [query["sql"] for query in context.captured_queries
+                   if not query["sql"].startswith(self.TRANSACTION_STATEMENTS)]
+        self.assertEqual(len(queries), budget, "\n".join(queries))
+        return result
+
+
+class CartServiceTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("shopper", password="pw")
+        self.shirt = create_item("shirt", "10.00", Decimal("8.00"))
+        self.hoodie = create_item("hoodie", "25.00")
+
+    def get_order(self):
+        return Order.objects.get(user=self.user, ordered=False)
+
+    def assertTotals(self, order, subtotal, discount, total):
+        self.assertEqual((order.subtotal, order.discount_total, order.total),
+                         (Decimal(subtotal), Decimal(discount), Decimal(total)))
+
+    def test_add_update_and_remove(self):
+        self.assertEqual(cart.add_item(self.user, self.shirt), cart.ADDED)
+        self.assertEqual(cart.add_item(self.user, self.shirt, order=cart.load_cart(self.user)), cart.UPDATED)
+        self.assertEqual(cart.add_item(self.user, self.hoodie, order=cart.load_cart(self.user)), cart.ADDED)
+        order = self.get_order()
+        self.assertTotals(order, "45.00", "4.00", "41.00")
+        self.assertEqual(OrderItem.objects.get(item=self.shirt).line_total, Decimal("16.00"))
+
+        self.assertEqual(cart.remove_single_item(self.user, self.shirt, order), cart.UPDATED)
+        self.assertEqual(cart.remove_single_item(self.user, self.shirt, order), cart.REMOVED)
+        self.assertEqual(cart.remove_single_item(self.user, self.shirt, order), cart.NOT_IN_CART)
+        self.assertTotals(self.get_order(), "25.00", "0.00", "25.00")
+
+        self.assertEqual(cart.remove_item(self.user, self.hoodie, order), cart.REMOVED)
+        self.assertTotals(self.get_order(), "0.00", "0.00", "0.00")
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_query_budget(self):
+        self.assertQueryBudget(4, cart.add_item, self.user, self.shirt)
+        order = cart.load_cart(self.user)
+        self.assertQueryBudget(3, cart.add_item, self.user, self.hoodie, order=order)
+        order = cart.load_cart(self.user)
+        self.assertQueryBudget(2, cart.add_item, self.user, self.shirt, order=order)
+        self.assertQueryBudget(2, cart.remove_single_item, self.user, self.shirt, order)
+        self.assertQueryBudget(5, cart.remove_single_item, self.user, self.shirt, order)
+        self.assertQueryBudget(4, cart.remove_item, self.user, self.hoodie, order)
+
+
+class LazyCartTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("shopper", password="pw")
+        cart.add_item(self.user, create_item("shirt", "10.00"))
+        self.request = RequestFactory().get("/")
+        self.request.user = self.user
+
+    def test_untouched_cart_runs_no_query(self):
+        with self.assertNumQueries(0):
+            CartMiddleware(lambda request: HttpResponse())(self.request)
+
+    def test_cart_is_loaded_once(self):
+        def view(request):
+            lines = [len(request.cart.items.all()) for _ in range(3)]
+            return HttpResponse(str(lines))
+
+        # the open order and its prefetched lines
+        with self.assertNumQueries(2):
+            response = CartMiddleware(view)(self.request)
+        self.assertEqual(response.content, b"[1, 1, 1]")
+
+
+class OrderTotalsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("shopper", password="pw")
+        self.shirt = create_item("shirt", "10.00", Decimal("8.00"))
+        self.hoodie = create_item("hoodie", "25.00")
+
+    def assertInSync(self):
+        order = Order.objects.get(user=self.user, ordered=False)
+        stored = {field: getattr(order, field) for field in ("subtotal", "discount_total", "coupon_amount", "total")}
+        self.assertEqual(stored, order.calculate_totals())
+        return order
+
+    def test_cart_changes_keep_totals_in_sync(self):
+        Coupon.objects.create(code="SPRING", amount=Decimal("5.00"))
+        cart.add_item(self.user, self.shirt)
+        cart.add_item(self.user, self.hoodie, order=cart.load_cart(self.user))
+        self.assertInSync()
+        apply_coupon(cart.load_cart(self.user), self.user, "SPRING")
+        self.assertEqual(self.assertInSync().total, Decimal("28.00"))
+        cart.add_item(self.user, self.shirt, order=cart.load_cart(self.user))
+        self.assertInSync()
+        cart.remove_single_item(self.user, self.shirt, cart.load_cart(self.user))
+        cart.remove_item(self.user, self.hoodie, cart.load_cart(self.user))
+        self.assertEqual(self.assertInSync().total, Decimal("3.00"))
+
+        self.shirt.discount_price = None
+        self.shirt.save()
+        self.assertEqual(self.assertInSync().total, Decimal("5.00"))
+
+    def test_only_price_changes_reprice_carts(self):
+        cart.add_item(self.user, self.shirt)
+        with mock.patch("core.models.reprice_open_order_items") as reprice:
+            self.shirt.title = "Striped shirt"
+            self.shirt.save()
+            self.shirt.price = Decimal("10.00")
+            self.shirt.save()
+            self.assertFalse(reprice.called)
+            self.shirt.discount_price = Decimal("7.00")
+            self.shirt.save()
+            self.assertEqual(reprice.call_count, 1)
+
+    def test_check_order_totals_reports_and_fixes_drift(self):
+        cart.add_item(self.user, self.shirt, quantity=2)
+        order = self.assertInSync()
+        # writes that bypass the cart services and receivers
+        OrderItem.objects.update(line_total=Decimal("1.00"))
+        Order.objects.filter(pk=order.pk).update(total=Decimal("99.00"))
+
+        out = StringIO()
+        call_command("check_order_totals", stdout=out)
+        self.assertIn(f"Order {order.pk}: stored", out.getvalue())
+        self.assertIn("Found 1 order item(s) and 1 order(s) with drifted totals", out.getvalue())
+        self.assertEqual(Order.objects.get(pk=order.pk).total, Decimal("99.00"))
+
+        call_command("check_order_totals", "--fix", stdout=StringIO())
+        self.assertEqual(OrderItem.objects.get().line_total, Decimal("16.00"))
+        self.assertEqual(self.assertInSync().total, Decimal("16.00"))
+        out = StringIO()
+        call_command("check_order_totals", stdout=out)
+        self.assertIn("Found 0 order item(s) and 0 order(s)", out.getvalue())
+
+    def test_paid_orders_are_only_reported(self):
+        cart.add_item(self.user, self.shirt, quantity=2)
+        order = self.assertInSync()
+        payment = Payment.objects.create(stripe_charge_id="ch", amount=Decimal("15.00"), user=self.user)
+        order.items.update(ordered=True)
+        Order.objects.filter(pk=order.pk).update(ordered=True, payment=payment)
+        # repriced after the payment
+        Item.objects.filter(pk=self.shirt.pk).update(discount_price=Decimal("5.00"))
+
+        out = StringIO()
+        call_command("check_order_totals", "--all", "--fix", stdout=out)
+        self.assertIn(f"Paid order {order.pk}: total 16.00, charged 15.00", out.getvalue())
+        self.assertIn("Repaired 0 order item(s) and 0 order(s)", out.getvalue())
+        self.assertEqual(Order.objects.get(pk=order.pk).total, Decimal("16.00"))
+        self.assertEqual(OrderItem.objects.get().line_total, Decimal("16.00"))
+
+
+class CartConcurrencyTests(TransactionTestCase):
+    threads = 8
+    clicks = 10
+
+    def test_concurrent_adds_lose_no_update(self):
+        user = User.objects.create_user("clicker", password="pw")
+        item = create_item("shirt", "10.00")
+        done = []
+        errors = []
+
+        def click():
+            try:
+                for _ in range(self.clicks):
+                    while True:
+                        try:
+                            cart.add_item(user, item)
+                            break
+                        except OperationalError:
+                            # SQLite reports lock contention, the click is retried
+                            continue
+                    done.append(1)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=click) for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        clicks = self.threads * self.clicks
+        order = Order.objects.get(user=user, ordered=False)
+        line = order.items.get()
+        self.assertEqual(line.quantity, clicks)
+        self.assertEqual(line.line_total, clicks * Decimal("10.00"))
+        self.assertEqual(order.total, clicks * Decimal("10.00"))
+
+
+@override_settings(PAYMENT_JOBS_EAGER=False)
+class PaymentJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("payer", password="pw")
+        self.client.login(username="payer", password="pw")
+        cart.add_item(self.user, create_item("shirt", "12.50"), quantity=2)
+        self.order = Order.objects.get(user=self.user, ordered=False)
+
+    def pay(self, token="tok_visa"):
+        response = self.client.post("/payment/stripe/", {"stripeToken": token})
+        return PaymentJob.objects.get(idempotency_key=response.url.split("/")[-2])
+
+    def status(self, job):
+        return self.client.get(f"/payment/status/{job.idempotency_key}/", {"format": "json"}).json()
+
+    def test_charge_in_background(self):
+        with FakeStripeServer() as server:
+            job = self.pay()
+            self.assertEqual(self.pay(), job)
+            self.assertEqual(self.status(job), {"status": "pending"})
+            self.assertEqual(server.requests, [])
+
+            call_command("process_payments", "--once", stdout=StringIO())
+
+        self.assertEqual(self.status(job), {"status": "succeeded", "redirect": "/"})
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.ordered)
+        self.assertEqual(self.order.payment.amount, Decimal("25.00"))
+        self.assertTrue(self.order.items.get().ordered)
+        self.assertEqual(list(self.order.lines.values_list("title", "quantity", "price", "line_total", "currency")),
+                         [("shirt", 2, Decimal("12.50"), Decimal("25.00"), "eur")])
+        self.assertEqual(server.requests[0][1]["amount"], "2500")
+        self.assertEqual(server.requests[0][2], job.idempotency_key)
+
+    def test_reclaimed_job_is_finalized_once(self):
+        with FakeStripeServer():
+            job = self.pay()
+            self.assertTrue(payments.claim_job(job))
+            # a second worker reclaims the stale job, Stripe replays the charge to both
+            PaymentJob.objects.filter(pk=job.pk).update(updated=timezone.now() - timezone.timedelta(hours=1))
+            reclaimed = payments.claim_next_job()
+            charges = [payments.charge_order(job), payments.charge_order(reclaimed)]
+        self.assertEqual(charges[0]["id"], charges[1]["id"])
+
+        first = payments.finalize_order(reclaimed, charges[1])
+        ref_code = Order.objects.get(pk=self.order.pk).ref_code
+        self.assertEqual(payments.finalize_order(job, charges[0]), first)
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(OrderLine.objects.count(), 1)
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertEqual((order.payment, order.ref_code), (first, ref_code))
+        self.assertEqual(PaymentJob.objects.get(pk=job.pk).payment, first)
+
+    def test_retry_reuses_idempotency_key(self):
+        with FakeStripeServer() as server:
+            server.rate_limited = 1
+            job = self.pay()
+            payments.run_job(payments.claim_next_job())
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), (PaymentJob.PENDING, 1))
+
+            PaymentJob.objects.filter(pk=job.pk).update(run_after=job.created)
+            payments.run_job(payments.claim_next_job())
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (PaymentJob.SUCCEEDED, 2))
+        self.assertEqual([request[2] for request in server.requests], [job.idempotency_key] * 2)
+        self.assertEqual(len(server.created), 1)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_declined_card(self):
+        with FakeStripeServer():
+            job = self.pay("tok_chargeDeclined")
+            payments.run_job(payments.claim_next_job())
+
+        self.assertEqual(self.status(job)["status"], "failed")
+        job.refresh_from_db()
+        self.assertEqual(job.error, "Your card was declined.")
+        self.assertFalse(Order.objects.get(pk=self.order.pk).ordered)
+        # a new attempt gets a new job and key
+        self.assertNotEqual(self.pay(), job)
+
+    def test_saved_card_is_charged(self):
+        UserProfile.objects.filter(user=self.user).update(stripe_customer_id="cus_1")
+        with FakeStripeServer() as server:
+            response = self.client.post("/payment/stripe/", {"stripeToken": "tok_new", "save": "on"})
+            job = PaymentJob.objects.get(idempotency_key=response.url.split("/")[-2])
+            payments.run_job(payments.claim_next_job())
+
+        self.assertEqual(server.requests[0][1], {"source": "tok_new"})
+        charge = server.requests[1][1]
+        self.assertEqual((charge["customer"], charge["source"]), ("cus_1", server.created[0]["id"]))
+        job.refresh_from_db()
+        self.assertEqual(job.status, PaymentJob.SUCCEEDED)
+
+    def test_cart_is_locked_while_paying(self):
+        Coupon.objects.create(code="SPRING", amount=Decimal("5.00"))
+        item = Item.objects.get(slug="shirt")
+        created = self.order.ordered_date
+        job = self.pay()
+        with self.assertRaises(cart.CartLocked):
+            cart.add_item(self.user, item, order=cart.load_cart(self.user))
+        with self.assertRaisesMessage(CouponError, "being paid"):
+            apply_coupon(cart.load_cart(self.user), self.user, "SPRING")
+        self.assertEqual(Order.objects.get(pk=self.order.pk).total, job.amount)
+
+        with FakeStripeServer():
+            payments.run_job(payments.claim_next_job())
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertTrue(order.ordered)
+        self.assertGreater(order.ordered_date, created)
+
+    def test_repriced_order_is_not_charged(self):
+        job = self.pay()
+        item = Item.objects.get(slug="shirt")
+        item.price = Decimal("15.00")
+        item.save()
+        with FakeStripeServer() as server:
+            payments.run_job(payments.claim_next_job())
+
+        self.assertEqual(server.requests, [])
+        job.refresh_from_db()
+        self.assertEqual(job.status, PaymentJob.FAILED)
+        self.assertIn("changed", job.error)
+
+
+def make_card(last4):
+    return {"id": f"card_{last4}", "object": "card", "brand": "Visa",
+            "last4": last4, "exp_month": 12, "exp_year": 2030}
+
+
+class CardCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def card_requests(self, stripe_server):
+        return [path for path, _, _ in stripe_server.requests if path.startswith("/v1/customers/")]
+
+    def test_cached_until_invalidated(self):
+        with FakeStripeServer() as stripe_server:
+            stripe_server.cards = [make_card("4242")]
+            self.assertEqual(payments.get_default_card("cus_1")["last4"], "4242")
+            self.assertEqual(payments.get_default_card("cus_1")["last4"], "4242")
+            self.assertEqual(len(self.card_requests(stripe_server)), 1)
+
+            stripe_server.cards = [make_card("1881")]
+            payments.invalidate_default_card("cus_1")
+            self.assertEqual(payments.get_default_card("cus_1")["last4"], "1881")
+            self.assertEqual(len(self.card_requests(stripe_server)), 2)
+
+    @override_settings(STRIPE_CARD_CACHE_TTL=0)
+    def test_stale_card_served_while_refreshing(self):
+        with FakeStripeServer() as stripe_server:
+            stripe_server.cards = [make_card("4242")]
+            payments.get_default_card("cus_1")
+            stripe_server.cards = [make_card("1881")]
+            # stale entry is returned right away, the refresh runs in the background
+            self.assertEqual(payments.get_default_card("cus_1")["last4"], "4242")
+            for _ in range(50):
+                if cache.get("stripe:cards:cus_1")[1]["last4"] == "1881":
+                    break
+                time.sleep(0.05)
+            self.assertEqual(cache.get("stripe:cards:cus_1")[1]["last4"], "1881")
+
+
+class ImageDerivativeTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_derivatives_generated_on_save(self):
+        from PIL import Image
+
+        buffer = BytesIO()
+        Image.new("RGB", (1600, 1200), "red").save(buffer, "PNG")
+        item = create_item("shirt")
+        item.image = SimpleUploadedFile("shirt.png", buffer.getvalue())
+        item.save()
+
+        item.refresh_from_db()
+        self.assertEqual(item.image_derivatives, item.image.name)
+        with item.image.storage.open(images.derivative_name(item.image.name, "card", "webp")) as card:
+            self.assertEqual(Image.open(card).size, (400, 300))
+
+        html = Template('{% load image_tags %}{% item_image item "card" %}').render(Context({"item": item}))
+        self.assertIn('type="image/webp"', html)
+        self.assertIn("shirt.png.card.jpg 400w", html)
+        self.assertNotIn("shirt.detail", html)
+        self.assertNotEqual(images.derivative_name("items/shirt.png", "card", "webp"),
+                            images.derivative_name("items/shirt.jpg", "card", "webp"))
+
+    def test_derivatives_deleted_with_the_image(self):
+        from PIL import Image
+
+        def upload(name, color):
+            buffer = BytesIO()
+            Image.new("RGB", (800, 600), color).save(buffer, "PNG")
+            return SimpleUploadedFile(name, buffer.getvalue())
+
+        shirt, coat = create_item("shirt"), create_item("coat")
+        shirt.image = upload("shirt.png", "red")
+        shirt.save()
+        old = shirt.image.name
+        # a second item showing the same stored image
+        coat.image = old
+        coat.save()
+        storage = shirt.image.storage
+
+        shirt.image = upload("shirt-blue.png", "blue")
+        shirt.save()
+        self.assertTrue(all(storage.exists(name) for name in images.derivative_names(old)))
+        self.assertTrue(all(storage.exists(name) for name in images.derivative_names(shirt.image.name)))
+
+        coat.delete()
+        self.assertFalse(any(storage.exists(name) for name in images.derivative_names(old)))
+        blue = shirt.image.name
+        shirt.image = ""
+        shirt.save()
+        self.assertFalse(any(storage.exists(name) for name in images.derivative_names(blue)))
+        self.assertEqual(Item.objects.get(pk=shirt.pk).image_derivatives, "")
+
+
+class CatalogImporterTests(TestCase):
+    def test_upsert_on_slug(self):
+        user = User.objects.create_user("shopper", password="pw")
+        shirt = create_item("shirt", "10.00")
+        cart.add_item(user, shirt, quantity=2)
+        rows = [
+            {"slug": "shirt", "title": "Shirt", "price": "12.00", "category": "Shirt", "label": "primary"},
+            {"title": "Blue hoodie", "price": "30", "category": "OW", "label": "S"},
+            {"title": "Blue hoodie", "price": "35", "category": "OW", "label": "S"},
+            {"title": "No price", "category": "S", "label": "P"},
+        ]
+
+        errors = []
+        stats = CatalogImporter(batch_size=2, on_error=lambda row, message: errors.append(row)).run(iter(rows))
+        self.assertEqual(stats, {"rows": 4, "created": 2, "updated": 1, "unchanged": 0, "skipped": 1})
+        self.assertEqual(errors, [4])
+        self.assertEqual(sorted(Item.objects.values_list("slug", flat=True)),
+                         ["blue-hoodie", "blue-hoodie-2", "shirt"])
+        self.assertEqual(Order.objects.get(user=user).total, Decimal("24.00"))
+        self.assertEqual(Item.objects.get(slug="shirt").image, "x.jpg")
+
+        stats = CatalogImporter().run(iter(rows[:1]))
+        self.assertEqual((stats["updated"], stats["unchanged"]), (0, 1))
+
+    def test_image_names_follow_the_content(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        with override_settings(MEDIA_ROOT=os.path.join(media_root.name, "media")):
+            for folder, content in [("a", b"red"), ("b", b"blue")]:
+                os.makedirs(os.path.join(media_root.name, folder))
+                with open(os.path.join(media_root.name, folder, "shirt.png"), "wb") as f:
+                    f.write(content)
+            red = resolve_image("a/shirt.png", "red", media_root.name)
+            blue = resolve_image("b/shirt.png", "blue", media_root.name)
+            self.assertNotEqual(red, blue)
+            self.assertEqual(resolve_image("a/shirt.png", "red", media_root.name), red)
+
+            with mock.patch("requests.get") as get:
+                get.return_value.content = b"v1"
+                first = resolve_image("https://cdn.example.com/shirt.png", "shirt")
+                self.assertEqual(resolve_image("https://cdn.example.com/shirt.png", "shirt"), first)
+                self.assertEqual(get.call_count, 1)
+                second = resolve_image("https://cdn.example.com/shirt-v2.png", "shirt")
+                self.assertEqual(get.call_count, 2)
+            self.assertNotEqual(first, second)
+            self.assertTrue(first.startswith("items/shirt-") and first.endswith(".png"))
+
+
+class FacetTests(TestCase):
+    def setUp(self):
+        for slug, category, label in [("a", "S", "P"), ("b", "S", "P"), ("c", "SW", "P"), ("d", "OW", "D")]:
+            Item.objects.filter(pk=create_item(slug).pk).update(category=category, label=label)
+        bump_catalog_version()
+
+    def counts(self, response, facet):
+        return {facet["value"]: facet["count"] for facet in response.context[f"{facet}_facets"]}
+
+    def test_counts_follow_the_other_facet(self):
+        self.assertEqual(sorted(get_facet_counts()), [("OW", "D", 1), ("S", "P", 2), ("SW", "P", 1)])
+
+        response = self.client.get("/", {"category": "S"})
+        self.assertEqual({item.slug for item in response.context["object_list"]}, {"a", "b"})
+        self.assertEqual(self.counts(response, "category"), {"S": 2, "SW": 1, "OW": 1})
+        self.assertEqual(self.counts(response, "label"), {"P": 2, "S": 0, "D": 0})
+
+        response = self.client.get("/", {"label": "P"})
+        self.assertEqual(self.counts(response, "category"), {"S": 2, "SW": 1, "OW": 0})
+        self.assertEqual(len(response.context["object_list"]), 3)
+        self.assertContains(response, "Danger")
+
+    def test_filters_combine_and_unknown_values_are_ignored(self):
+        response = self.client.get("/", {"category": "OW", "label": "D"})
+        self.assertEqual([item.slug for item in response.context["object_list"]], ["d"])
+        self.assertEqual(len(self.client.get("/", {"category": "S", "label": "D"}).context["object_list"]), 0)
+        response = self.client.get("/", {"category": "XX"})
+        self.assertEqual(response.context["filters"], {})
+        self.assertEqual(len(response.context["object_list"]), 4)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        # same title and price everywhere, the pk alone orders the pages
+        items = [Item.objects.create(title="Tee", price=Decimal("10.00"), category="S", label="P",
+                                     slug=f"tee-{n}", description="Tee", image="x.jpg") for n in range(25)]
+        Item.objects.filter(pk=items[12].pk).delete()
+        self.ids = sorted((item.pk for item in items if item is not items[12]), reverse=True)
+
+    def page(self, **cursor):
+        page = self.client.get("/", cursor).context["page_obj"]
+        self.assertTrue(page.is_keyset)
+        return page
+
+    def test_walks_forward_and_back_over_every_item_once(self):
+        first = self.page(after="")
+        self.assertEqual([item.pk for item in first], self.ids[:10])
+        self.assertFalse(first.has_previous())
+        self.assertEqual(first.next_after, self.ids[9])
+
+        second = self.page(after=first.next_after)
+        self.assertEqual([item.pk for item in second], self.ids[10:20])
+        self.assertEqual(second.previous_before, self.ids[10])
+
+        last = self.page(after=second.next_after)
+        self.assertEqual([item.pk for item in last], self.ids[20:])
+        self.assertFalse(last.has_next())
+
+        back = self.page(before=last.previous_before)
+        self.assertEqual([item.pk for item in back], self.ids[10:20])
+        self.assertEqual(back.next_after, self.ids[19])
+        top = self.page(before=back.previous_before)
+        self.assertEqual([item.pk for item in top], self.ids[:10])
+        self.assertFalse(top.has_previous())
+        self.assertEqual(top.next_after, self.ids[9])
+
+    def test_edges(self):
+        self.assertEqual(len(self.page(after=self.ids[-1])), 0)
+        self.assertFalse(self.page(after=self.ids[-1]).has_next())
+        self.assertEqual([item.pk for item in self.page(before=self.ids[0])], [])
+        # a cursor sitting on the deleted row still splits the listing in two
+        gap = self.ids[11] - 1
+        self.assertEqual([item.pk for item in self.page(after=gap)][0], self.ids[12])
+        self.assertEqual([item.pk for item in self.page(before=gap)][-1], self.ids[11])
+        self.assertEqual(self.client.get("/", {"after": "x"}).status_code, 404)
+
+    def test_follows_the_filters(self):
+        Item.objects.filter(pk__in=self.ids[::2]).update(category="SW")
+        page = self.page(category="SW", after=self.ids[0])
+        self.assertEqual([item.pk for item in page], self.ids[2:22:2])
+        self.assertEqual(page.previous_before, self.ids[2])
+        self.assertEqual([item.pk for item in self.page(category="SW", after=page.next_after)], self.ids[22::2])
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.shirt = self.create("shirt", "Red shirt", "Cotton")
+        self.coat = self.create("coat", "Blue coat", "Looks good with a red shirt")
+        self.hat = self.create("hat", "Green hat", "Wool")
+
+    def create(self, slug, title, description):
+        item = create_item(slug)
+        item.title = title
+        item.description = description
+        item.save()
+        return item
+
+    def test_title_matches_rank_first(self):
+        for backend in (get_search_backend(), DatabaseSearchBackend()):
+            with self.subTest(type(backend).__name__):
+                self.assertEqual(backend.search("shir", 0, 10), [self.shirt.pk, self.coat.pk])
+                self.assertEqual(backend.search("red shirt", 1, 10), [self.coat.pk])
+                self.assertEqual(backend.count("shirt"), 2)
+                self.assertEqual(backend.search("", 0, 10), [])
+        response = self.client.get("/search/", {"q": "shirt"})
+        self.assertEqual(list(response.context["object_list"]), [self.shirt, self.coat])
+
+    def test_falls_back_without_fts5(self):
+        self.addCleanup(get_search_backend.cache_clear)
+        get_search_backend.cache_clear()
+        with mock.patch("core.search.sqlite_has_fts5", return_value=False), self.assertLogs("core.search", "WARNING"):
+            backend = get_search_backend()
+        self.assertIsInstance(backend, DatabaseSearchBackend)
+        self.assertEqual(backend.search("wool", 0, 10), [self.hat.pk])
+
+    def test_rebuild_reindexes_edited_items(self):
+        # a bulk update skips the index receivers
+        Item.objects.filter(pk=self.hat.pk).update(title="Red scarf")
+        self.assertEqual(get_search_backend().search("scarf", 0, 10), [])
+        call_command("rebuild_search_index", stdout=StringIO())
+        self.assertEqual(get_search_backend().search("scarf", 0, 10), [self.hat.pk])
+        # both title matches rank above the description match
+        self.assertEqual(get_search_backend().search("red", 0, 10)[2], self.coat.pk)
+
+
+# the payment scenario measures the request, not the charge
+@override_settings(PAYMENT_JOBS_EAGER=False)
+class ViewBenchmarkTests(TestCase):
+    """
+    Query budgets of every core route against a synthetic dataset, sized with
+    BENCHMARK_ITEMS / BENCHMARK_CART_LINES / BENCHMARK_ORDERS, and home page
+    render times. Results are written as JSON to BENCHMARK_OUTPUT when set,
+    timings are not asserted.
+    """
+
+    def test_query_budgets(self):
+        sizes = {
+            "items": int(os.getenv("BENCHMARK_ITEMS", 100)),
+            "cart_lines": int(os.getenv("BENCHMARK_CART_LINES", 3)),
+            "orders": int(os.getenv("BENCHMARK_ORDERS", 2)),
+        }
+        dataset = benchmark.seed_dataset(**sizes)
+        scenarios = benchmark.view_scenarios(dataset)
+        budgets = benchmark.load_query_budgets()
+        self.assertEqual({url_name for _, url_name, _, _, _ in scenarios},
+                         {name for name in get_resolver("core.urls").reverse_dict if isinstance(name, str)})
+
+        self.client.force_login(dataset["users"][0])
+        # the backend probes the database once per process, not per request
+        get_search_backend()
+        results = {}
+        for name, _, method, path, data in scenarios:
+            # every request starts from a cold catalog cache
+            cache.clear()
+            results[name] = benchmark.measure_request(self.client, method, path, data)
+            with self.subTest(name):
+                self.assertLess(results[name]["status"], 400)
+                self.assertLessEqual(results[name]["queries"], budgets[name])
+
+        # wall times are only recorded, the warm render must be served by the card fragments
+        render = benchmark.render_timings()
+        self.assertEqual(set(render), {"uncached_loader", "cold_fragments", "warm_fragments"})
+        context = {"object_list": list(Item.objects.order_by("-id")[:10])}
+        with mock.patch.object(benchmark.fragment_cache(), "set") as stored:
+            benchmark.time_render(engines["django"], "home.html", context, repeat=1)
+        self.assertFalse(stored.called)
+        with mock.patch.object(benchmark.fragment_cache(), "set") as stored:
+            benchmark.time_render(engines["django"], "home.html", context, repeat=1, cold_fragments=True)
+        self.assertEqual(stored.call_count, 10)
+
+        if os.getenv("BENCHMARK_OUTPUT"):
+            benchmark.write_results(results, os.environ["BENCHMARK_OUTPUT"], dataset=sizes,
+                                    vendor=connection.vendor, render=render)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics.registry.reset()
+        cache.clear()
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_route_metrics(self):
+        create_item("shirt")
+        self.client.get("/")
+        self.client.get("/product/shirt/")
+        with FakeStripeServer() as stripe_server:
+            stripe_server.cards = [make_card("4242")]
+            payments.get_default_card("cus_1")
+
+        self.assertEqual(self.client.get("/metrics/").status_code, 403)
+        body = self.client.get("/metrics/", HTTP_AUTHORIZATION="Bearer secret").content.decode()
+        self.assertIn('http_requests_total{route="core:home",method="GET",status="200"} 1', body)
+        self.assertIn('http_request_duration_seconds_count{route="core:product"} 1', body)
+        self.assertIn('stripe_requests_total{route="background"} 1', body)
+        self.assertRegex(body, r'db_queries_total\{route="core:home"\} [1-9]')
+
+    @override_settings(METRICS_SLOW_QUERIES=2)
+    def test_slow_query_log(self):
+        with self.assertLogs("core.metrics", "WARNING") as logs:
+            self.client.get("/")
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn(" at core/", logs.output[0])
+
+    def test_call_site_skips_a_virtualenv_in_the_project(self):
+        library = os.path.join(settings.BASE_DIR, "env", "lib", "python3", "site-packages", "django", "query.py")
+        namespace = {"execute": lambda: metrics.call_site()}
+        exec(compile("def query():\n    return execute()\n", library, "exec"), namespace)
+        self.assertTrue(namespace["query"]().startswith(os.path.join("core", "tests.py:")))
+
+
+class HotQueryIndexTests(TestCase):
+    def test_hot_queries_use_an_index(self):
+        for name, queryset in benchmark.hot_queries().items():
+            with self.subTest(name):
+                indexed, plan = benchmark.explain(queryset)
+                self.assertTrue(indexed, plan)
+
+
+class AnonymousCartTests(TestCase):
+    def test_cookie_cart_merged_on_login(self):
+        user = User.objects.create_user("shopper", "shopper@example.com", "pw")
+        shirt = create_item("shirt", "10.00", Decimal("8.00"))
+        hoodie = create_item("hoodie", "25.00")
+        cart.add_item(user, shirt)
+
+        self.client.get(shirt.get_add_to_cart_url())
+        self.client.get(shirt.get_add_to_cart_url())
+        self.client.get(hoodie.get_add_to_cart_url())
+        self.assertFalse(Order.objects.filter(user=None).exists())
+        self.assertEqual(OrderItem.objects.count(), 1)
+        response = self.client.get("/order-summary/")
+        self.assertEqual(response.context["object"].total, Decimal("41.00"))
+
+        response = self.client.post(reverse("account_login"), {"login": "shopper", "password": "pw"})
+        self.assertEqual(response.cookies[cart.ANONYMOUS_CART_COOKIE].value, "")
+        order = Order.objects.get(user=user, ordered=False)
+        self.assertEqual(sorted(order.items.values_list("item__slug", "quantity")), [("hoodie", 1), ("shirt", 3)])
+        self.assertEqual(order.total, Decimal("49.00"))
+
+
+class AdminTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser("admin", "admin@example.com", "pw")
+        self.client.force_login(self.admin)
+        self.coupon = Coupon.objects.create(code="SAVE", amount=Decimal("2.00"))
+        self.shirt = create_item("shirt", "10.00")
+
+    def create_paid_orders(self, count):
+        for n in range(count):
+            user = User.objects.create_user(f"buyer-{Order.objects.count()}")
+            address = Address.objects.create(user=user, street_address="1 street", apartment_address="",
+                                             country="FR", postal_code="1", address_type="S")
+            cart.add_item(user, self.shirt, quantity=2)
+            order = Order.objects.get(user=user, ordered=False)
+            order.coupon = self.coupon
+            order.save()
+            payment = Payment.objects.create(stripe_charge_id="ch", amount=order.total, user=user)
+            order.items.update(ordered=True)
+            Order.objects.filter(pk=order.pk).update(ordered=True, payment=payment, shipping_address=address,
+                                                     billing_address=address, ordered_date=timezone.now())
+            snapshot_order_lines([order.pk])
+
+    def changelist_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.client.get("/admin/core/order/").status_code, 200)
+        return len(context.captured_queries)
+
+    def test_order_changelist_query_count_is_flat(self):
+        self.create_paid_orders(2)
+        few = self.changelist_queries()
+        self.create_paid_orders(8)
+        self.assertEqual(self.changelist_queries(), few)
+
+    def test_sales_overview(self):
+        self.create_paid_orders(3)
+        # repricing doesn't rewrite history
+        self.shirt.price = Decimal("99.00")
+        self.shirt.save()
+        response = self.client.get("/admin/core/order/sales/")
+        self.assertEqual(response.context["totals"]["revenue"], Decimal("54.00"))
+        self.assertEqual(list(response.context["top_items"]),
+                         [{"title": "shirt", "quantity": 6, "revenue": Decimal("60.00")}])
+
+    def test_sales_overview_months(self):
+        self.create_paid_orders(4)
+        this_month = timezone.localdate().replace(day=1)
+        two_months_ago = (this_month - timezone.timedelta(days=40)).replace(day=15)
+        payments = list(Payment.objects.order_by("pk"))
+        Payment.objects.filter(pk=payments[0].pk).update(
+            timestamp=timezone.make_aware(timezone.datetime.combine(two_months_ago, timezone.datetime.min.time())))
+        Payment.objects.filter(pk=payments[1].pk).update(timestamp=timezone.now() - timezone.timedelta(days=400))
+
+        months = self.client.get("/admin/core/order/sales/").context["months"]
+        self.assertEqual(len(months), 12)
+        self.assertEqual([(months[0]["orders"], months[0]["revenue"]), (months[1]["orders"], months[1]["revenue"])],
+                         [(2, Decimal("36.00")), (0, Decimal("0.00"))])
+        self.assertEqual(timezone.localtime(months[2]["month"]).date(), two_months_ago.replace(day=1))
+        self.assertEqual(sum(month["orders"] for month in months), 3)
+
+    def test_estimated_count(self):
+        self.create_paid_orders(3)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        paginator = EstimatedCountPaginator(Order.objects.order_by("pk"), 10)
+        paginator.estimate_threshold = 1
+        self.assertEqual(self.assertQueryBudget(1, lambda: paginator.count), 3)
+        filtered = EstimatedCountPaginator(Order.objects.filter(ordered=True).order_by("pk"), 10)
+        self.assertEqual(filtered.count, 3)
+
+
+@override_settings(REFUND_RETRY_BACKOFF=0.01)
+class RefundTests(TestCase):
+    def create_order(self, username, charge_id):
+        user = User.objects.create_user(username, f"{username}@example.com")
+        payment = Payment.objects.create(stripe_charge_id=charge_id, amount=Decimal("10.00"), user=user) \
+            if charge_id else None
+        return Order.objects.create(user=user, ordered=True, ordered_date=timezone.now(), payment=payment,
+                                    refund_requested=True)
+
+    def test_batch_refunds(self):
+        orders = [self.create_order(f"buyer-{n}", f"ch_{n}") for n in range(4)]
+        orders.append(self.create_order("refunded", "ch_refunded"))
+        orders.append(self.create_order("unpaid", None))
+        Refund.objects.create(order=orders[0], reason="Too small", email="buyer-0@example.com")
+        # an open cart selected along with them is left alone
+        Order.objects.create(user=User.objects.create_user("browsing"), ordered_date=timezone.now())
+
+        with FakeStripeServer() as stripe_server:
+            stripe_server.rate_limited = 3
+            results = refunds.process_refunds(Order.objects.all(), workers=3, rate=100)
+            self.assertEqual(results, {"succeeded": 4, "failed": 2})
+            # refunded orders are skipped on the second run
+            self.assertEqual(refunds.process_refunds(Order.objects.all()), {"succeeded": 0, "failed": 2})
+            keys = [key for path, _, key in stripe_server.requests if path == "/v1/refunds"]
+        self.assertEqual(len(stripe_server.created), 4)
+        self.assertEqual(len(keys), 4 + 3 + 2)
+
+        self.assertEqual(Refund.objects.count(), 6)
+        refund = Refund.objects.get(order=orders[0])
+        self.assertEqual((refund.status, refund.accepted, refund.reason), (Refund.SUCCEEDED, True, "Too small"))
+        self.assertTrue(refund.stripe_refund_id.startswith("re_"))
+        self.assertEqual(Order.objects.filter(refund_granted=True).count(), 4)
+        self.assertIn("already been refunded", Refund.objects.get(order=orders[4]).error)
+        # the failed refund is tried again under a new key, rate limited retries reuse theirs
+        refund = Refund.objects.get(order=orders[4])
+        self.assertEqual([key for key in keys if key.startswith(f"refund-{refund.pk}-")],
+                         [f"refund-{refund.pk}-0", f"refund-{refund.pk}-1"])
+        self.assertEqual(refund.attempts, 2)
+        self.assertEqual(len(set(keys)), 4 + 2)
+        self.assertEqual(Refund.objects.get(order=orders[5]).status, Refund.FAILED)
+
+
+class CouponTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.item = create_item("shirt", "20.00")
+
+    def cart_of(self, username):
+        user = User.objects.create_user(username, password="pw")
+        cart.add_item(user, self.item)
+        return user, cart.load_cart(user)
+
+    def pay(self, user):
+        return payments.enqueue_payment(cart.load_cart(user), user, source="tok_visa")
+
+    def test_redemption_limits(self):
+        Coupon.objects.create(code="TWICE", amount=Decimal("5.00"), max_uses=2, max_uses_per_user=1)
+        Coupon.objects.create(code="BIG", amount=Decimal("5.00"), min_basket=Decimal("50.00"))
+        user, order = self.cart_of("first")
+        with self.assertRaisesMessage(CouponError, "at least 50.00"):
+            apply_coupon(order, user, "BIG")
+        with self.assertRaisesMessage(CouponError, "does not exist"):
+            apply_coupon(order, user, "NOPE")
+
+        self.assertQueryBudget(3, apply_coupon, order, user, "TWICE")
+        self.assertEqual(Order.objects.get(pk=order.pk).total, Decimal("15.00"))
+        # counted when paid, given back when the payment fails
+        self.assertEqual(Coupon.objects.get(code="TWICE").uses, 0)
+        payments.fail_job(self.pay(user), "Your card was declined.")
+        self.assertEqual(Coupon.objects.get(code="TWICE").uses, 0)
+        job = self.pay(user)
+        self.assertEqual(Coupon.objects.get(code="TWICE").uses, 1)
+        PaymentJob.objects.filter(pk=job.pk).update(status=PaymentJob.SUCCEEDED)
+        Order.objects.filter(pk=order.pk).update(ordered=True)
+        cart.add_item(user, self.item)
+        order = cart.load_cart(user)
+        with self.assertRaisesMessage(CouponError, "already used"):
+            apply_coupon(order, user, "TWICE")
+
+        second, order = self.cart_of("second")
+        apply_coupon(order, second, "TWICE")
+        third, third_order = self.cart_of("third")
+        apply_coupon(third_order, third, "TWICE")
+        self.pay(second)
+        with self.assertRaisesMessage(CouponError, "used up"):
+            self.pay(third)
+        self.assertEqual(Coupon.objects.get(code="TWICE").uses, 2)
+        self.assertEqual(CouponRedemption.objects.filter(coupon__code="TWICE").count(), 2)
+        self.assertFalse(PaymentJob.objects.filter(order=third_order).exists())
+
+    def test_basket_checked_again_when_paying(self):
+        Coupon.objects.create(code="TEN", amount=Decimal("25.00"), min_basket=Decimal("20.00"))
+        user, order = self.cart_of("shopper")
+        apply_coupon(order, user, "TEN")
+        self.assertEqual(Order.objects.get(pk=order.pk).total, Decimal("0.00"))
+        cart.add_item(user, self.item, order=cart.load_cart(user))
+        self.assertEqual(Order.objects.get(pk=order.pk).total, Decimal("15.00"))
+        cart.remove_single_item(user, self.item, cart.load_cart(user))
+        cart.remove_single_item(user, self.item, cart.load_cart(user))
+        self.assertEqual(Order.objects.get(pk=order.pk).total, Decimal("0.00"))
+        with self.assertRaisesMessage(CouponError, "at least 20.00"):
+            self.pay(user)
+        self.assertEqual(Coupon.objects.get(code="TEN").uses, 0)
+
+    def test_table_invalidated_on_save(self):
+        coupon = Coupon.objects.create(code="SPRING", amount=Decimal("5.00"))
+        user, order = self.cart_of("shopper")
+        coupon.active = False
+        coupon.save()
+        with self.assertRaisesMessage(CouponError, "does not exist"):
+            apply_coupon(order, user, "SPRING")
+
+    @override_settings(CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "shared"},
+        "local": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "local"},
+    }, CATALOG_CACHE="local", CATALOG_VERSION_CACHE="default")
+    def test_table_follows_the_shared_version(self):
+        Coupon.objects.create(code="SPRING", amount=Decimal("5.00"))
+        user, order = self.cart_of("shopper")
+        apply_coupon(order, user, "SPRING")
+        # deactivated by another worker, which bumps the shared version
+        Coupon.objects.filter(code="SPRING").update(active=False)
+        caches["default"].incr("coupons:version")
+        with self.assertRaisesMessage(CouponError, "no longer valid"):
+            payments.enqueue_payment(cart.load_cart(user), user, source="tok_visa")
+
+
+class CheckoutTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("shopper", password="pw")
+        cart.add_item(self.user, create_item("shirt"))
+        self.order = cart.load_cart(self.user)
+
+    def address(self, prefix, **extra):
+        return dict({f"{prefix}_address_1": "1 Main St", f"{prefix}_address_2": "",
+                     f"{prefix}_country": "FR", f"{prefix}_postal_code": "75001"}, **extra)
+
+    def test_new_addresses_written_in_one_pass(self):
+        data = self.address("shipping", set_default_shipping=True, same_billing_address=True)
+        self.assertQueryBudget(4, save_checkout, self.order, self.user, data)
+        order = Order.objects.select_related("shipping_address", "billing_address").get(pk=self.order.pk)
+        self.assertEqual((order.shipping_address.address_type, order.shipping_address.default), ("S", True))
+        self.assertEqual((order.billing_address.address_type, order.billing_address.default), ("B", False))
+        self.assertNotEqual(order.shipping_address_id, order.billing_address_id)
+
+        # a new default replaces the previous one
+        data = self.address("shipping", set_default_shipping=True, **self.address("billing"))
+        self.assertQueryBudget(4, save_checkout, self.order, self.user, data)
+        self.assertEqual(Address.objects.filter(address_type="S", default=True).get(),
+                         Order.objects.get(pk=self.order.pk).shipping_address)
+
+    def test_default_addresses(self):
+        with self.assertRaisesMessage(CheckoutError, "No default shipping address"):
+            save_checkout(self.order, self.user, {"use_default_shipping": True})
+        save_checkout(self.order, self.user, self.address("shipping", set_default_shipping=True,
+                                                          same_billing_address=True))
+        Address.objects.filter(address_type="B").update(default=True)
+        data = {"use_default_shipping": True, "use_default_billing": True}
+        self.assertQueryBudget(2, save_checkout, self.order, self.user, data)
+        with self.assertRaisesMessage(CheckoutError, "required billing address"):
+            save_checkout(self.order, self.user, {"use_default_shipping": True})
+
+
+class OrderLineBackfillTests(TestCase):
+    def test_backfill_in_chunks(self):
+        item = create_item("shirt", "10.00", Decimal("8.00"))
+        for n in range(3):
+            user = User.objects.create_user(f"buyer-{n}")
+            cart.add_item(user, item, quantity=n + 1)
+            order = cart.load_cart(user)
+            order.items.update(ordered=True)
+            Order.objects.filter(pk=order.pk).update(ordered=True)
+        cart.add_item(User.objects.create_user("browsing"), item)
+
+        out = StringIO()
+        call_command("backfill_order_lines", "--chunk-size", "2", stdout=out)
+        self.assertIn("Snapshotted 3 lines of 3 orders", out.getvalue())
+        self.assertEqual(sorted(OrderLine.objects.values_list("quantity", "discount_price", "line_total")),
+                         [(1, Decimal("8.00"), Decimal("8.00")), (2, Decimal("8.00"), Decimal("16.00")),
+                          (3, Decimal("8.00"), Decimal("24.00"))])
+        call_command("backfill_order_lines", stdout=out)
+        self.assertIn("Snapshotted 0 lines of 0 orders", out.getvalue())
+
+
+class SalesRollupTests(TestCase):
+    def setUp(self):
+        self.shirt = create_item("shirt", "10.00")
+        self.coat = create_item("coat", "30.00")
+        Item.objects.filter(pk=self.coat.pk).update(category="OW")
+        self.coat.refresh_from_db()
+        self.coupon = Coupon.objects.create(code="SAVE", amount=Decimal("5.00"))
+
+    def pay(self, paid_at, *lines, coupon=None):
+        user = User.objects.create_user(f"buyer-{User.objects.count()}")
+        for item, quantity in lines:
+            cart.add_item(user, item, quantity=quantity)
+        order = cart.load_cart(user)
+        if coupon:
+            order.coupon = coupon
+            order.save()
+        payment = Payment.objects.create(stripe_charge_id="ch", amount=order.total, user=user)
+        Payment.objects.filter(pk=payment.pk).update(timestamp=paid_at)
+        order.items.update(ordered=True)
+        Order.objects.filter(pk=order.pk).update(ordered=True, payment=payment)
+        snapshot_order_lines([order.pk])
+
+    def rollups(self, model, period):
+        return {(getattr(row, period), row.category): (row.revenue, row.orders, row.units, row.coupon_discount)
+                for row in model.objects.all()}
+
+    def test_incremental_rollup_and_rebuild(self):
+        day = timezone.now().replace(hour=10, minute=0, second=0, microsecond=0) - timezone.timedelta(days=1)
+        self.pay(day.replace(minute=15), (self.shirt, 2), (self.coat, 1), coupon=self.coupon)
+        self.pay(day.replace(minute=40), (self.shirt, 1))
+        self.pay(day.replace(hour=14), (self.coat, 1))
+        self.pay(timezone.now(), (self.shirt, 1))  # inside the lag, left for later
+
+        out = StringIO()
+        call_command("rollup_sales", "--chunk-size", "2", stdout=out)
+        self.assertIn("Rolled up 3 orders, 4 lines", out.getvalue())
+        self.assertEqual(self.rollups(HourlySales, "hour"), {
+            (day, ""): (Decimal("55.00"), 2, 4, Decimal("5.00")),
+            (day, "S"): (Decimal("30.00"), 2, 3, Decimal("0.00")),
+            (day, "OW"): (Decimal("30.00"), 1, 1, Decimal("0.00")),
+            (day.replace(hour=14), ""): (Decimal("30.00"), 1, 1, Decimal("0.00")),
+            (day.replace(hour=14), "OW"): (Decimal("30.00"), 1, 1, Decimal("0.00")),
+        })
+        daily = self.rollups(DailySales, "day")
+        self.assertEqual(daily[(day.date(), "")], (Decimal("85.00"), 3, 5, Decimal("5.00")))
+        self.assertEqual(daily[(day.date(), "OW")], (Decimal("60.00"), 2, 2, Decimal("0.00")))
+
+        self.pay(day.replace(hour=15), (self.shirt, 1))
+        call_command("rollup_sales", stdout=out)
+        self.assertIn("Rolled up 1 orders, 1 lines", out.getvalue())
+        daily = self.rollups(DailySales, "day")
+        self.assertEqual(daily[(day.date(), "")], (Decimal("95.00"), 4, 6, Decimal("5.00")))
+
+        call_command("rollup_sales", "--rebuild", "--chunk-size", "3", stdout=out)
+        self.assertEqual(self.rollups(DailySales, "day"), daily)
+
+    def test_lines_are_dated_by_the_payment(self):
+        paid_at = timezone.now() - timezone.timedelta(days=3)
+        self.pay(paid_at, (self.shirt, 1))
+        self.assertEqual(OrderLine.objects.get().ordered_date, paid_at)
+        self.assertNotEqual(Order.objects.get().ordered_date, paid_at)
+
+
+class StaticFilesTests(TestCase):
+    def test_hashed_compressed_assets(self):
+        with tempfile.TemporaryDirectory() as static_root, override_settings(STATIC_ROOT=static_root):
+            call_command("collectstatic", "--noinput", verbosity=0)
+            url = staticfiles_storage.url("css/bootstrap.min.css")
+            self.assertRegex(url, r"^/static/css/bootstrap\.min\.[0-9a-f]{12}\.css$")
+            self.assertContains(self.client.get("/"), url)
+
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip, deflate")
+            self.assertEqual(response["Content-Encoding"], "gzip")
+            self.assertEqual(response["Content-Type"], "text/css")
+            self.assertEqual(response["Cache-Control"], "public, max-age=31536000, immutable")
+            with staticfiles_storage.open("css/bootstrap.min.css") as f:
+                self.assertEqual(gzip.decompress(b"".join(response.streaming_content)), f.read())
+
+            plain = self.client.get("/static/css/bootstrap.min.css")
+            self.assertFalse(plain.has_header("Content-Encoding"))
+            self.assertEqual(plain["Cache-Control"], "public, max-age=60")
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]).status_code, 304)
+
+
+@override_settings(CACHES={
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "shared"},
+    "local": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "local"},
+}, CATALOG_CACHE="local", CATALOG_VERSION_CACHE="default")
+class CatalogVersionTests(TestCase):
+    def test_bump_in_the_shared_cache_invalidates_local_values(self):
+        values = iter(["first", "second"])
+        self.assertEqual(cached_catalog_value("page", lambda: next(values)), "first")
+        self.assertEqual(cached_catalog_value("page", lambda: next(values)), "first")
+        # another worker bumps the version, only the shared cache sees it
+        caches["default"].incr("catalog:version")
+        self.assertEqual(cached_catalog_value("page", lambda: next(values)), "second")
+        self.assertIsNone(caches["local"].get("catalog:version"))
+
+
+class ProductPageCacheTests(TestCase):
+    def setUp(self):
+        self.item = create_item("shirt", "10.00")
+        self.url = self.item.get_absolute_url()
+
+    def test_anonymous_conditional_get(self):
+        first = self.client.get(self.url)
+        etag = first["ETag"]
+        self.assertRegex(etag, r'^"\d+-[0-9a-f]{12}"$')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url).content, first.content)
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=first["Last-Modified"]).status_code,
+                             304)
+
+        self.item.price = Decimal("12.00")
+        self.item.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertContains(response, "12.00")
+        self.assertEqual(self.client.get("/product/missing/").status_code, 404)
+
+    def test_signed_in_users_get_a_fresh_page(self):
+        User.objects.create_user("shopper", password="pw")
+        self.client.login(username="shopper", password="pw")
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header("ETag"))
+
+
+class ProductCardCacheTests(TestCase):
+    def test_card_fragment_follows_item_saves(self):
+        item = create_item("shirt", "10.00")
+        self.assertContains(self.client.get("/"), "10.00€")
+        # the page is queried again, the card is still the cached one of this version
+        Item.objects.filter(pk=item.pk).update(price=Decimal("11.00"))
+        bump_catalog_version()
+        self.assertContains(self.client.get("/"), "10.00€")
+
+        item.price = Decimal("12.00")
+        item.save()
+        self.assertContains(self.client.get("/"), "12.00€")
+
+
+@override_settings(DATABASE_REPLICAS=["local_replica"])
+class ReplicaRouterTests(TransactionTestCase):
+    def setUp(self):
+        self.item = create_item("shirt", "12.00")
+        # a second SQLite file holding a copy of the catalog from before the price change
+        directory = tempfile.mkdtemp()
+        connections.databases["local_replica"] = {"ENGINE": "django.db.backends.sqlite3",
+                                                  "NAME": os.path.join(directory, "replica.sqlite3")}
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(connections.databases.pop, "local_replica")
+        self.addCleanup(routers._down_until.clear)
+        self.addCleanup(self.close_replica)
+        with connections["local_replica"].schema_editor() as editor:
+            editor.create_model(Item)
+        self.item.price = Decimal("10.00")
+        Item.objects.using("local_replica").bulk_create([self.item])
+
+        User.objects.create_user("shopper", password="pw")
+        self.client.login(username="shopper", password="pw")
+        self.client.cookies.pop(ReplicaPinMiddleware.cookie_name, None)
+
+    def close_replica(self):
+        connections["local_replica"].close()
+        del connections["local_replica"]
+
+    def test_reads_stay_on_the_primary_after_a_write(self):
+        self.assertContains(self.client.get("/product/shirt/"), "10.00")
+        response = self.client.get(reverse("core:add-to-cart", args=["shirt"]))
+        self.assertIn(ReplicaPinMiddleware.cookie_name, response.cookies)
+        self.assertContains(self.client.get("/product/shirt/"), "12.00")
+        self.assertEqual(OrderItem.objects.get().line_total, Decimal("12.00"))
+
+    def test_falls_back_to_the_primary_when_the_replica_fails(self):
+        self.close_replica()
+        connections.databases["local_replica"]["NAME"] = "/nonexistent/replica.sqlite3"
+        with self.assertLogs("core.routers", "WARNING"):
+            self.assertContains(self.client.get("/product/shirt/"), "12.00")
+        self.assertIn("local_replica", routers._down_until)
+
+    def test_missing_sqlite_replica_is_not_created(self):
+        self.close_replica()
+        missing = os.path.join(os.path.dirname(connections.databases["local_replica"]["NAME"]), "missing.sqlite3")
+        connections.databases["local_replica"]["NAME"] = missing
+        with self.assertLogs("core.routers", "WARNING"):
+            self.assertContains(self.client.get("/product/shirt/"), "12.00")
+        self.assertFalse(os.path.exists(missing))
+
+    def test_failed_replica_query_is_retried_on_the_primary(self):
+        with connections["local_replica"].schema_editor() as editor:
+            editor.delete_model(Item)
+        with self.assertLogs("core.middleware", "WARNING"):
+            self.assertContains(self.client.get("/product/shirt/"), "12.00")
+        self.assertIn("local_replica", routers._down_until)
+
+    def test_primary_reads_keep_a_pin_set_inside(self):
+        tokens = routers.start_request(False)
+        self.addCleanup(routers.finish_request, tokens)
+        with routers.primary_reads():
+            pass
+        self.assertEqual(routers.ReplicaRouter().db_for_read(Item), "local_replica")
+        with routers.primary_reads():
+            Item.objects.filter(pk=self.item.pk).update(price=Decimal("13.00"))
+        self.assertTrue(routers.wrote_to_primary())
+        self.assertIsNone(routers.ReplicaRouter().db_for_read(Item))
+
+    def test_catalog_cache_reads_the_replica_once_it_caught_up(self):
+        self.client.logout()
+        # the item was just saved, the replica may not hold it yet
+        self.assertContains(self.client.get("/product/shirt/"), "12.00")
+        bump_catalog_version()
+        with override_settings(REPLICA_PIN_SECONDS=0):
+            self.assertContains(self.client.get("/product/shirt/"), "10.00")
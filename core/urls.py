@@ -2,6 +2,7 @@ from django.urls import path
 from django.views.generic import TemplateView
 from .views import (
     HomeView,
+    SearchView,
     CheckoutView,
     ItemDetailView,
     add_to_cart,
@@ -9,6 +10,7 @@ from .views import (
     remove_single_item_from_cart,
     OrderSummaryView,
     PaymentView,
+    PaymentStatusView,
     AddCouponView,
     RequestRefundView
 )
@@ -17,6 +19,7 @@ app_name = "core"
 
 urlpatterns = [
     path("", HomeView.as_view(), name="home"),
+    path("search/", SearchView.as_view(), name="search"),
     path("checkout/", CheckoutView.as_view(), name="checkout"),
     path("order-summary/", OrderSummaryView.as_view(), name="order-summary"),
     path("product/<slug>/", ItemDetailView.as_view(), name="product"),
@@ -25,5 +28,6 @@ urlpatterns = [
     path("remove-from-cart/<slug>/", remove_from_cart, name="remove-from-cart"),
     path("remove-item-from-cart/<slug>/", remove_single_item_from_cart, name="remove-single-item-from-cart"),
     path("payment/<payment_option>/", PaymentView.as_view(), name="payment"),
+    path("payment/status/<key>/", PaymentStatusView.as_view(), name="payment-status"),
     path("request-refund/", RequestRefundView.as_view(), name="request-refund"),
 ]
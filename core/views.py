@@ -1,221 +1,197 @@
-from django.conf import settings
+import hashlib
+
 from django.contrib import messages
-from django.contrib.auth.decorators import login_required # for function based view
 from django.contrib.auth.mixins import LoginRequiredMixin # for class based view
 from django.core.exceptions import ObjectDoesNotExist
-from django.shortcuts import render, get_object_or_404, redirect
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
+from django.shortcuts import render, get_object_or_404, redirect, reverse
 from django.views.generic import ListView, DetailView, View
-from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, urlencode
 
+from . import cart, metrics, payments
+from .catalog import CatalogPaginator, cached_catalog_value, get_facet_counts
+from .checkout import BILLING, SHIPPING, CheckoutError, get_default_addresses, save_checkout
+from .coupons import CouponError, apply_coupon
 from .forms import CheckoutForm, CouponForm, RefundForm, PaymentForm
+from .pagination import KeysetPaginationMixin
+from .routers import use_primary
+from .search import SearchResults
 
-from .models import Item, OrderItem, Order, Address, Payment, Coupon, Refund, UserProfile
+from .models import Item, Order, PaymentJob, Refund, CATEGORY_CHOICES, LABEL_CHOICES
 
-import random
-import string
 import stripe
-stripe.api_key = settings.STRIPE_SECRET_KEY
 
-def create_ref_code():
-    return "".join(random.choices(string.ascii_lowercase + string.digits, k=20))
-
-def is_valid_form(values):
-    valid = True
-    for field in values:
-        if field == "":
-            valid = False
-    return valid
+FACETS = (
+    ("category", CATEGORY_CHOICES),
+    ("label",    LABEL_CHOICES),
+)
 
 # Create your views here.
-class HomeView(ListView):
-    model         = Item
+class HomeView(KeysetPaginationMixin, ListView):
+    model           = Item
+    paginate_by     = 10
+    paginator_class = CatalogPaginator
+    ordering        = ['-id'] # minus = descending
+    template_name   = "home.html"
+
+    def get_filters(self):
+        filters = {}
+        for field, choices in FACETS:
+            value = self.request.GET.get(field)
+            if value in dict(choices):
+                filters[field] = value
+        return filters
+
+    def get_queryset(self):
+        return super().get_queryset().filter(**self.get_filters())
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        filters   = self.get_filters()
+        cache_key = "home:" + ":".join(filters.get(field, "") for field, choices in FACETS)
+        return super().get_paginator(queryset, per_page, cache_key = cache_key, **kwargs)
+
+    def get_facets(self, filters):
+        # counts for one facet respect the filters selected on the other facets
+        rows   = get_facet_counts()
+        facets = {}
+        for field, choices in FACETS:
+            others = { key: value for key, value in filters.items() if key != field }
+            counts = {}
+            for category, label, count in rows:
+                row = { "category": category, "label": label }
+                if all(row[key] == value for key, value in others.items()):
+                    counts[row[field]] = counts.get(row[field], 0) + count
+            facets[f"{field}_facets"] = [
+                {
+                    "value":  value,
+                    "name":   name,
+                    "count":  counts.get(value, 0),
+                    "active": filters.get(field) == value,
+                    "query":  urlencode({ **others, field: value })
+                }
+                for value, name in choices
+            ]
+            facets[f"{field}_all_query"] = urlencode(others)
+        return facets
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        filters = self.get_filters()
+        context.update(self.get_facets(filters))
+        context.update({
+            "filters":          filters,
+            "pagination_query": urlencode(filters) + "&" if filters else ""
+        })
+        return context
+
+class SearchView(ListView):
     paginate_by   = 10
-    ordering      = ['-id'] # minus = descending
     template_name = "home.html"
 
-class OrderSummaryView(LoginRequiredMixin, View):
+    def get_query(self):
+        return self.request.GET.get("q", "").strip()
+
+    def get_queryset(self):
+        return SearchResults(self.get_query())
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update({
+            "search_query":     self.get_query(),
+            "pagination_query": urlencode({ "q": self.get_query() }) + "&"
+        })
+        return context
+
+class OrderSummaryView(View):
     def get(self, *args, **kwargs):
-        try:
-            context = {
-                "object": Order.objects.get(
-                    user    = self.request.user,
-                    ordered = False
-                )
-            }
-            return render(self.request, "order_summary.html", context)
-        except ObjectDoesNotExist:
+        if not self.request.cart:
             messages.warning(self.request, "You do not have an active order.")
             return redirect("/")
+        context = {
+            "object": self.request.cart
+        }
+        return render(self.request, "order_summary.html", context)
 
 class ItemDetailView(DetailView):
+    """
+    Anonymous visitors get the page body cached per catalog version, with a
+    strong ETag and Last-Modified so revalidations end in a 304 without a
+    query. Signed in users see their cart in the navbar and get a fresh page.
+    """
     model         = Item
     template_name = "product.html"
 
-class CheckoutView(View):
-    def get(self, *args, **kwargs):
-        try:
-            context = {
-                "form": CheckoutForm(),
-                "coupon_form": CouponForm(),
-                "order": Order.objects.get(
-                    user    = self.request.user,
-                    ordered = False
-                ),
-                "DISPLAY_COUPON_FORM": True
-            }
-
-            shipping_address_qs = Address.objects.filter(
-                user         = self.request.user,
-                address_type = "S",
-                default      = True
-            )
-            if shipping_address_qs.exists():
-                context.update(
-                    { "default_shipping_address": shipping_address_qs[0] }
-                )
-
-            billing_address_qs = Address.objects.filter(
-                user         = self.request.user,
-                address_type = "B",
-                default      = True
-            )
-            if billing_address_qs.exists():
-                context.update(
-                    { "default_billing_address": billing_address_qs[0] }
-                )
+    def get(self, request, *args, **kwargs):
+        if request.user.is_authenticated or len(messages.get_messages(request)):
+            return super().get(request, *args, **kwargs)
+
+        page     = cached_catalog_value(f"product:{kwargs['slug']}", lambda: self.render_page(*args, **kwargs))
+        response = get_conditional_response(request, etag = page["etag"], last_modified = page["last_modified"])
+        if response is None:
+            response = HttpResponse(page["content"])
+        response["ETag"]          = page["etag"]
+        response["Last-Modified"] = http_date(page["last_modified"])
+        patch_cache_control(response, no_cache = True)
+        patch_vary_headers(response, ["Cookie"])
+        return response
+
+    def render_page(self, *args, **kwargs):
+        response = super().get(self.request, *args, **kwargs)
+        response.render()
+        updated  = self.object.updated_at
+        return {
+            "content":       response.content,
+            # the digest changes with the templates, the timestamp with the item
+            "etag":          '"%d-%s"' % (updated.timestamp() * 1e6, hashlib.md5(response.content).hexdigest()[:12]),
+            "last_modified": int(updated.timestamp()),
+        }
 
-            return render(self.request, "checkout.html", context)
-        except ObjectDoesNotExist:
+class CheckoutView(LoginRequiredMixin, View):
+    def get(self, *args, **kwargs):
+        if not self.request.cart:
             messages.info(self.request, "You don't have an active order.")
-            return redirect("core:checkout")
+            return redirect("core:order-summary")
 
+        defaults = get_default_addresses(self.request.user)
+        context = {
+            "form": CheckoutForm(),
+            "coupon_form": CouponForm(),
+            "order": self.request.cart,
+            "DISPLAY_COUPON_FORM": True,
+            "default_shipping_address": defaults.get(SHIPPING),
+            "default_billing_address": defaults.get(BILLING)
+        }
+        return render(self.request, "checkout.html", context)
 
     def post(self, *args, **kwargs):
-        form = CheckoutForm(self.request.POST or None)
-        try:
-            order = Order.objects.get(
-                user    = self.request.user,
-                ordered = False
-            )
-            if form.is_valid():
-                print(form.cleaned_data)
-                use_default_shipping = form.cleaned_data.get("use_default_shipping")
-                if use_default_shipping:
-                    print("Use the default shipping address")
-                    address_qs = Address.objects.filter(
-                        user         = self.request.user,
-                        address_type = "S",
-                        default      = True
-                    )
-                    if address_qs.exists():
-                        shipping_address = address_qs[0]
-                        order.shipping_address = shipping_address
-                        order.save()
-                    else:
-                        messages.info(self.request, "No default shipping address available.")
-                        return redirect("core:checkout")
-                else:
-                    print("User is entering a new shipping address.")
-                    shipping_address_1    = form.cleaned_data.get("shipping_address_1")
-                    shipping_address_2    = form.cleaned_data.get("shipping_address_2")
-                    shipping_country      = form.cleaned_data.get("shipping_country")
-                    shipping_postal_code  = form.cleaned_data.get("shipping_postal_code")
-
-                    if is_valid_form([shipping_address_1, shipping_country, shipping_postal_code]):
-                        shipping_address  = Address(
-                            user              = self.request.user,
-                            street_address    = shipping_address_1,
-                            apartment_address = shipping_address_2,
-                            country           = shipping_country,
-                            postal_code       = shipping_postal_code,
-                            address_type      = "S"
-                        )
-                        shipping_address.save()
-
-                        order.shipping_address = shipping_address
-                        order.save()
-
-                        set_default_shipping  = form.cleaned_data.get("set_default_shipping")
-                        if set_default_shipping:
-                            shipping_address.default = True
-                            shipping_address.save()
-                    else:
-                        messages.info(self.request, "Please fill in the required shipping address field.")
-
-                use_default_billing  = form.cleaned_data.get("use_default_billing")
-                same_billing_address = form.cleaned_data.get("same_billing_address")
-
-                if same_billing_address:
-                    billing_address              = shipping_address
-                    billing_address.pk           = None # autogenerate new primary key for new object
-                    billing_address.save()              # save duplicated object
-                    billing_address.address_type = "B"
-                    billing_address.save()
-                    order.billing_address = billing_address
-                    order.save()
-
-                elif use_default_billing:
-                    print("Use the default billing address")
-                    address_qs = Address.objects.filter(
-                        user         = self.request.user,
-                        address_type = "B",
-                        default      = True
-                    )
-                    if address_qs.exists():
-                        billing_address = address_qs[0]
-                        order.billing_address = billing_address
-                        order.save()
-                    else:
-                        messages.info(self.request, "No default billing address available.")
-                        return redirect("core:checkout")
-
-                else:
-                    print("User is entering a new billing address.")
-                    billing_address_1    = form.cleaned_data.get("billing_address_1")
-                    billing_address_2    = form.cleaned_data.get("billing_address_2")
-                    billing_country      = form.cleaned_data.get("billing_country")
-                    billing_postal_code  = form.cleaned_data.get("billing_postal_code")
-
-                    if is_valid_form([billing_address_1, billing_country, billing_postal_code]):
-                        billing_address  = Address(
-                            user              = self.request.user,
-                            street_address    = billing_address_1,
-                            apartment_address = billing_address_2,
-                            country           = billing_country,
-                            postal_code       = billing_postal_code,
-                            address_type      = "B"
-                        )
-                        billing_address.save()
-
-                        order.billing_address = billing_address
-                        order.save()
-
-                        set_default_billing  = form.cleaned_data.get("set_default_billing")
-                        if set_default_billing:
-                            billing_address.default = True
-                            billing_address.save()
-                    else:
-                        messages.info(self.request, "Please fill in the required billing address field.")
-
-                payment_option        = form.cleaned_data.get("payment_option")
-
-                if payment_option == "S" :
-                    return redirect("core:payment", payment_option="stripe")
-                elif payment_option == "P":
-                    return redirect("core:payment", payment_option="paypal")
-                else:
-                    messages.warning(self.request, "Invalid payment option selected.")
-                    return redirect("core:checkout")
-        except ObjectDoesNotExist:
+        form  = CheckoutForm(self.request.POST or None)
+        order = self.request.cart
+        if not order:
             messages.warning(self.request, "You do not have an active order.")
             return redirect("core:order-summary")
+        if not form.is_valid():
+            messages.warning(self.request, "Please correct the checkout form.")
+            return redirect("core:checkout")
+
+        try:
+            save_checkout(order, self.request.user, form.cleaned_data)
+        except CheckoutError as e:
+            messages.info(self.request, str(e))
+            return redirect("core:checkout")
+
+        payment_option = form.cleaned_data.get("payment_option")
+        if payment_option == "S":
+            return redirect("core:payment", payment_option="stripe")
+        return redirect("core:payment", payment_option="paypal")
 
-class PaymentView(View):
+class PaymentView(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
-        order = Order.objects.get(
-            user    = self.request.user,
-            ordered = False
-        )
+        order = self.request.cart
+        if not order:
+            messages.warning(self.request, "You do not have an active order.")
+            return redirect("core:order-summary")
 
         if order.billing_address:
             context = {
@@ -224,16 +200,14 @@ class PaymentView(View):
             }
             user_profile = self.request.user.userprofile
             if user_profile.one_click_purchasing:
-                # fetch the user card list
-                cards = stripe.Customer.list_sources(
-                    user_profile.stripe_customer_id,
-                    limit  = 3,
-                    object = "card"
-                )
-                card_list = cards["data"]
-                if len(card_list) > 0:
+                # fetch the user default card, cached per customer
+                try:
+                    card = payments.get_default_card(user_profile.stripe_customer_id)
+                except stripe.error.StripeError:
+                    card = None
+                if card:
                     # update the context with default card
-                    context.update({"card": card_list[0]})
+                    context.update({"card": card})
 
             return render(self.request, "payment.html", context)
         else:
@@ -241,19 +215,23 @@ class PaymentView(View):
             return redirect("core:checkout")
 
     def post(self, *args, **kwargs):
-        order        = Order.objects.get(
-            user    = self.request.user,
-            ordered = False
-        )
+        order        = self.request.cart
+        if not order:
+            messages.warning(self.request, "You do not have an active order.")
+            return redirect("core:order-summary")
         form         = PaymentForm(self.request.POST)
-        user_profile = UserProfile.objects.get(user = self.request.user)
+        user_profile = self.request.user.userprofile
 
-        if form.is_valid():
-            print(form.cleaned_data)
-            token       = self.request.POST.get("stripeToken")
-            save        = form.cleaned_data.get("save")
-            use_default = form.cleaned_data.get("use_default")
+        if not form.is_valid():
+            messages.warning(self.request, "Invalid payment data.")
+            return redirect("core:payment", payment_option = "stripe")
 
+        token       = self.request.POST.get("stripeToken")
+        save        = form.cleaned_data.get("save")
+        use_default = form.cleaned_data.get("use_default")
+        source      = token
+
+        try:
             if save:
                 # allow to fetch cards
                 if not user_profile.stripe_customer_id:
@@ -264,73 +242,47 @@ class PaymentView(View):
                     user_profile.stripe_customer_id   = customer["id"]
                     user_profile.one_click_purchasing = True
                     user_profile.save()
+                    source = customer["default_source"]
                 else:
-                    stripe.Customer.create_source(
+                    card = stripe.Customer.create_source(
                         user_profile.stripe_customer_id,
                         source = token
                     )
-            amount = int(order.get_total() * 100) # cents
+                    source = card["id"]
+                payments.invalidate_default_card(user_profile.stripe_customer_id)
+        except stripe.error.StripeError as e:
+            messages.warning(self.request, payments.describe_stripe_error(e))
+            return redirect("core:payment", payment_option = "stripe")
 
+        # the card token is consumed once it is attached to the customer, a
+        # saved card is charged by its id, the customer's default otherwise
         try:
             if use_default:
-                charge = stripe.Charge.create(
-                    amount        = amount, # cents
-                    currency      = "eur",
-                    customer      = user_profile.stripe_customer_id
-                )
+                job = payments.enqueue_payment(order, self.request.user, customer = user_profile.stripe_customer_id)
+            elif save:
+                job = payments.enqueue_payment(order, self.request.user, source = source,
+                                               customer = user_profile.stripe_customer_id)
             else:
-                charge = stripe.Charge.create(
-                    amount        = amount, # cents
-                    currency      = "eur",
-                    source        = token
-                )
-            # create the payment
-            payment = Payment(
-                stripe_charge_id = charge["id"],
-                user             = self.request.user,
-                amount           = order.get_total()
-            )
-            payment.save()
-
-            # assign the payment to the order
-            order_items = order.items.all()
-            order_items.update(ordered = True) # update_all
-
-            for item in order_items:
-                item.save()
-
-            order.ordered = True
-            order.ref_code = create_ref_code()
-            order.payment = payment
-            order.save()
+                job = payments.enqueue_payment(order, self.request.user, source = token)
+        except CouponError as e:
+            messages.warning(self.request, str(e))
+            return redirect("core:checkout")
+        return redirect("core:payment-status", key = job.idempotency_key)
 
-            messages.success(self.request, "Your order was successful.")
-            return redirect("/")
+class PaymentStatusView(LoginRequiredMixin, View):
+    def get(self, *args, **kwargs):
+        job = get_object_or_404(PaymentJob, idempotency_key = kwargs["key"], user = self.request.user)
+        if self.request.GET.get("format") != "json":
+            return render(self.request, "payment_status.html", { "job": job })
 
-        except stripe.error.CardError as e:
-            messages.warning(self.request, f"{e.error.message}")
-            return redirect("/")
-        except stripe.error.RateLimitError as e:
-            messages.warning(self.request, "Rate limit error")
-            return redirect("/")
-        except stripe.error.InvalidRequestError as e:
-            messages.warning(self.request, f"{e.error.message}")
-            messages.warning(self.request, "Invalid parameters")
-            return redirect("/")
-        except stripe.error.AuthenticationError as e:
-            messages.warning(self.request, "Not authenticated")
-            return redirect("/")
-        except stripe.error.APIConnectionError as e:
-            messages.warning(self.request, "Network error")
-            return redirect("/")
-        except stripe.error.StripeError as e:
-            messages.warning(self.request, "Something went wrong. You are not charged. Please try again.")
-            return redirect("/")
-        except Exception as e:
-            messages.warning(self.request, f"{e.error.message}")
-            # send an email to ourselves
-            messages.warning(self.request, "A serious error occured. We have been notified")
-            return redirect("/")
+        data = { "status": job.get_status_display().lower() }
+        if job.status == PaymentJob.SUCCEEDED:
+            messages.success(self.request, "Your order was successful.")
+            data["redirect"] = "/"
+        elif job.status == PaymentJob.FAILED:
+            messages.warning(self.request, job.error)
+            data["redirect"] = reverse("core:payment", kwargs = { "payment_option": "stripe" })
+        return JsonResponse(data)
 
 def products(request):
     template = "products.html"
@@ -339,57 +291,41 @@ def products(request):
     }
     return render(request, template, context)
 
-@login_required
+@use_primary
 def add_to_cart(request, slug):
     item = get_object_or_404(Item, slug = slug)
-    order_item, created = OrderItem.objects.get_or_create(
-        item    = item,
-        user    = request.user,
-        ordered = False
-    )
-    order_qs = Order.objects.filter(
-        user    = request.user,
-        ordered = False
-    )
-
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug = item.slug).exists():
-            order_item.quantity += 1
-            order_item.save()
-            messages.info(request, "This item quantity was updated.")
+    if request.user.is_authenticated:
+        try:
+            status = cart.add_item(request.user, item, order = request.cart or None)
+        except cart.CartLocked as e:
+            messages.warning(request, str(e))
             return redirect("core:order-summary")
-        else:
-            order.items.add(order_item)
-            messages.info(request, "This item was added to your cart.")
+    else:
+        # kept in a signed cookie until the visitor logs in
+        status = request.cart.add(item)
+        if status == cart.NOT_IN_CART:
+            messages.warning(request, "Your cart is full, log in to add more items.")
             return redirect("core:order-summary")
+    if status == cart.UPDATED:
+        messages.info(request, "This item quantity was updated.")
     else:
-        order = Order.objects.create(
-            user=request.user,
-            ordered_date= timezone.now()
-        )
-        order.items.add(order_item)
         messages.info(request, "This item was added to your cart.")
-        return redirect("core:order-summary")
+    return redirect("core:order-summary")
 
-@login_required
+@use_primary
 def remove_from_cart(request, slug):
-    item = get_object_or_404(Item, slug = slug)
-    order_qs = Order.objects.filter(
-        user    = request.user,
-        ordered = False
-    )
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug = item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item    = item,
-                user    = request.user,
-                ordered = False
-            )[0]
-            order.items.remove(order_item)
+    item  = get_object_or_404(Item, slug = slug)
+    order = request.cart
+    if order:
+        if request.user.is_authenticated:
+            try:
+                status = cart.remove_item(request.user, item, order)
+            except cart.CartLocked as e:
+                messages.warning(request, str(e))
+                return redirect("core:order-summary")
+        else:
+            status = order.remove(item)
+        if status == cart.REMOVED:
             messages.info(request, "This item was removed from your cart.")
             return redirect("core:order-summary")
         else:
@@ -400,63 +336,46 @@ def remove_from_cart(request, slug):
         messages.info(request, "You don't have an active order.")
         return redirect("core:product", slug = slug)
 
-@login_required
+@use_primary
 def remove_single_item_from_cart(request, slug):
     item       = get_object_or_404(Item, slug = slug)
-    order_qs   = Order.objects.filter(
-        user    = request.user,
-        ordered = False
-    )
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug = item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item    = item,
-                user    = request.user,
-                ordered = False
-            )[0]
-            if order_item.quantity > 1:
-                order_item.quantity -= 1
-                order_item.save()
-                messages.info(request, "This item quantity was updated.")
-            else:
-                order.items.remove(order_item)
-                messages.info(request, "This item was removed from your cart.")
-            return redirect("core:order-summary")
+    order      = request.cart
+    if order:
+        if request.user.is_authenticated:
+            try:
+                status = cart.remove_single_item(request.user, item, order)
+            except cart.CartLocked as e:
+                messages.warning(request, str(e))
+                return redirect("core:order-summary")
+        else:
+            status = order.remove_single(item)
+        if status == cart.UPDATED:
+            messages.info(request, "This item quantity was updated.")
+        elif status == cart.REMOVED:
+            messages.info(request, "This item was removed from your cart.")
         else:
             messages.info(request, "This item was not in your cart.")
-            return redirect("core:order-summary")
+        return redirect("core:order-summary")
 
     else:
         messages.info(request, "You don't have an active order.")
         return redirect("core:order-summary")
 
-def get_coupon(request, code):
-    try:
-        coupon = Coupon.objects.get(code = code)
-        return coupon
-    except ObjectDoesNotExist:
-        messages.info(request, "This coupon does not exist")
-        return redirect("core:checkout")
-
-class AddCouponView(View):
+class AddCouponView(LoginRequiredMixin, View):
     def post(self, *args, **kwargs):
         form = CouponForm(self.request.POST or None)
         if form.is_valid():
-            try:
-                code = form.cleaned_data.get("code")
-                order = Order.objects.get(
-                    user    = self.request.user,
-                    ordered = False
-                )
-                order.coupon = get_coupon(self.request, code)
-                order.save()
-                messages.success(self.request, "Successfully added coupon")
-                return redirect("core:checkout")
-            except ObjectDoesNotExist:
+            order = self.request.cart
+            if not order:
                 messages.info(self.request, "You don't have an active order.")
                 return redirect("core:checkout")
+            try:
+                apply_coupon(order, self.request.user, form.cleaned_data.get("code"))
+            except CouponError as e:
+                messages.warning(self.request, str(e))
+                return redirect("core:checkout")
+            messages.success(self.request, "Successfully added coupon")
+        return redirect("core:checkout")
 
 class RequestRefundView(View):
     def get(self, *args, **kwargs):
@@ -487,3 +406,13 @@ class RequestRefundView(View):
             except ObjectDoesNotExist:
                 messages.info(self.request, "This order does not exist")
                 return redirect("core:request-refund")
+
+def metrics_view(request):
+    token = getattr(settings, "METRICS_TOKEN", None)
+    if token:
+        allowed = request.META.get("HTTP_AUTHORIZATION") == f"Bearer {token}"
+    else:
+        allowed = request.user.is_staff
+    if not allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.registry.render(), content_type = "text/plain; version=0.0.4; charset=utf-8")
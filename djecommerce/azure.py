@@ -23,8 +23,40 @@ DATABASES = {
         'OPTIONS': {'sslmode': 'require'},
     }
 }
+if os.getenv('POSTGRES_REPLICA_HOST'):
+    DATABASES['replica'] = dict(DATABASES['default'], HOST=os.getenv('POSTGRES_REPLICA_HOST'),
+                                TEST={'MIRROR': 'default'})
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
 
-STATICFILES_STORAGE = 'storages.backends.azure_storage.AzureStorage'
+# The catalog and coupon version keys must be seen by every worker, a
+# process-local cache would leave the other workers on stale pages. The
+# table is created with `python manage.py createcachetable`; point
+# CACHE_BACKEND / CACHE_LOCATION to memcached to move it off the database.
+# Pages and product cards are keyed on the version or the item's updated_at,
+# they are kept in process memory and cost no round trip.
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'django_cache'),
+    },
+    'local': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'djecommerce',
+    },
+    'template_fragments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'djecommerce-fragments',
+    },
+}
+CATALOG_CACHE = 'local'
+CATALOG_VERSION_CACHE = 'default'
+
+SEARCH_BACKEND = 'core.search.PostgresSearchBackend'
+
+STATICFILES_STORAGE = 'core.azure_storage.CompressedManifestAzureStorage'
+# static files are served by the container, assets are referenced by hashed names
+STATIC_SERVE = False
+AZURE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
 AZURE_ACCOUNT_NAME = os.getenv('AZ_STORAGE_ACCOUNT_NAME')
 AZURE_CONTAINER = os.getenv('AZ_STORAGE_CONTAINER')
 AZURE_ACCOUNT_KEY = os.getenv('AZ_STORAGE_KEY')
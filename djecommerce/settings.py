@@ -28,13 +28,17 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'core.middleware.StaticFilesMiddleware',
+    'core.middleware.ReplicaPinMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
-    'django.middleware.clickjacking.XFrameOptionsMiddleware'
+    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'core.middleware.CartMiddleware',
 ]
 
 ROOT_URLCONF = 'djecommerce.urls'
@@ -43,13 +47,21 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # templates are compiled once per process, also with DEBUG (restart
+            # the server to pick up template edits)
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'core.context_processors.cart',
             ],
         },
     },
@@ -64,6 +76,12 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static_files')]
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
+# collectstatic writes content-hashed names, a staticfiles.json manifest and
+# .gz/.br variants (.br needs the brotli package). StaticFilesMiddleware
+# serves them from STATIC_ROOT, hashed names cached for STATIC_MAX_AGE seconds.
+STATICFILES_STORAGE = 'core.storage.CompressedManifestStaticFilesStorage'
+STATIC_SERVE = os.getenv('STATIC_SERVE', '1') == '1'
+STATIC_MAX_AGE = 60 * 60 * 24 * 365
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
@@ -88,9 +106,75 @@ DATABASES = {
     }
 }
 
+# Read replicas, see core/routers.py. Locally a copy of db.sqlite3 will do:
+# `cp db.sqlite3 replica.sqlite3 && DATABASE_REPLICA=replica.sqlite3 ...`
+if os.getenv('DATABASE_REPLICA'):
+    DATABASES["replica"] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.path.join(BASE_DIR, os.getenv('DATABASE_REPLICA')),
+        "TEST": {"MIRROR": "default"},
+    }
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['core.routers.ReplicaRouter']
+# Users who wrote, and catalog cache entries filled right after a catalog
+# change, read from the primary for this many seconds; keep it above the
+# replication lag. A replica that refuses connections is skipped for
+# REPLICA_RETRY_SECONDS
+REPLICA_PIN_SECONDS = 5
+REPLICA_RETRY_SECONDS = 30
+
+# LocMemCache is per process: fine for development, but every deployment
+# running more than one worker needs a shared backend (see azure.py)
+CACHES = {
+    "default": {
+        "BACKEND": os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        "LOCATION": os.getenv('CACHE_LOCATION', 'djecommerce'),
+    }
+}
+
+# Catalog pages and counts are cached per catalog version, see core/catalog.py.
+# The version keys (catalog and coupons) live in CATALOG_VERSION_CACHE, which
+# has to be shared by all workers; the values can stay in a local cache.
+CATALOG_CACHE = "default"
+CATALOG_VERSION_CACHE = "default"
+CATALOG_CACHE_TIMEOUT = 60 * 15
+
+# Product search, see core/search.py
+SEARCH_BACKEND = 'core.search.SqliteSearchBackend'
+
 LOGIN_REDIRECT_URL = "/"
 
 STRIPE_SECRET_KEY = "sk_test_4eC39HqLyjWDarjtT1zdp7dc"
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE', 'https://api.stripe.com')
+
+# Saved card summaries are refreshed in the background once older than the
+# TTL and dropped after the max age (seconds)
+STRIPE_CARD_CACHE_TTL = 60 * 5
+STRIPE_CARD_CACHE_MAX_AGE = 60 * 60 * 24
+
+# Batch refunds: concurrent Stripe calls, client-side calls per second and
+# retries of rate limited calls (backoff in seconds, doubled per attempt)
+REFUND_WORKERS = 4
+REFUND_RATE_LIMIT = 20
+REFUND_MAX_ATTEMPTS = 5
+REFUND_RETRY_BACKOFF = 1
+
+# Sales rollups (`python manage.py rollup_sales`) leave payments younger than
+# this many seconds for the next run, their transaction may not be committed
+SALES_ROLLUP_LAG = 60
+
+# Per-route request metrics served at /metrics/. The endpoint needs a staff
+# login, or `Authorization: Bearer <METRICS_TOKEN>` when a token is set.
+# METRICS_SLOW_QUERIES > 0 logs the slowest queries of each request with
+# their call sites.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+METRICS_SLOW_QUERIES = int(os.getenv('METRICS_SLOW_QUERIES', 0))
+
+# Charges run inside the checkout request unless PAYMENT_JOBS_EAGER=0, then
+# `python manage.py process_payments` must run alongside the web server or
+# the carts stay locked behind their pending payment.
+PAYMENT_JOBS_EAGER = os.getenv('PAYMENT_JOBS_EAGER', '1') == '1'
 
 if ENVIRONMENT == 'production':
     DEBUG = False
@@ -3,9 +3,12 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
 
+from core.views import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('accounts/', include('allauth.urls')),
+    path('metrics/', metrics_view, name='metrics'),
     path('', include('core.urls', namespace='core')),
 ]
 